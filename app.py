@@ -8,15 +8,23 @@ import os
 import json
 import hashlib
 import base64
+import time
 import urllib.request
 import urllib.error
 from datetime import datetime, timezone, timedelta
-from flask import Flask, request, jsonify, render_template_string, Response, redirect
+from flask import Flask, request, jsonify, render_template_string, Response, redirect, g, has_app_context, stream_with_context
 from flask_cors import CORS
 import psycopg
+from psycopg.pq import TransactionStatus
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
 import qrcode
+import click
 import threading
+import functools
+import concurrent.futures
+import contextlib
+import hmac
 
 # Timezone Brasil (UTC-3)
 BRT = timezone(timedelta(hours=-3))
@@ -38,10 +46,126 @@ EMAIL_ENABLED = os.environ.get('EMAIL_ENABLED', 'true').lower() == 'true'
 # Para testes: se configurado, todos os emails vão para este endereço
 EMAIL_TEST_OVERRIDE = os.environ.get('EMAIL_TEST_OVERRIDE', '')
 
+# Pool de conexões PostgreSQL (um por processo - cada worker do gunicorn cria o seu)
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '5'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '30'))  # Espera máxima por uma conexão (s)
+DB_POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', '300'))  # Conexões ociosas além disso são fechadas (s)
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', '1800'))  # Reciclagem periódica (s)
+DB_POOL_ALERTA_ESPERA_MS = float(os.environ.get('DB_POOL_ALERTA_ESPERA_MS', '200'))
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+def get_pool():
+    """Retorna o pool de conexões do processo atual, criando-o sob demanda.
+
+    O pool é recriado se o processo mudou (fork do gunicorn com --preload),
+    pois conexões e threads do pool não sobrevivem ao fork.
+    """
+    global _db_pool, _db_pool_pid
+    pid = os.getpid()
+    if _db_pool is None or _db_pool_pid != pid:
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool_pid != pid:
+                _db_pool = ConnectionPool(
+                    DATABASE_URL,
+                    kwargs={'row_factory': dict_row},
+                    min_size=DB_POOL_MIN,
+                    max_size=DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    max_lifetime=DB_POOL_MAX_LIFETIME,
+                    check=ConnectionPool.check_connection,  # Descarta conexões quebradas antes de entregar
+                    name=f'hami-{pid}',
+                    open=True
+                )
+                _db_pool_pid = pid
+    return _db_pool
+
+class ConexaoPool:
+    """Conexão emprestada do pool.
+
+    Repassa tudo para a conexão psycopg, mas close() devolve a conexão ao pool
+    em vez de encerrá-la. Também funciona como context manager (commit no
+    sucesso, rollback em caso de erro, devolução garantida).
+    """
+
+    def __init__(self, pool, conn, espera_ms):
+        self._pool = pool
+        self._conn = conn
+        self.espera_ms = espera_ms
+
+    def __getattr__(self, nome):
+        if self._conn is None:
+            raise psycopg.InterfaceError('Conexão já devolvida ao pool')
+        return getattr(self._conn, nome)
+
+    @property
+    def autocommit(self):
+        return self._conn.autocommit
+
+    @autocommit.setter
+    def autocommit(self, valor):
+        self._conn.autocommit = valor
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        # Transação aberta (ex.: rota só de leitura) - desfazer antes de devolver
+        if not conn.closed and conn.info.transaction_status != TransactionStatus.IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+        # Devolver sempre no modo padrão (transacional)
+        if not conn.closed and conn.autocommit:
+            conn.autocommit = False
+        self._pool.putconn(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self._conn is not None and not self._conn.closed:
+                if exc_type is None:
+                    self._conn.commit()
+                else:
+                    self._conn.rollback()
+        finally:
+            self.close()
+
 def get_db():
-    """Retorna conexão com o banco de dados"""
-    conn = psycopg.connect(DATABASE_URL, row_factory=dict_row)
-    return conn
+    """Retorna conexão do pool (close() ou fim do bloco with devolve ao pool)"""
+    pool = get_pool()
+    inicio = time.perf_counter()
+    conn = pool.getconn()
+    espera_ms = (time.perf_counter() - inicio) * 1000
+    if espera_ms >= DB_POOL_ALERTA_ESPERA_MS:
+        print(f"[DB] Espera de {espera_ms:.0f} ms por conexão do pool")
+    conexao = ConexaoPool(pool, conn, espera_ms)
+    # Dentro de uma requisição, registrar para devolução garantida no teardown
+    if has_app_context():
+        g.setdefault('_conexoes_db', []).append(conexao)
+    return conexao
+
+@app.teardown_appcontext
+def devolver_conexoes_db(exc):
+    """Devolve ao pool conexões que a rota não fechou (retornos antecipados, exceções)"""
+    for conexao in g.pop('_conexoes_db', []):
+        conexao.close()
+
+def estatisticas_pool():
+    """Estatísticas do pool deste processo (tempo de espera, conexões em uso, etc.)"""
+    if _db_pool is None or _db_pool_pid != os.getpid():
+        return None
+    stats = _db_pool.get_stats()
+    if stats.get('requests_num'):
+        stats['requests_wait_ms_media'] = round(stats.get('requests_wait_ms', 0) / stats['requests_num'], 2)
+    return stats
 
 def enviar_email_assinatura(email_destino, assunto, corpo_html, anexo_pdf=None, nome_anexo=None):
     """Envia email usando API do Resend (HTTP)"""
@@ -104,51 +228,34 @@ def notificar_assinatura_individual(doc_id, signatario_nome, todos_assinaram=Fal
     try:
         print(f"[EMAIL] Iniciando notificação para doc_id: {doc_id}, signatario: {signatario_nome}")
         
-        conn = get_db()
-        cur = conn.cursor()
-        
-        # Buscar documento e email do criador
-        cur.execute('''
-            SELECT titulo, arquivo_nome, criado_por, email_criador, lote_id
-            FROM documentos WHERE doc_id = %s
-        ''', (doc_id,))
-        doc = cur.fetchone()
-        
-        print(f"[EMAIL] Documento encontrado: {doc}")
-        
-        if not doc or not doc.get('email_criador'):
-            print(f"[EMAIL] Email criador não encontrado ou vazio para doc_id: {doc_id}")
-            cur.close()
-            conn.close()
-            return False
-        
-        # Se for um lote, buscar todos os documentos do lote
-        lote_id = doc.get('lote_id')
-        docs_lote = []
-        if lote_id:
-            cur.execute('SELECT doc_id, titulo, arquivo_nome FROM documentos WHERE lote_id = %s', (lote_id,))
-            docs_lote = [{'doc_id': r['doc_id'], 'titulo': r['titulo'] or r['arquivo_nome']} for r in cur.fetchall()]
-        
-        # Buscar total e status dos signatários (pelo lote se aplicável)
-        if lote_id:
-            cur.execute('''
-                SELECT COUNT(*) as total, 
-                       SUM(CASE WHEN assinado THEN 1 ELSE 0 END) as assinados
-                FROM signatarios WHERE lote_id = %s
-            ''', (lote_id,))
-        else:
+        # Conexão devolvida ao pool ao sair do bloco (inclusive em erro - roda em thread)
+        with get_db() as conn:
+            cur = conn.cursor()
+            
+            # Buscar documento e email do criador
             cur.execute('''
-                SELECT COUNT(*) as total, 
-                       SUM(CASE WHEN assinado THEN 1 ELSE 0 END) as assinados
-                FROM signatarios WHERE doc_id = %s
+                SELECT titulo, arquivo_nome, criado_por, email_criador, lote_id, total_signatarios, assinados
+                FROM documentos WHERE doc_id = %s
             ''', (doc_id,))
-        stats = cur.fetchone()
-        
-        cur.close()
-        conn.close()
+            doc = cur.fetchone()
+            
+            print(f"[EMAIL] Documento encontrado: {doc}")
+            
+            if not doc or not doc.get('email_criador'):
+                print(f"[EMAIL] Email criador não encontrado ou vazio para doc_id: {doc_id}")
+                return False
+            
+            # Se for um lote, buscar todos os documentos do lote
+            lote_id = doc.get('lote_id')
+            docs_lote = []
+            if lote_id:
+                cur.execute('SELECT doc_id, titulo, arquivo_nome FROM documentos WHERE lote_id = %s', (lote_id,))
+                docs_lote = [{'doc_id': r['doc_id'], 'titulo': r['titulo'] or r['arquivo_nome']} for r in cur.fetchall()]
+            cur.close()
         
-        total = stats['total']
-        assinados = stats['assinados']
+        # Progresso mantido no documento (espelha o lote quando aplicável)
+        total = doc['total_signatarios']
+        assinados = doc['assinados']
         
         # URL base do servidor
         server_url = "https://signature-server-jq9j.onrender.com"
@@ -246,31 +353,27 @@ def notificar_signatario_individual(doc_id, signatario_nome, email_signatario, t
         return False
     
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        
-        # Buscar documento com lote_id
-        cur.execute('''
-            SELECT doc_id, titulo, arquivo_nome, lote_id
-            FROM documentos WHERE doc_id = %s
-        ''', (doc_id,))
-        doc = cur.fetchone()
-        
-        if not doc:
-            print(f"[EMAIL-SIGNATARIO] Documento não encontrado: {doc_id}")
+        with get_db() as conn:
+            cur = conn.cursor()
+            
+            # Buscar documento com lote_id
+            cur.execute('''
+                SELECT doc_id, titulo, arquivo_nome, lote_id
+                FROM documentos WHERE doc_id = %s
+            ''', (doc_id,))
+            doc = cur.fetchone()
+            
+            if not doc:
+                print(f"[EMAIL-SIGNATARIO] Documento não encontrado: {doc_id}")
+                return False
+            
+            # Se for um lote, buscar todos os documentos do lote
+            lote_id = doc.get('lote_id')
+            docs_lote = []
+            if lote_id:
+                cur.execute('SELECT doc_id, titulo, arquivo_nome FROM documentos WHERE lote_id = %s', (lote_id,))
+                docs_lote = [{'doc_id': r['doc_id'], 'titulo': r['titulo'] or r['arquivo_nome']} for r in cur.fetchall()]
             cur.close()
-            conn.close()
-            return False
-        
-        # Se for um lote, buscar todos os documentos do lote
-        lote_id = doc.get('lote_id')
-        docs_lote = []
-        if lote_id:
-            cur.execute('SELECT doc_id, titulo, arquivo_nome FROM documentos WHERE lote_id = %s', (lote_id,))
-            docs_lote = [{'doc_id': r['doc_id'], 'titulo': r['titulo'] or r['arquivo_nome']} for r in cur.fetchall()]
-        
-        cur.close()
-        conn.close()
         
         print(f"[EMAIL-SIGNATARIO] Documento encontrado: {doc['titulo'] or doc['arquivo_nome']}, Lote: {len(docs_lote)} docs")
         
@@ -357,110 +460,647 @@ def notificar_signatario_async(doc_id, signatario_nome, email_signatario, todos_
     print(f"[EMAIL-SIGNATARIO] Thread iniciada para {email_signatario}")
 
 
-def init_db():
-    """Inicializa tabelas do banco de dados"""
+# ==================== MIGRAÇÕES ====================
+# Alterações de esquema ficam em migrations/NNNN_nome.sql e são aplicadas em
+# ordem, uma única vez, pelo comando `flask --app app migrar` (executado no
+# deploy, antes de subir o gunicorn). A tabela schema_version registra as
+# versões já aplicadas; os workers não mexem no esquema ao iniciar.
+
+MIGRACOES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRACOES_LOCK_ID = 7351001  # pg_advisory_lock: um único migrador por vez
+
+def listar_migracoes():
+    """Lista (versão, nome, caminho) dos arquivos de migração em ordem de versão"""
+    migracoes = []
+    for arquivo in sorted(os.listdir(MIGRACOES_DIR)):
+        if not arquivo.endswith('.sql'):
+            continue
+        versao, _, nome = arquivo[:-4].partition('_')
+        if not versao.isdigit():
+            raise ValueError(f"Migração com nome inválido: {arquivo}")
+        migracoes.append((int(versao), nome, os.path.join(MIGRACOES_DIR, arquivo)))
+    versoes = [m[0] for m in migracoes]
+    if len(versoes) != len(set(versoes)):
+        raise ValueError("Migrações com versão duplicada")
+    return migracoes
+
+def migrar_banco():
+    """Aplica as migrações pendentes e cria os índices.
+
+    Cada migração roda na sua própria transação junto com o registro em
+    schema_version: uma falha desfaz só aquela migração e interrompe o
+    processo com erro, assim como a falha ao criar um índice. Os índices são criados ainda sob o lock, para que duas
+    instâncias subindo juntas não disputem o mesmo CREATE INDEX CONCURRENTLY.
+    Retorna a lista de versões aplicadas.
+    """
+    aplicadas = []
     conn = get_db()
+    conn.autocommit = True
+    try:
+        # Espera o lock fora de qualquer consulta: um pg_advisory_lock bloqueado
+        # seguraria um snapshot, e o CREATE INDEX CONCURRENTLY de quem tem o
+        # lock esperaria por ele (deadlock)
+        while not conn.execute('SELECT pg_try_advisory_lock(%s) AS ok', (MIGRACOES_LOCK_ID,)).fetchone()['ok']:
+            time.sleep(1)
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    versao INTEGER PRIMARY KEY,
+                    nome VARCHAR(255) NOT NULL,
+                    aplicada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            ja_aplicadas = {row['versao'] for row in conn.execute('SELECT versao FROM schema_version').fetchall()}
+            for versao, nome, caminho in listar_migracoes():
+                if versao in ja_aplicadas:
+                    continue
+                with open(caminho, encoding='utf-8') as f:
+                    sql = f.read()
+                print(f"[MIGRAR] Aplicando {versao:04d}_{nome}")
+                with conn.transaction():
+                    conn.execute(sql)
+                    conn.execute('INSERT INTO schema_version (versao, nome) VALUES (%s, %s)', (versao, nome))
+                aplicadas.append(versao)
+            criar_indices(conn)
+        finally:
+            conn.execute('SELECT pg_advisory_unlock(%s)', (MIGRACOES_LOCK_ID,))
+    finally:
+        conn.close()
+    
+    print(f"[MIGRAR] {len(aplicadas)} migração(ões) aplicada(s)")
+    return aplicadas
+
+@app.cli.command('migrar')
+def comando_migrar():
+    """Aplica as migrações de esquema pendentes (rodar antes de iniciar o servidor).
+
+    Termina com código 1 se uma migração ou um índice falhar: o deploy não sobe.
+    """
+    import sys
+    try:
+        migrar_banco()
+    except Exception as e:
+        print(f"[MIGRAR] Falha: {e}")
+        sys.exit(1)
+
+# ==================== ÍNDICES ====================
+
+# Índices dos caminhos de acesso mais usados: (nome, definição)
+# (índices únicos ficam nas migrações, como idx_log_auditoria_cadeia_seq na 0012)
+INDICES = [
+    ('idx_signatarios_lote_id', 'signatarios (lote_id)'),                   # lotes: assinar, notificações, PDF assinado
+    ('idx_signatarios_doc_id', 'signatarios (doc_id)'),                     # status, dossiê, verificação
+    ('idx_documentos_lote_id', 'documentos (lote_id)'),                     # documentos de um lote
+    ('idx_documentos_arquivo_hash', 'documentos (arquivo_hash)'),           # verificar_permanente, blobs
+    ('idx_documentos_criado_em_id', 'documentos (criado_em, id)'),          # listagem paginada, período, limpeza dos mais antigos
+    ('idx_documentos_pasta_criado_em', 'documentos (pasta_id, criado_em, id)'),      # listagem por pasta, excluir_pasta
+    ('idx_documentos_criado_por_criado_em', 'documentos (criado_por, criado_em, id)'),  # listagem por criador
+    ('idx_documentos_pendentes_criado_em', 'documentos (criado_em, id) WHERE concluido_em IS NULL'),       # status=pendente
+    ('idx_documentos_concluidos_criado_em', 'documentos (criado_em, id) WHERE concluido_em IS NOT NULL'),  # status=concluido
+    ('idx_pastas_pasta_pai_id', 'pastas (pasta_pai_id)'),                   # excluir_pasta (subpastas)
+    ('idx_evidencias_hash_arquivo_hash', 'evidencias_hash (arquivo_hash)'), # verificar_permanente
+    ('idx_evidencias_hash_doc_id', 'evidencias_hash (doc_id)'),             # verificar_permanente (por doc_id)
+]
+
+def consultas_indexadas():
+    """Consultas críticas das rotas, com parâmetros de exemplo, e a tabela que não pode ser lida por varredura sequencial.
+
+    Usa o mesmo SQL das rotas (constantes SQL_* e sql_listagem_documentos):
+    [(descrição, tabela, sql, parâmetros)].
+    """
+    data = datetime(2024, 1, 1)
+    consultas = [
+        ('signatário por token', 'signatarios', SQL_SIGNATARIO_POR_TOKEN, ('x',)),
+        ('signatário para validar', 'signatarios', SQL_SIGNATARIO_PARA_VALIDAR, ('x',)),
+        ('signatário para assinar', 'signatarios', SQL_SIGNATARIO_PARA_ASSINAR, ('x',)),
+        ('documentos do lote', 'documentos', SQL_DOCUMENTOS_DO_LOTE, ('x',)),
+        ('signatários do lote (PDF)', 'signatarios', SQL_SIGNATARIOS_PARA_PDF.format(coluna='lote_id'), ('x',)),
+        ('signatários do documento (PDF)', 'signatarios', SQL_SIGNATARIOS_PARA_PDF.format(coluna='doc_id'), ('x',)),
+        ('documento por hash', 'documentos', SQL_DOCUMENTO_POR_HASH, ('x',)),
+        ('documento por doc_id', 'documentos', SQL_DOCUMENTO_POR_DOC_ID, ('x',)),
+        ('evidências do hash', 'evidencias_hash', SQL_EVIDENCIAS_DO_HASH, ('x', 'x')),
+        ('assinados do lote', 'signatarios', SQL_ASSINADOS_PERMANENTE.format(coluna='lote_id'), ('x',)),
+        ('assinados do documento', 'signatarios', SQL_ASSINADOS_PERMANENTE.format(coluna='doc_id'), ('x',)),
+        ('documentos da pasta', 'documentos', SQL_CONTAR_DOCUMENTOS_DA_PASTA, (2,)),
+        ('subpastas', 'pastas', SQL_CONTAR_SUBPASTAS, (2,)),
+        ('documentos mais antigos', 'documentos', SQL_DOCUMENTOS_MAIS_ANTIGOS, (10,)),
+        ('signatários dos documentos removidos', 'signatarios', SQL_REMOVER_SIGNATARIOS_DOS_DOCUMENTOS, (['x', 'y'],)),
+        ('documentos removidos', 'documentos', SQL_REMOVER_DOCUMENTOS, (['x', 'y'],)),
+        ('lotes esvaziados', 'documentos', SQL_REMOVER_LOTES_VAZIOS, (['x', 'y'],)),
+    ]
+    # Listagem: cada filtro, na primeira página e nas seguintes (cursor)
+    filtros = [
+        ('listagem', {}),
+        ('listagem da pasta', {'pasta_id': '2'}),
+        ('listagem do criador', {'criado_por': 'x'}),
+        ('listagem do lote', {'lote_id': 'x'}),
+        ('listagem de pendentes', {'status': 'pendente'}),
+        ('listagem de concluídos', {'status': 'concluido'}),
+        ('listagem por período', {'de': '01/01/2024', 'ate': '31/01/2024'}),
+    ]
+    for descricao, args in filtros:
+        condicoes, params = filtros_documentos(args)
+        consultas.append((descricao, 'documentos', *sql_listagem_documentos(condicoes, params, LISTAGEM_LIMITE_PADRAO + 1)))
+        consultas.append((f'{descricao} (cursor)', 'documentos',
+                          *sql_listagem_documentos(condicoes, params, LISTAGEM_LIMITE_PADRAO + 1, (data, 10))))
+    return consultas
+
+# Índices substituídos por outros de INDICES, ou sem consulta que os use
+# (removidos depois que os novos existem)
+INDICES_REMOVIDOS = [
+    'idx_documentos_criado_em',   # -> idx_documentos_criado_em_id
+    'idx_documentos_pasta_id',    # -> idx_documentos_pasta_criado_em
+    'idx_log_auditoria_doc_id_acao',  # verificar_permanente lê evidencias_hash
+]
+
+def criar_indices(conn):
+    """Cria os índices de INDICES que ainda não existem.
+
+    Usa CREATE INDEX CONCURRENTLY (sem travar escritas nas tabelas) e recria
+    índices deixados inválidos por uma criação interrompida. conn deve estar
+    em autocommit (CONCURRENTLY não roda dentro de transação); migrar_banco
+    passa a conexão que segura o lock das migrações.
+    """
     cur = conn.cursor()
+    for nome, definicao in INDICES:
+        cur.execute('''
+            SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+            WHERE c.relname = %s
+        ''', (nome,))
+        row = cur.fetchone()
+        if row and row['indisvalid']:
+            continue
+        if row:
+            cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {nome}')
+        try:
+            cur.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {nome} ON {definicao}')
+        except Exception as e:
+            # A falha interrompe a migração (e o deploy); o índice que o
+            # CONCURRENTLY deixou inválido é removido para o próximo migrar
+            print(f"[DB] Erro ao criar índice {nome}: {e}")
+            cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {nome}')
+            raise
+        print(f"[DB] Índice criado: {nome}")
+    for nome in INDICES_REMOVIDOS:
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {nome}')
+    cur.close()
+
+def varreduras_sequenciais(plano, tabela):
+    """Nós Seq Scan sobre a tabela em um plano EXPLAIN (FORMAT JSON)"""
+    encontrados = []
+    if plano.get('Node Type') == 'Seq Scan' and plano.get('Relation Name') == tabela:
+        encontrados.append(plano)
+    for filho in plano.get('Plans', []):
+        encontrados.extend(varreduras_sequenciais(filho, tabela))
+    return encontrados
+
+def verificar_planos_consultas(forcar_indices=True):
+    """Verifica se cada consulta de consultas_indexadas() é atendida por índice.
+
+    Com forcar_indices (enable_seqscan desligado) o planejador só escolhe
+    varredura sequencial quando nenhum índice serve - independente do volume
+    de dados da tabela, então serve para um banco vazio. Sem ele, vale o
+    plano que o planejador escolheria de fato (banco com dados e ANALYZE).
+    Retorna a lista de (descrição, plano) das consultas sem índice.
+    """
+    falhas = []
+    with get_db() as conn:
+        cur = conn.cursor()
+        if forcar_indices:
+            cur.execute('SET LOCAL enable_seqscan = off')
+        for descricao, tabela, sql, params in consultas_indexadas():
+            cur.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plano = cur.fetchone()['QUERY PLAN'][0]['Plan']
+            if varreduras_sequenciais(plano, tabela):
+                falhas.append((descricao, plano))
+        cur.close()
+        conn.rollback()
+    return falhas
+
+@app.cli.command('verificar-indices')
+@click.option('--planejador-padrao', is_flag=True, help='Não desliga enable_seqscan (vale o plano escolhido com os dados atuais)')
+def comando_verificar_indices(planejador_padrao):
+    """Falha (código 1) se alguma consulta crítica cair em varredura sequencial"""
+    import sys
+    falhas = verificar_planos_consultas(forcar_indices=not planejador_padrao)
+    for descricao, plano in falhas:
+        print(f"SEQ SCAN: {descricao}")
+        print(json.dumps(plano, indent=2))
+    total = len(consultas_indexadas())
+    print(f"{total - len(falhas)}/{total} consultas atendidas por índice")
+    if falhas:
+        sys.exit(1)
+
+# ==================== ARMAZENAMENTO DE ARQUIVOS (BLOBS) ====================
+# PDFs são gravados uma única vez, endereçados pelo SHA-256 do conteúdo
+# (documentos.arquivo_hash). A linha de documentos guarda apenas o hash.
+
+BLOB_BACKEND = os.environ.get('BLOB_BACKEND', 'local')  # local | s3 | banco (só se escolhido)
+BLOB_DIR = os.environ.get('BLOB_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blobs'))
+BLOB_S3_BUCKET = os.environ.get('BLOB_S3_BUCKET', '')
+BLOB_S3_PREFIXO = os.environ.get('BLOB_S3_PREFIXO', 'blobs/')
+BLOB_S3_ENDPOINT_URL = os.environ.get('BLOB_S3_ENDPOINT_URL', '')  # R2, MinIO, etc.
+BLOB_PARTE_TAMANHO = 256 * 1024  # Leituras e gravações em partes (streaming)
+# Arquivos temporários (PDF original, PDF assinado em montagem) ficam em
+# memória até este tamanho e passam para disco acima dele
+ARQUIVO_SPOOL_LIMITE = int(os.environ.get('ARQUIVO_SPOOL_LIMITE', 8 * 1024 * 1024))
+
+class BlobStoreBanco:
+    """Blobs na tabela arquivos_blob - só com BLOB_BACKEND=banco (sem disco persistente nem S3).
+
+    Os PDFs continuam no PostgreSQL (backups e VACUUM maiores); por isso não é o padrão.
+    """
     
-    # Tabela de documentos
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS documentos (
-            id SERIAL PRIMARY KEY,
-            doc_id VARCHAR(64) UNIQUE NOT NULL,
-            titulo VARCHAR(255),
-            arquivo_nome VARCHAR(255),
-            arquivo_base64 TEXT,
-            arquivo_hash VARCHAR(64),
-            criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            criado_por VARCHAR(100)
-        )
-    ''')
+    nome = 'banco'
     
-    # Tabela de signatários (atualizada com novos campos)
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS signatarios (
-            id SERIAL PRIMARY KEY,
-            doc_id VARCHAR(64) REFERENCES documentos(doc_id),
-            nome VARCHAR(255) NOT NULL,
-            email VARCHAR(255),
-            cpf VARCHAR(14),
-            telefone VARCHAR(20),
-            token VARCHAR(64) UNIQUE NOT NULL,
-            assinado BOOLEAN DEFAULT FALSE,
-            assinatura_base64 TEXT,
-            selfie_base64 TEXT,
-            ip_assinatura VARCHAR(45),
-            data_assinatura TIMESTAMP,
-            user_agent TEXT,
-            latitude DECIMAL(10, 8),
-            longitude DECIMAL(11, 8),
-            endereco_aproximado TEXT,
-            data_nascimento DATE
-        )
-    ''')
+    def existe(self, hash_hex):
+        with get_db() as conn:
+            return conn.execute('SELECT 1 FROM arquivos_blob WHERE hash = %s', (hash_hex,)).fetchone() is not None
     
-    # Adicionar colunas se não existirem (para bancos existentes)
-    try:
-        cur.execute('ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS selfie_base64 TEXT')
-        cur.execute('ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS telefone VARCHAR(20)')
-        cur.execute('ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS latitude DECIMAL(10, 8)')
-        cur.execute('ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS longitude DECIMAL(11, 8)')
-        cur.execute('ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS endereco_aproximado TEXT')
-        cur.execute('ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS data_nascimento DATE')
-        cur.execute('ALTER TABLE documentos ADD COLUMN IF NOT EXISTS arquivo_hash VARCHAR(64)')
-        cur.execute('ALTER TABLE documentos ADD COLUMN IF NOT EXISTS pasta_id INTEGER DEFAULT 1')
-        cur.execute('ALTER TABLE documentos ADD COLUMN IF NOT EXISTS email_criador VARCHAR(255)')
-    except:
-        pass
-    
-    # Tabela de pastas para organizar documentos
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS pastas (
-            id SERIAL PRIMARY KEY,
-            nome VARCHAR(100) NOT NULL,
-            pasta_pai_id INTEGER REFERENCES pastas(id) ON DELETE CASCADE,
-            criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            criado_por VARCHAR(100)
-        )
-    ''')
+    def salvar(self, hash_hex, dados, cur=None):
+        # Com cur, na transação de quem grava a referência: o blob e a linha de
+        # blob_referencias são confirmados ou desfeitos juntos
+        sql = '''
+            INSERT INTO arquivos_blob (hash, conteudo, tamanho) VALUES (%s, %s, %s)
+            ON CONFLICT (hash) DO NOTHING
+        '''
+        if cur is not None:
+            cur.execute(sql, (hash_hex, dados, len(dados)))
+            return
+        with get_db() as conn:
+            conn.execute(sql, (hash_hex, dados, len(dados)))
     
-    # Tabela de log de auditoria com hash encadeado (blockchain-like)
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS log_auditoria (
-            id SERIAL PRIMARY KEY,
-            doc_id VARCHAR(64),
-            acao VARCHAR(50) NOT NULL,
-            usuario VARCHAR(200),
-            ip VARCHAR(50),
-            user_agent TEXT,
-            dados_adicionais JSONB,
-            hash_anterior VARCHAR(64),
-            hash_registro VARCHAR(64),
-            criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+    def salvar_arquivo(self, hash_hex, arquivo, cur=None):
+        # bytea não aceita gravação em partes: o conteúdo passa inteiro pela memória
+        self.salvar(hash_hex, arquivo.read(), cur)
     
-    # Criar pasta raiz se não existir
-    cur.execute("INSERT INTO pastas (id, nome, pasta_pai_id, criado_por) VALUES (1, 'Raiz', NULL, 'SISTEMA') ON CONFLICT (id) DO NOTHING")
+    def ler(self, hash_hex):
+        with get_db() as conn:
+            row = conn.execute('SELECT conteudo FROM arquivos_blob WHERE hash = %s', (hash_hex,), binary=True).fetchone()
+        return bytes(row['conteudo']) if row else None
     
-    # Adicionar colunas de aceite de termos se não existirem
-    try:
-        cur.execute('ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS aceite_termos BOOLEAN DEFAULT FALSE')
-        cur.execute('ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS data_aceite TIMESTAMP')
-        cur.execute('ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS hash_aceite VARCHAR(64)')
-    except:
-        pass
+    def ler_partes(self, hash_hex):
+        # conteudo é STORAGE EXTERNAL: substring lê do TOAST só os trechos pedidos.
+        # Uma conexão por parte, para não prender o pool enquanto o cliente baixa
+        inicio = 1
+        while True:
+            with get_db() as conn:
+                row = conn.execute('SELECT substring(conteudo FROM %s FOR %s) AS parte FROM arquivos_blob WHERE hash = %s',
+                                   (inicio, BLOB_PARTE_TAMANHO, hash_hex), binary=True).fetchone()
+            if not row or not row['parte']:
+                return
+            yield bytes(row['parte'])
+            if len(row['parte']) < BLOB_PARTE_TAMANHO:
+                return
+            inicio += BLOB_PARTE_TAMANHO
     
-    # Adicionar suporte a lotes (múltiplos documentos por assinatura)
-    try:
-        cur.execute('ALTER TABLE documentos ADD COLUMN IF NOT EXISTS lote_id VARCHAR(32)')
-        cur.execute('ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS lote_id VARCHAR(32)')
-    except:
-        pass
+    def remover(self, hash_hex):
+        with get_db() as conn:
+            conn.execute('DELETE FROM arquivos_blob WHERE hash = %s', (hash_hex,))
     
-    conn.commit()
-    cur.close()
-    conn.close()
+    def caminho_local(self, hash_hex):
+        return None
+
+class BlobStoreLocal:
+    """Blobs em disco, em diretórios fragmentados (ab/cd/abcd...) com gravação atômica"""
+    
+    nome = 'local'
+    
+    def __init__(self, diretorio):
+        self.diretorio = diretorio
+    
+    def _caminho(self, hash_hex):
+        return os.path.join(self.diretorio, hash_hex[:2], hash_hex[2:4], hash_hex)
+    
+    def existe(self, hash_hex):
+        return os.path.exists(self._caminho(hash_hex))
+    
+    def salvar(self, hash_hex, dados, cur=None):
+        from io import BytesIO
+        self.salvar_arquivo(hash_hex, BytesIO(dados))
+    
+    def salvar_arquivo(self, hash_hex, arquivo, cur=None):
+        import tempfile
+        import shutil
+        caminho = self._caminho(hash_hex)
+        if os.path.exists(caminho):
+            return
+        pasta = os.path.dirname(caminho)
+        os.makedirs(pasta, exist_ok=True)
+        # Grava em arquivo temporário na mesma pasta e renomeia: leitores nunca veem arquivo parcial
+        fd, temporario = tempfile.mkstemp(dir=pasta, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(arquivo, f, BLOB_PARTE_TAMANHO)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporario, caminho)
+        except BaseException:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+            raise
+    
+    def ler(self, hash_hex):
+        try:
+            with open(self._caminho(hash_hex), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+    
+    def ler_partes(self, hash_hex):
+        try:
+            f = open(self._caminho(hash_hex), 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            yield from iter(lambda: f.read(BLOB_PARTE_TAMANHO), b'')
+    
+    def remover(self, hash_hex):
+        try:
+            os.remove(self._caminho(hash_hex))
+        except FileNotFoundError:
+            pass
+    
+    def caminho_local(self, hash_hex):
+        caminho = self._caminho(hash_hex)
+        return caminho if os.path.exists(caminho) else None
+
+class BlobStoreS3:
+    """Blobs em armazenamento compatível com S3.
+
+    Recebe qualquer cliente com a interface do boto3 (put_object, get_object,
+    head_object, delete_object) - nos testes pode ser um substituto local.
+    """
+    
+    nome = 's3'
+    
+    def __init__(self, cliente, bucket, prefixo=''):
+        self.cliente = cliente
+        self.bucket = bucket
+        self.prefixo = prefixo
+    
+    def _chave(self, hash_hex):
+        return f"{self.prefixo}{hash_hex[:2]}/{hash_hex}"
+    
+    @staticmethod
+    def _nao_encontrado(e):
+        codigo = getattr(e, 'response', {}).get('Error', {}).get('Code')
+        return codigo in ('404', 'NoSuchKey', 'NotFound')
+    
+    def existe(self, hash_hex):
+        try:
+            self.cliente.head_object(Bucket=self.bucket, Key=self._chave(hash_hex))
+            return True
+        except Exception as e:
+            if self._nao_encontrado(e):
+                return False
+            raise
+    
+    def salvar(self, hash_hex, dados, cur=None):
+        self.cliente.put_object(Bucket=self.bucket, Key=self._chave(hash_hex), Body=dados)
+    
+    def salvar_arquivo(self, hash_hex, arquivo, cur=None):
+        self.cliente.put_object(Bucket=self.bucket, Key=self._chave(hash_hex), Body=arquivo)
+    
+    def _corpo(self, hash_hex):
+        try:
+            return self.cliente.get_object(Bucket=self.bucket, Key=self._chave(hash_hex))['Body']
+        except Exception as e:
+            if self._nao_encontrado(e):
+                return None
+            raise
+    
+    def ler(self, hash_hex):
+        corpo = self._corpo(hash_hex)
+        return corpo.read() if corpo is not None else None
+    
+    def ler_partes(self, hash_hex):
+        corpo = self._corpo(hash_hex)
+        if corpo is not None:
+            yield from iter(lambda: corpo.read(BLOB_PARTE_TAMANHO), b'')
+    
+    def remover(self, hash_hex):
+        self.cliente.delete_object(Bucket=self.bucket, Key=self._chave(hash_hex))
+    
+    def caminho_local(self, hash_hex):
+        return None
+
+def criar_blob_store(backend=None):
+    """Cria o blob store configurado em BLOB_BACKEND"""
+    backend = backend or BLOB_BACKEND
+    if backend == 'local':
+        return BlobStoreLocal(BLOB_DIR)
+    if backend == 's3':
+        import boto3  # Dependência opcional, só necessária com BLOB_BACKEND=s3
+        cliente = boto3.client('s3', endpoint_url=BLOB_S3_ENDPOINT_URL or None)
+        return BlobStoreS3(cliente, BLOB_S3_BUCKET, BLOB_S3_PREFIXO)
+    if backend == 'banco':
+        return BlobStoreBanco()
+    raise ValueError(f"BLOB_BACKEND inválido: {backend}")
+
+_blob_store = None
+
+def get_blob_store():
+    """Retorna o blob store do processo (criado sob demanda)"""
+    global _blob_store
+    if _blob_store is None:
+        _blob_store = criar_blob_store()
+    return _blob_store
+
+def referenciar_blob(cur, dados):
+    """Registra uma nova referência ao blob com este conteúdo e retorna o hash.
+
+    Deve rodar na transação que insere o documento. O conteúdo só é gravado no
+    blob store na primeira referência; PDFs repetidos (o mesmo modelo de contrato
+    enviado várias vezes) apenas incrementam o contador. No backend 'banco' o
+    blob entra na mesma transação; em disco/S3 um rollback deixa o arquivo sem
+    referência (regravado, com o mesmo conteúdo, se o PDF voltar).
+    """
+    from io import BytesIO
+    return referenciar_blob_arquivo(cur, BytesIO(dados))
+
+def referenciar_blob_arquivo(cur, arquivo):
+    """Como referenciar_blob, para conteúdo em um arquivo aberto (lido em partes)."""
+    sha = hashlib.sha256()
+    tamanho = 0
+    arquivo.seek(0)
+    for parte in iter(lambda: arquivo.read(BLOB_PARTE_TAMANHO), b''):
+        sha.update(parte)
+        tamanho += len(parte)
+    arquivo.seek(0)
+    hash_hex = sha.hexdigest()
+    # A linha fica travada até o commit: uma coleta concorrente espera por nós
+    cur.execute('''
+        INSERT INTO blob_referencias (hash, referencias, tamanho) VALUES (%s, 1, %s)
+        ON CONFLICT (hash) DO UPDATE SET referencias = blob_referencias.referencias + 1
+        RETURNING referencias
+    ''', (hash_hex, tamanho))
+    if cur.fetchone()['referencias'] == 1:
+        get_blob_store().salvar_arquivo(hash_hex, arquivo, cur)
+    return hash_hex
+
+def liberar_blobs(cur, hashes):
+    """Remove uma referência por hash (um por documento excluído), na transação da exclusão.
+
+    Os blobs que ficam sem referência são apagados depois, por coletar_blobs().
+    """
+    hashes = [h for h in hashes if h]
+    if not hashes:
+        return
+    cur.execute('''
+        UPDATE blob_referencias b SET referencias = GREATEST(b.referencias - r.qtd, 0)
+        FROM (SELECT h AS hash, COUNT(*) AS qtd FROM unnest(%s::text[]) AS h GROUP BY h) r
+        WHERE b.hash = r.hash
+    ''', (hashes,))
+
+def coletar_blobs():
+    """Apaga do blob store os blobs cuja última referência foi removida.
+
+    O conteúdo é apagado antes do commit que remove a linha de contagem; uma
+    inclusão concorrente do mesmo PDF espera a trava da linha e, ao recriá-la,
+    grava o conteúdo de novo. Retorna quantos blobs foram apagados.
+    """
+    store = get_blob_store()
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT hash FROM blob_referencias WHERE referencias <= 0 FOR UPDATE SKIP LOCKED')
+        removidos = []
+        for row in cur.fetchall():
+            try:
+                store.remover(row['hash'])
+                removidos.append(row['hash'])
+            except Exception as e:
+                print(f"[BLOB] Erro ao remover blob {row['hash']}: {e}")
+        if removidos:
+            cur.execute('DELETE FROM blob_referencias WHERE hash = ANY(%s)', (removidos,))
+        cur.close()
+    return len(removidos)
+
+def arquivo_inline(row):
+    """Bytes do PDF guardados na própria linha (colunas legadas), ou None"""
+    if row.get('arquivo_bytes') is not None:
+        return bytes(row['arquivo_bytes'])
+    if row.get('arquivo_base64'):
+        return base64.b64decode(row['arquivo_base64'])
+    return None
+
+def abrir_arquivo(row):
+    """Arquivo aberto (leitura binária) com o PDF de uma linha de documentos, ou None.
+
+    Com o backend local é o próprio arquivo do blob; nos demais o conteúdo é
+    copiado em partes para um temporário (em memória até ARQUIVO_SPOOL_LIMITE).
+    Quem chama fecha o arquivo.
+    """
+    import tempfile
+    from io import BytesIO
+    dados = arquivo_inline(row)
+    if dados is not None:
+        return BytesIO(dados)
+    if not row.get('arquivo_hash'):
+        return None
+    store = get_blob_store()
+    caminho = store.caminho_local(row['arquivo_hash'])
+    if caminho:
+        return open(caminho, 'rb')
+    arquivo = tempfile.SpooledTemporaryFile(max_size=ARQUIVO_SPOOL_LIMITE)
+    for parte in store.ler_partes(row['arquivo_hash']):
+        arquivo.write(parte)
+    if not arquivo.tell():
+        arquivo.close()
+        return None
+    arquivo.seek(0)
+    return arquivo
+
+def resposta_blob(hash_hex, tamanho=None):
+    """Resposta HTTP com um PDF do blob store, ou None se o blob não existir.
+
+    Com o backend local o arquivo é enviado direto do disco; nos demais vai em
+    partes de BLOB_PARTE_TAMANHO, sem o arquivo inteiro na memória do worker.
+    """
+    from flask import send_file
+    store = get_blob_store()
+    caminho = store.caminho_local(hash_hex)
+    if caminho:
+        return send_file(caminho, mimetype='application/pdf')
+    if not store.existe(hash_hex):
+        return None
+    # Sem stream_with_context: as partes não dependem da requisição, e um 304
+    # (make_conditional) descarta o gerador sem nunca iniciá-lo
+    resposta = Response(store.ler_partes(hash_hex), mimetype='application/pdf')
+    if tamanho is not None:
+        resposta.content_length = tamanho
+    return resposta
+
+def resposta_pdf(row, content_disposition):
+    """Resposta HTTP com o PDF de uma linha de documentos, ou None se não houver arquivo.
+
+    PDFs do blob store são enviados em partes (ver resposta_blob).
+    """
+    pdf_data = arquivo_inline(row)
+    if pdf_data:
+        resposta = Response(pdf_data, mimetype='application/pdf')
+    elif row.get('arquivo_hash'):
+        resposta = resposta_blob(row['arquivo_hash'])
+        if resposta is None:
+            return None
+    else:
+        return None
+    resposta.headers['Content-Disposition'] = content_disposition
+    return resposta
+
+def migrar_arquivos_para_blobs(tamanho_lote=20):
+    """Move PDFs guardados na linha (base64 legado ou arquivo_bytes) para o blob store.
+
+    Migração online: cada lote é uma transação curta que ignora linhas travadas
+    (SKIP LOCKED), então pode rodar com o servidor no ar e ser interrompida e
+    retomada a qualquer momento. O blob é gravado antes de a linha ser limpa.
+    Retorna (migrados, falhas).
+    """
+    migrados = 0
+    falhas = 0
+    ultimo_id = 0
+    
+    while True:
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute('''
+                SELECT id, doc_id, arquivo_bytes, arquivo_base64, arquivo_hash FROM documentos
+                WHERE (arquivo_bytes IS NOT NULL OR arquivo_base64 IS NOT NULL) AND id > %s
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ''', (ultimo_id, tamanho_lote), binary=True)
+            rows = cur.fetchall()
+            if not rows:
+                break
+            ultimo_id = rows[-1]['id']
+            
+            for row in rows:
+                try:
+                    dados = arquivo_inline(row)
+                    hash_hex = hashlib.sha256(dados).hexdigest()
+                    # O hash é a prova de integridade do documento: nunca reescrever um divergente
+                    if row['arquivo_hash'] and row['arquivo_hash'] != hash_hex:
+                        raise ValueError(f"hash do conteúdo ({hash_hex}) diverge de arquivo_hash")
+                    referenciar_blob(cur, dados)
+                    cur.execute('''
+                        UPDATE documentos SET arquivo_bytes = NULL, arquivo_base64 = NULL, arquivo_hash = %s
+                        WHERE id = %s
+                    ''', (hash_hex, row['id']))
+                    migrados += 1
+                except Exception as e:
+                    falhas += 1
+                    print(f"[MIGRACAO] Documento {row['doc_id']} não migrado: {e}")
+            cur.close()
+        print(f"[MIGRACAO] {migrados} documento(s) migrado(s) para o blob store ({get_blob_store().nome})")
+    
+    return migrados, falhas
+
+@app.cli.command('migrar-arquivos')
+def comando_migrar_arquivos():
+    """Move PDFs guardados nas linhas de documentos para o blob store (flask --app app migrar-arquivos)"""
+    migrados, falhas = migrar_arquivos_para_blobs()
+    print(f"Concluído: {migrados} migrado(s), {falhas} falha(s)")
 
 # ==================== FUNÇÕES AUXILIARES ====================
 
@@ -496,41 +1136,680 @@ def validar_cpf(cpf):
     
     return True, "CPF válido"
 
-def registrar_auditoria(doc_id, acao, usuario=None, ip=None, user_agent=None, dados_adicionais=None):
+# ==================== AUDITORIA ====================
+# Cada documento (ou lote) tem a sua própria cadeia de hashes em log_auditoria:
+# registros de documentos diferentes são encadeados em paralelo, travando só a
+# linha da sua cadeia em cadeias_auditoria. De tempos em tempos um registro
+# ANCORA_AUDITORIA na cadeia global 'ANCORA' incorpora o último hash de cada
+# cadeia alterada, de modo que qualquer adulteração também quebra a cadeia global.
+
+AUDITORIA_HASH_VERSAO = 2
+AUDITORIA_HASH_INICIAL = '0' * 64
+AUDITORIA_CADEIA_ANCORA = 'ANCORA'
+AUDITORIA_CADEIA_SISTEMA = 'SISTEMA'  # registros sem doc_id
+AUDITORIA_ANCORA_INTERVALO = int(os.environ.get('AUDITORIA_ANCORA_INTERVALO', 300))  # segundos
+AUDITORIA_ANCORA_LOCK_ID = 7351002  # pg_try_advisory_xact_lock: uma âncora por vez
+
+_ultima_ancora = 0.0
+_ultima_ancora_lock = threading.Lock()
+
+def cadeia_auditoria(doc_id):
+    """Cadeia de um registro: o próprio doc_id (ou lote_id)"""
+    return doc_id or AUDITORIA_CADEIA_SISTEMA
+
+def hash_auditoria(registro):
+    """Hash (versão 2) de um registro: SHA-256 do JSON canônico de todos os campos"""
+    canonico = json.dumps({
+        'v': AUDITORIA_HASH_VERSAO,
+        'cadeia': registro['cadeia'],
+        'seq': registro['seq'],
+        'doc_id': registro['doc_id'],
+        'acao': registro['acao'],
+        'usuario': registro['usuario'],
+        'ip': registro['ip'],
+        'user_agent': registro['user_agent'],
+        'dados': registro['dados_adicionais'] or None,
+        'carimbo': registro['carimbo'],
+        'hash_anterior': registro['hash_anterior'],
+    }, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonico.encode()).hexdigest()
+
+def anexar_auditoria_lote(cur, registros):
+    """Encadeia vários registros de auditoria dentro da transação de cur.
+
+    registros: dicts com doc_id, acao e, opcionais, usuario, ip, user_agent,
+    dados_adicionais, cadeia e arquivo_hash (grava também a evidência do hash
+    em evidencias_hash). As cabeças das cadeias envolvidas são travadas
+    de uma vez (em ordem, evitando deadlock), os hashes são calculados em
+    memória e registros e cabeças são gravados em lote. Retorna os registros
+    completos (seq, carimbo, hashes), na ordem recebida.
+    """
+    if not registros:
+        return []
+    
+    cadeias = sorted({r.get('cadeia') or cadeia_auditoria(r['doc_id']) for r in registros})
+    # Cria as cadeias novas; em ambos os casos trava e retorna o último elo
+    cur.execute('''
+        INSERT INTO cadeias_auditoria (cadeia, seq, hash_ultimo)
+        SELECT c, 0, %s FROM unnest(%s::text[]) AS c ORDER BY c
+        ON CONFLICT (cadeia) DO UPDATE SET cadeia = EXCLUDED.cadeia
+        RETURNING cadeia, seq, hash_ultimo
+    ''', (AUDITORIA_HASH_INICIAL, cadeias))
+    cabecas = {row['cadeia']: (row['seq'], row['hash_ultimo']) for row in cur.fetchall()}
+    
+    carimbo = datetime.now(BRT).isoformat()
+    completos = []
+    for r in registros:
+        cadeia = r.get('cadeia') or cadeia_auditoria(r['doc_id'])
+        seq, hash_anterior = cabecas[cadeia]
+        registro = {
+            'cadeia': cadeia,
+            'seq': seq + 1,
+            'doc_id': r['doc_id'],
+            'acao': r['acao'],
+            'usuario': r.get('usuario'),
+            'ip': r.get('ip'),
+            'user_agent': r.get('user_agent'),
+            'dados_adicionais': r.get('dados_adicionais') or None,
+            'carimbo': carimbo,
+            'hash_anterior': hash_anterior,
+            'arquivo_hash': r.get('arquivo_hash'),
+        }
+        registro['hash_registro'] = hash_auditoria(registro)
+        cabecas[cadeia] = (registro['seq'], registro['hash_registro'])
+        completos.append(registro)
+    
+    cur.executemany('''
+        INSERT INTO log_auditoria (doc_id, acao, usuario, ip, user_agent, dados_adicionais, hash_anterior, hash_registro,
+                                   cadeia, seq, hash_versao, carimbo)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ''', [(r['doc_id'], r['acao'], r['usuario'], r['ip'], r['user_agent'],
+           json.dumps(r['dados_adicionais']) if r['dados_adicionais'] else None,
+           r['hash_anterior'], r['hash_registro'], r['cadeia'], r['seq'], AUDITORIA_HASH_VERSAO, r['carimbo'])
+          for r in completos])
+    cur.execute('''
+        UPDATE cadeias_auditoria c SET seq = n.seq, hash_ultimo = n.hash, atualizado_em = CURRENT_TIMESTAMP
+        FROM unnest(%s::text[], %s::bigint[], %s::text[]) AS n(cadeia, seq, hash)
+        WHERE c.cadeia = n.cadeia
+    ''', (list(cabecas), [c[0] for c in cabecas.values()], [c[1] for c in cabecas.values()]))
+    
+    # Evidência por hash do PDF (verificação permanente por índice)
+    evidencias = [r for r in completos if r['arquivo_hash'] and r['doc_id']]
+    if evidencias:
+        cur.execute('''
+            INSERT INTO evidencias_hash (arquivo_hash, doc_id, acao, log_id, usuario, ip, dados, criado_em)
+            SELECT e.arquivo_hash, l.doc_id, l.acao, l.id, l.usuario, l.ip, l.dados_adicionais, l.criado_em
+            FROM unnest(%s::text[], %s::text[], %s::bigint[]) AS e(arquivo_hash, cadeia, seq)
+            JOIN log_auditoria l ON l.cadeia = e.cadeia AND l.seq = e.seq
+        ''', ([r['arquivo_hash'] for r in evidencias], [r['cadeia'] for r in evidencias], [r['seq'] for r in evidencias]))
+    return completos
+
+def anexar_auditoria(cur, doc_id, acao, usuario=None, ip=None, user_agent=None, dados_adicionais=None, cadeia=None, arquivo_hash=None):
+    """Encadeia um registro na cadeia do documento, dentro da transação de cur.
+
+    A linha da cadeia em cadeias_auditoria fica travada até o commit, então
+    registros simultâneos do mesmo documento entram em sequência e os de
+    documentos diferentes não esperam uns pelos outros. Retorna o registro.
+    """
+    return anexar_auditoria_lote(cur, [{
+        'doc_id': doc_id, 'acao': acao, 'usuario': usuario, 'ip': ip, 'user_agent': user_agent,
+        'dados_adicionais': dados_adicionais, 'cadeia': cadeia, 'arquivo_hash': arquivo_hash
+    }])[0]
+
+def registrar_auditoria(doc_id, acao, usuario=None, ip=None, user_agent=None, dados_adicionais=None, arquivo_hash=None):
     """Registra ação no log de auditoria com hash encadeado"""
     try:
-        conn = get_db()
+        with get_db() as conn:
+            cur = conn.cursor()
+            anexar_auditoria(cur, doc_id, acao, usuario, ip, user_agent, dados_adicionais, arquivo_hash=arquivo_hash)
+            cur.close()
+        ancorar_auditoria_async()
+        return True
+    except Exception as e:
+        print(f"Erro ao registrar auditoria: {e}")
+        return False
+
+def registrar_auditoria_lote(registros):
+    """Registra vários registros de auditoria numa única transação (ver anexar_auditoria_lote)"""
+    try:
+        with get_db() as conn:
+            cur = conn.cursor()
+            anexar_auditoria_lote(cur, registros)
+            cur.close()
+        ancorar_auditoria_async()
+        return True
+    except Exception as e:
+        print(f"Erro ao registrar auditoria: {e}")
+        return False
+
+def ancorar_auditoria():
+    """Incorpora na cadeia global o último hash de cada cadeia alterada desde a última âncora.
+
+    Retorna o registro da âncora, ou None se não havia nada a ancorar ou se
+    outro processo já está ancorando.
+    """
+    with get_db() as conn:
         cur = conn.cursor()
+        cur.execute('SELECT pg_try_advisory_xact_lock(%s) AS obtido', (AUDITORIA_ANCORA_LOCK_ID,))
+        if not cur.fetchone()['obtido']:
+            return None
         
-        # Buscar hash do último registro para encadeamento
-        cur.execute('SELECT hash_registro FROM log_auditoria ORDER BY id DESC LIMIT 1')
-        row = cur.fetchone()
-        hash_anterior = row['hash_registro'] if row else '0' * 64
+        cur.execute('''
+            SELECT cadeia, seq, hash_ultimo FROM cadeias_auditoria
+            WHERE seq > ancorado_seq AND cadeia <> %s
+            ORDER BY cadeia
+        ''', (AUDITORIA_CADEIA_ANCORA,))
+        cabecas = {row['cadeia']: {'seq': row['seq'], 'hash': row['hash_ultimo']} for row in cur.fetchall()}
+        if not cabecas:
+            return None
+        
+        raiz = hashlib.sha256(json.dumps(cabecas, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+        registro = anexar_auditoria(cur, None, 'ANCORA_AUDITORIA', usuario='SISTEMA',
+                                    dados_adicionais={'raiz': raiz, 'cadeias': cabecas},
+                                    cadeia=AUDITORIA_CADEIA_ANCORA)
+        cur.execute('''
+            UPDATE cadeias_auditoria c SET ancorado_seq = GREATEST(c.ancorado_seq, a.seq)
+            FROM unnest(%s::text[], %s::bigint[]) AS a(cadeia, seq)
+            WHERE c.cadeia = a.cadeia
+        ''', (list(cabecas), [c['seq'] for c in cabecas.values()]))
+        cur.close()
+    print(f"[AUDITORIA] Âncora {registro['seq']}: {len(cabecas)} cadeia(s), raiz {raiz[:16]}")
+    return registro
+
+def ancorar_auditoria_async():
+    """Dispara ancorar_auditoria em segundo plano no máximo uma vez por AUDITORIA_ANCORA_INTERVALO"""
+    global _ultima_ancora
+    with _ultima_ancora_lock:
+        if time.monotonic() - _ultima_ancora < AUDITORIA_ANCORA_INTERVALO:
+            return
+        _ultima_ancora = time.monotonic()
+    
+    def _ancorar():
+        try:
+            ancorar_auditoria()
+        except Exception as e:
+            print(f"[AUDITORIA] Erro ao ancorar: {e}")
+    
+    threading.Thread(target=_ancorar, daemon=True).start()
+
+@app.cli.command('ancorar-auditoria')
+def comando_ancorar_auditoria():
+    """Grava uma âncora da auditoria agora (também é feita automaticamente a cada AUDITORIA_ANCORA_INTERVALO)"""
+    registro = ancorar_auditoria()
+    print(f"Âncora {registro['seq']} gravada" if registro else "Nada a ancorar")
+
+# Verificação incremental: percorre log_auditoria em ordem de id, recalculando
+# os hashes, a partir do último checkpoint válido. Cada execução bem-sucedida
+# grava um checkpoint assinado (HMAC) com o último elo de cada cadeia, e a
+# próxima verifica só o que foi gravado depois dele.
+
+AUDITORIA_CHAVE_CHECKPOINT = os.environ.get('AUDITORIA_CHAVE_CHECKPOINT', '')
+AUDITORIA_VERIFICACAO_LOTE = int(os.environ.get('AUDITORIA_VERIFICACAO_LOTE', 1000))
+# Registros mais recentes que isso ficam para a próxima execução: uma transação
+# ainda aberta pode gravar um id menor depois (e ficaria antes do checkpoint)
+AUDITORIA_VERIFICACAO_MARGEM = int(os.environ.get('AUDITORIA_VERIFICACAO_MARGEM', 60))  # segundos
+AUDITORIA_CADEIA_LEGADO = 'LEGADO'  # registros de antes das cadeias por documento (hash_versao NULL)
+
+def assinatura_checkpoint(ate_id, total_registros, cabecas):
+    """HMAC-SHA256 do conteúdo de um checkpoint"""
+    conteudo = json.dumps({'ate_id': ate_id, 'total_registros': total_registros, 'cabecas': cabecas},
+                          sort_keys=True, separators=(',', ':'))
+    return hmac.new(AUDITORIA_CHAVE_CHECKPOINT.encode(), conteudo.encode(), hashlib.sha256).hexdigest()
+
+def ultimo_checkpoint_valido(cur):
+    """(checkpoint, ids de checkpoints com assinatura inválida mais recentes que ele)"""
+    invalidos = []
+    if not AUDITORIA_CHAVE_CHECKPOINT:
+        return None, invalidos
+    cur.execute('SELECT id, ate_id, total_registros, cabecas, assinatura FROM auditoria_checkpoints ORDER BY id DESC')
+    for cp in cur:
+        esperado = assinatura_checkpoint(cp['ate_id'], cp['total_registros'], cp['cabecas'])
+        if hmac.compare_digest(esperado, cp['assinatura']):
+            return cp, invalidos
+        invalidos.append(cp['id'])
+    return None, invalidos
+
+def conferir_ancora(cur, registro, cabecas):
+    """Motivo da falha de uma âncora (raiz ou elo divergente), ou None se confere"""
+    incluidas = (registro['dados_adicionais'] or {}).get('cadeias', {})
+    raiz = hashlib.sha256(json.dumps(incluidas, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+    if raiz != (registro['dados_adicionais'] or {}).get('raiz'):
+        return 'raiz da âncora não confere com as cadeias incluídas'
+    if AUDITORIA_CADEIA_LEGADO in incluidas and incluidas[AUDITORIA_CADEIA_LEGADO]['hash'] != cabecas.get(AUDITORIA_CADEIA_LEGADO, {}).get('hash'):
+        return 'âncora diverge do último hash da cadeia legada'
+    outras = {c: v for c, v in incluidas.items() if c != AUDITORIA_CADEIA_LEGADO}
+    if not outras:
+        return None
+    cur.execute('''
+        SELECT l.cadeia, l.seq, l.hash_registro
+        FROM log_auditoria l JOIN unnest(%s::text[], %s::bigint[]) AS a(cadeia, seq)
+          ON l.cadeia = a.cadeia AND l.seq = a.seq
+        WHERE l.id < %s
+    ''', (list(outras), [v['seq'] for v in outras.values()], registro['id']))
+    gravados = {row['cadeia']: row['hash_registro'] for row in cur.fetchall()}
+    for cadeia, elo in outras.items():
+        if gravados.get(cadeia) != elo['hash']:
+            return f"âncora diverge da cadeia {cadeia} no elo {elo['seq']}"
+    return None
+
+def verificar_auditoria(completo=False):
+    """Verifica as cadeias de log_auditoria e grava um checkpoint se estiverem íntegras.
+
+    Registros versão 2 têm o hash recalculado e o encadeamento (seq e
+    hash_anterior) conferido na sua cadeia; âncoras também têm a raiz e os elos
+    incluídos conferidos. Registros legados só podem ter o encadeamento
+    conferido (o carimbo usado no hash antigo não era gravado). Para no
+    primeiro elo quebrado e o retorna em 'quebra'.
+    """
+    resultado = {'integra': True, 'verificados': 0, 'quebra': None, 'checkpoint': None,
+                 'checkpoints_invalidos': [], 'desde_id': 0}
+    with get_db() as conn:
+        cur = conn.cursor()
+        checkpoint = None
+        if not completo:
+            checkpoint, resultado['checkpoints_invalidos'] = ultimo_checkpoint_valido(cur)
+        cabecas = dict(checkpoint['cabecas']) if checkpoint else {}
+        ate_id = checkpoint['ate_id'] if checkpoint else 0
+        total = checkpoint['total_registros'] if checkpoint else 0
+        resultado['desde_id'] = ate_id
+        
+        leitura = conn.cursor(name='verificar_auditoria')
+        leitura.itersize = AUDITORIA_VERIFICACAO_LOTE
+        leitura.execute('''
+            SELECT id, doc_id, acao, usuario, ip, user_agent, dados_adicionais, hash_anterior, hash_registro,
+                   cadeia, seq, hash_versao, carimbo, criado_em < now() - make_interval(secs => %s) AS assentado
+            FROM log_auditoria WHERE id > %s ORDER BY id
+        ''', (AUDITORIA_VERIFICACAO_MARGEM, ate_id))
+        
+        for row in leitura:  # buscado do servidor em lotes de itersize
+            if not row['assentado']:
+                break
+            legado = row['hash_versao'] is None
+            cadeia = AUDITORIA_CADEIA_LEGADO if legado else row['cadeia']
+            anterior = cabecas.get(cadeia, {'seq': 0, 'hash': AUDITORIA_HASH_INICIAL})
+            motivo = None
+            if row['hash_anterior'] != anterior['hash']:
+                motivo = 'hash_anterior não confere com o registro anterior da cadeia'
+            elif not legado and row['seq'] != anterior['seq'] + 1:
+                motivo = f"seq {row['seq']} fora de ordem (esperado {anterior['seq'] + 1})"
+            elif not legado and hash_auditoria(row) != row['hash_registro']:
+                motivo = 'hash_registro não confere com o conteúdo do registro'
+            elif cadeia == AUDITORIA_CADEIA_ANCORA:
+                motivo = conferir_ancora(cur, row, cabecas)
+            if motivo:
+                resultado['quebra'] = {'id': row['id'], 'cadeia': cadeia, 'seq': row['seq'],
+                                       'acao': row['acao'], 'doc_id': row['doc_id'], 'motivo': motivo}
+                break
+            cabecas[cadeia] = {'seq': anterior['seq'] + 1, 'hash': row['hash_registro']}
+            ate_id = row['id']
+            total += 1
+            resultado['verificados'] += 1
+        leitura.close()
+        
+        resultado['integra'] = resultado['quebra'] is None
+        resultado['ate_id'] = ate_id
+        resultado['total_registros'] = total
+        resultado['cadeias'] = len(cabecas)
+        
+        if resultado['integra'] and AUDITORIA_CHAVE_CHECKPOINT and (resultado['verificados'] or not checkpoint):
+            cur.execute('''
+                INSERT INTO auditoria_checkpoints (ate_id, total_registros, cabecas, assinatura)
+                VALUES (%s, %s, %s, %s) RETURNING id
+            ''', (ate_id, total, json.dumps(cabecas), assinatura_checkpoint(ate_id, total, cabecas)))
+            resultado['checkpoint'] = cur.fetchone()['id']
+        elif checkpoint:
+            resultado['checkpoint'] = checkpoint['id']
+        cur.close()
+    
+    if resultado['quebra']:
+        print(f"[AUDITORIA] Cadeia quebrada no registro {resultado['quebra']['id']}: {resultado['quebra']['motivo']}")
+    return resultado
+
+@app.cli.command('verificar-auditoria')
+@click.option('--completo', is_flag=True, help='Ignora os checkpoints e verifica o log inteiro')
+def comando_verificar_auditoria(completo):
+    """Verifica as cadeias de hash do log de auditoria (código 1 se alguma estiver quebrada)"""
+    import sys
+    if not AUDITORIA_CHAVE_CHECKPOINT:
+        print("AUDITORIA_CHAVE_CHECKPOINT não definida: checkpoints desativados, verificando o log inteiro")
+    resultado = verificar_auditoria(completo)
+    print(json.dumps(resultado, indent=2, ensure_ascii=False, default=str))
+    if not resultado['integra']:
+        sys.exit(1)
+
+@app.route('/api/admin/verificar_auditoria', methods=['POST'])
+def admin_verificar_auditoria():
+    """Verifica as cadeias de auditoria (incremental a partir do último checkpoint)"""
+    try:
+        data = request.json or {}
+        chave_admin = os.environ.get('ADMIN_CHAVE', '')
         
-        # Criar dados para hash
-        timestamp = datetime.now(BRT).isoformat()
-        dados_hash = f"{doc_id}|{acao}|{usuario}|{ip}|{timestamp}|{hash_anterior}"
-        hash_registro = hashlib.sha256(dados_hash.encode()).hexdigest()
+        # Desativado enquanto ADMIN_CHAVE não estiver configurada
+        if not chave_admin or not hmac.compare_digest(str(data.get('chave', '')), chave_admin):
+            return jsonify({'erro': 'Chave de administração inválida'}), 403
         
-        # Inserir registro
-        cur.execute('''
-            INSERT INTO log_auditoria (doc_id, acao, usuario, ip, user_agent, dados_adicionais, hash_anterior, hash_registro)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        ''', (doc_id, acao, usuario, ip, user_agent, json.dumps(dados_adicionais) if dados_adicionais else None, hash_anterior, hash_registro))
+        resultado = verificar_auditoria(completo=bool(data.get('completo')))
+        return jsonify(resultado), (200 if resultado['integra'] else 409)
         
-        conn.commit()
-        cur.close()
-        conn.close()
-        return True
     except Exception as e:
-        print(f"Erro ao registrar auditoria: {e}")
-        return False
+        return jsonify({'erro': str(e)}), 500
+
+# ==================== IMAGENS DOS SIGNATÁRIOS ====================
+# Assinatura manuscrita e selfie ficam em signatarios_imagens (bytea), fora
+# da linha do signatário: consultas de nome/status/dossiê não arrastam os
+# data URLs. As colunas assinatura_base64/selfie_base64 só têm conteúdo em
+# assinaturas gravadas por uma versão anterior e são lidas como alternativa
+# até flask --app app migrar-imagens movê-las para signatarios_imagens.
+#
+# Junto com cada original é gravada, na assinatura, a versão pronta para o
+# PDF (tipo '<tipo>_pdf'): selfie JPEG 195x260 e assinatura PNG em fundo
+# branco. O PDF assinado só embute esses bytes.
+
+TIPOS_IMAGEM_SIGNATARIO = ('assinatura', 'selfie')
+
+SELFIE_PDF_TAMANHO = (195, 260)  # 3:4 retrato
+ASSINATURA_PDF_TAMANHO_MAXIMO = (437, 138)
+
+def tipo_imagem_pdf(tipo):
+    """Tipo da versão pronta para o PDF de uma imagem ('selfie' -> 'selfie_pdf')"""
+    return f'{tipo}_pdf'
+
+def decodificar_data_url(valor):
+    """Retorna (mime, bytes) de um data URL (data:image/png;base64,...) ou base64 puro"""
+    mime = None
+    if valor.startswith('data:') and ',' in valor:
+        cabecalho, valor = valor.split(',', 1)
+        mime = cabecalho[5:].split(';')[0] or None
+    return mime, base64.b64decode(valor)
+
+def imagem_rgb_fundo_branco(img):
+    """Converte para RGB; transparência (PNG do canvas de assinatura) vira fundo branco"""
+    from PIL import Image
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[3])
+        return background
+    if img.mode != 'RGB':
+        return img.convert('RGB')
+    return img
+
+def preparar_selfie(conteudo):
+    """Selfie pronta para o PDF: JPEG RGB 195x260 recortado ao centro"""
+    from io import BytesIO
+    from PIL import Image
+    
+    target_width, target_height = SELFIE_PDF_TAMANHO
+    img = Image.open(BytesIO(conteudo))
+    # Foto de câmera (vários megapixels): o decodificador JPEG já entrega a
+    # imagem reduzida (1/2, 1/4, 1/8), no menor fator que cobre o tamanho final
+    if img.format == 'JPEG':
+        img.draft('RGB', (target_width, target_height))
+    img = imagem_rgb_fundo_branco(img)
+    
+    # Redimensionar mantendo proporção e cortando o excedente
+    img_ratio = img.width / img.height
+    if img_ratio > target_width / target_height:
+        new_width, new_height = int(target_height * img_ratio), target_height
+    else:
+        new_width, new_height = target_width, int(target_width / img_ratio)
+    img = img.resize((new_width, new_height), Image.LANCZOS)
+    left = (new_width - target_width) // 2
+    top = (new_height - target_height) // 2
+    img = img.crop((left, top, left + target_width, top + target_height))
+    
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=95)
+    return buffer.getvalue()
+
+def preparar_assinatura(conteudo):
+    """Assinatura pronta para o PDF: PNG RGB em fundo branco, no máximo 437x138"""
+    from io import BytesIO
+    from PIL import Image
+    
+    img = imagem_rgb_fundo_branco(Image.open(BytesIO(conteudo)))
+    img.thumbnail(ASSINATURA_PDF_TAMANHO_MAXIMO, Image.LANCZOS)
+    
+    buffer = BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+PREPARADORES_IMAGEM_PDF = {
+    'selfie': ('image/jpeg', preparar_selfie),
+    'assinatura': ('image/png', preparar_assinatura),
+}
+
+def preparar_imagem_pdf(tipo, conteudo):
+    """(mime, bytes) da versão pronta para o PDF, ou None se a imagem não puder ser lida"""
+    mime, preparar = PREPARADORES_IMAGEM_PDF[tipo]
+    try:
+        return mime, preparar(conteudo)
+    except Exception as e:
+        print(f"[IMAGENS] {tipo} não preparada para o PDF: {e}")
+        return None
+
+# Decodificar, converter, redimensionar e recodificar acontecem no Pillow,
+# que solta o GIL: várias imagens são preparadas em paralelo, em threads
+IMAGENS_PREPARACAO_THREADS = int(os.environ.get('IMAGENS_PREPARACAO_THREADS', min(4, os.cpu_count() or 1)))
+
+def preparar_imagens_pdf(itens):
+    """Prepara várias imagens ([(tipo, conteudo)]) em paralelo; resultados na mesma ordem"""
+    itens = list(itens)
+    if len(itens) <= 1 or IMAGENS_PREPARACAO_THREADS <= 1:
+        return [preparar_imagem_pdf(tipo, conteudo) for tipo, conteudo in itens]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(IMAGENS_PREPARACAO_THREADS, len(itens)),
+                                               thread_name_prefix='imagens-pdf') as executor:
+        return list(executor.map(lambda item: preparar_imagem_pdf(*item), itens))
+
+def preparar_imagens_signatario(imagens):
+    """Linhas (tipo, mime, conteúdo) de signatarios_imagens para as imagens recebidas ({tipo: data URL}).
+
+    Os originais e as versões para o PDF, preparadas em paralelo. Só CPU
+    (decodificar, redimensionar, recodificar): roda antes da transação que
+    trava o signatário, que só grava as linhas (gravar_imagens_signatario).
+    """
+    linhas = []
+    a_preparar = []
+    for tipo, valor in imagens.items():
+        if not valor:
+            continue
+        try:
+            mime, conteudo = decodificar_data_url(valor)
+        except ValueError:
+            # Fora do formato esperado: guardado como recebido
+            mime, conteudo = 'text/plain', valor.encode()
+        linhas.append((tipo, mime, conteudo))
+        if mime != 'text/plain':
+            a_preparar.append((tipo, conteudo))
+    
+    # Selfie e assinatura preparadas ao mesmo tempo
+    for (tipo, _), preparada in zip(a_preparar, preparar_imagens_pdf(a_preparar)):
+        if preparada:
+            linhas.append((tipo_imagem_pdf(tipo), preparada[0], preparada[1]))
+    return linhas
+
+def gravar_imagens_signatario(cur, signatario_id, linhas):
+    """Grava as linhas de preparar_imagens_signatario na transação de cur"""
+    if linhas:
+        cur.executemany('''
+            INSERT INTO signatarios_imagens (signatario_id, tipo, mime, conteudo, tamanho)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (signatario_id, tipo) DO UPDATE
+            SET mime = EXCLUDED.mime, conteudo = EXCLUDED.conteudo, tamanho = EXCLUDED.tamanho
+        ''', [(signatario_id, tipo, mime, conteudo, len(conteudo)) for tipo, mime, conteudo in linhas])
+
+def carregar_imagens_signatarios(cur, signatario_ids, tipos=TIPOS_IMAGEM_SIGNATARIO):
+    """{signatario_id: {tipo: bytes}} com as imagens originais dos signatários informados"""
+    imagens = {}
+    if not signatario_ids:
+        return imagens
+    cur.execute('''
+        SELECT signatario_id, tipo, conteudo FROM signatarios_imagens
+        WHERE signatario_id = ANY(%s) AND tipo = ANY(%s)
+    ''', (list(signatario_ids), list(tipos)), binary=True)
+    for row in cur.fetchall():
+        imagens.setdefault(row['signatario_id'], {})[row['tipo']] = bytes(row['conteudo'])
+    
+    faltando = [i for i in signatario_ids if i not in imagens]
+    if faltando:
+        cur.execute('''
+            SELECT id, assinatura_base64, selfie_base64 FROM signatarios
+            WHERE id = ANY(%s) AND (assinatura_base64 IS NOT NULL OR selfie_base64 IS NOT NULL)
+        ''', (faltando,))
+        for row in cur.fetchall():
+            for tipo in tipos:
+                valor = row[f'{tipo}_base64']
+                if valor:
+                    try:
+                        imagens.setdefault(row['id'], {})[tipo] = decodificar_data_url(valor)[1]
+                    except ValueError:
+                        pass
+    return imagens
+
+def carregar_imagens_pdf(cur, signatario_ids):
+    """{signatario_id: {tipo: bytes prontos para o PDF}} ('selfie' JPEG, 'assinatura' PNG).
+
+    Imagens gravadas antes da preparação na assinatura são preparadas aqui,
+    a partir do original (flask --app app preparar-imagens grava essas versões).
+    """
+    imagens = {}
+    if not signatario_ids:
+        return imagens
+    tipos_pdf = {tipo_imagem_pdf(tipo): tipo for tipo in TIPOS_IMAGEM_SIGNATARIO}
+    cur.execute('''
+        SELECT signatario_id, tipo, conteudo FROM signatarios_imagens
+        WHERE signatario_id = ANY(%s) AND tipo = ANY(%s)
+    ''', (list(signatario_ids), list(tipos_pdf)), binary=True)
+    for row in cur.fetchall():
+        imagens.setdefault(row['signatario_id'], {})[tipos_pdf[row['tipo']]] = bytes(row['conteudo'])
+    
+    incompletos = [i for i in signatario_ids if len(imagens.get(i, {})) < len(TIPOS_IMAGEM_SIGNATARIO)]
+    pendentes = [(signatario_id, tipo, conteudo)
+                 for signatario_id, originais in carregar_imagens_signatarios(cur, incompletos).items()
+                 for tipo, conteudo in originais.items()
+                 if tipo not in imagens.get(signatario_id, {})]
+    preparadas = preparar_imagens_pdf((tipo, conteudo) for _, tipo, conteudo in pendentes)
+    for (signatario_id, tipo, _), preparada in zip(pendentes, preparadas):
+        if preparada:
+            imagens.setdefault(signatario_id, {})[tipo] = preparada[1]
+    return imagens
+
+def preparar_imagens_pendentes(tamanho_lote=50):
+    """Grava a versão para o PDF das imagens que ainda não têm uma.
+
+    Cada lote é uma transação curta; pode rodar com o servidor no ar e ser
+    interrompida e retomada. Retorna (preparadas, falhas).
+    """
+    preparadas = 0
+    falhas = 0
+    ultimo = (0, '')
+    
+    while True:
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute('''
+                SELECT i.signatario_id, i.tipo, i.conteudo FROM signatarios_imagens i
+                WHERE i.tipo = ANY(%s) AND i.mime IS DISTINCT FROM 'text/plain'
+                  AND (i.signatario_id, i.tipo) > (%s, %s)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM signatarios_imagens p
+                      WHERE p.signatario_id = i.signatario_id AND p.tipo = i.tipo || '_pdf'
+                  )
+                ORDER BY i.signatario_id, i.tipo
+                LIMIT %s
+            ''', (list(TIPOS_IMAGEM_SIGNATARIO), ultimo[0], ultimo[1], tamanho_lote), binary=True)
+            rows = cur.fetchall()
+            if not rows:
+                break
+            ultimo = (rows[-1]['signatario_id'], rows[-1]['tipo'])
+            
+            preparadas_lote = preparar_imagens_pdf((row['tipo'], bytes(row['conteudo'])) for row in rows)
+            for row, preparada in zip(rows, preparadas_lote):
+                if not preparada:
+                    falhas += 1
+                    continue
+                cur.execute('''
+                    INSERT INTO signatarios_imagens (signatario_id, tipo, mime, conteudo, tamanho)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (signatario_id, tipo) DO NOTHING
+                ''', (row['signatario_id'], tipo_imagem_pdf(row['tipo']), preparada[0], preparada[1], len(preparada[1])))
+                preparadas += 1
+            cur.close()
+        print(f"[IMAGENS] {preparadas} imagem(ns) preparada(s) para o PDF")
+    
+    return preparadas, falhas
+
+@app.cli.command('preparar-imagens')
+def comando_preparar_imagens():
+    """Gera as versões para o PDF das selfies/assinaturas antigas (flask --app app preparar-imagens)"""
+    preparadas, falhas = preparar_imagens_pendentes()
+    print(f"Concluído: {preparadas} preparada(s), {falhas} falha(s)")
 
-# Inicializar banco ao iniciar
-try:
-    init_db()
-except:
-    pass
+def migrar_imagens_legadas(tamanho_lote=50):
+    """Move as imagens de signatarios.assinatura_base64/selfie_base64 para signatarios_imagens.
+
+    Online e retomável, como migrar_arquivos_para_blobs: cada lote trava os
+    signatários que move (SKIP LOCKED), grava as imagens em binário e limpa
+    as colunas antigas no mesmo commit. Conteúdo fora do formato data URL é
+    guardado como texto. Retorna o número de signatários migrados.
+    """
+    migrados = 0
+    ultimo = 0
+    
+    while True:
+        with get_db() as conn:
+            cur = conn.cursor()
+            cur.execute('''
+                SELECT id, assinatura_base64, selfie_base64 FROM signatarios
+                WHERE id > %s AND (assinatura_base64 IS NOT NULL OR selfie_base64 IS NOT NULL)
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ''', (ultimo, tamanho_lote))
+            rows = cur.fetchall()
+            if not rows:
+                break
+            ultimo = rows[-1]['id']
+            
+            linhas = []
+            for row in rows:
+                for tipo in TIPOS_IMAGEM_SIGNATARIO:
+                    valor = row[f'{tipo}_base64']
+                    if not valor:
+                        continue
+                    try:
+                        mime, conteudo = decodificar_data_url(valor)
+                    except ValueError:
+                        mime, conteudo = 'text/plain', valor.encode()
+                    linhas.append((row['id'], tipo, mime, conteudo, len(conteudo)))
+            if linhas:
+                cur.executemany('''
+                    INSERT INTO signatarios_imagens (signatario_id, tipo, mime, conteudo, tamanho)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (signatario_id, tipo) DO NOTHING
+                ''', linhas)
+            cur.execute('''
+                UPDATE signatarios SET assinatura_base64 = NULL, selfie_base64 = NULL
+                WHERE id = ANY(%s)
+            ''', ([row['id'] for row in rows],))
+            migrados += len(rows)
+            cur.close()
+        print(f"[IMAGENS] {migrados} signatário(s) com imagens migradas")
+    
+    return migrados
+
+@app.cli.command('migrar-imagens')
+def comando_migrar_imagens():
+    """Move selfies/assinaturas das colunas antigas de signatarios para signatarios_imagens"""
+    migrados = migrar_imagens_legadas()
+    print(f"Concluído: {migrados} signatário(s)")
+
+def prefixo_imagem(mime, inicio):
+    """Primeiros 50 caracteres do data URL original (usado no dossiê)"""
+    if mime == 'text/plain':
+        return inicio.decode('utf-8', 'replace')[:50]
+    prefixo = f"data:{mime};base64," if mime else ''
+    return (prefixo + base64.b64encode(inicio).decode())[:50]
 
 # ==================== PÁGINA DE ASSINATURA ====================
 
@@ -1497,13 +2776,33 @@ def index():
 @app.route('/health')
 def health():
     """Health check"""
-    return jsonify({'status': 'ok', 'timestamp': agora_brasil().isoformat()})
+    resposta = {'status': 'ok', 'timestamp': agora_brasil().isoformat()}
+    # Estatísticas do pool deste worker (espera por conexão, conexões em uso)
+    stats_pool = estatisticas_pool()
+    if stats_pool:
+        resposta['db_pool'] = stats_pool
+    return jsonify(resposta)
 
 @app.route('/assinar/<token>')
 def pagina_assinatura(token):
     """Página de assinatura"""
     return render_template_string(PAGINA_ASSINATURA, token=token)
 
+# Signatário pelo token do link (token tem índice único)
+SQL_SIGNATARIO_POR_TOKEN = '''
+    SELECT s.nome, s.email, s.assinado, s.data_assinatura, s.lote_id,
+           d.titulo, d.arquivo_nome, d.doc_id
+    FROM signatarios s
+    JOIN documentos d ON s.doc_id = d.doc_id
+    WHERE s.token = %s
+'''
+
+SQL_DOCUMENTOS_DO_LOTE = '''
+    SELECT doc_id, titulo, arquivo_nome
+    FROM documentos WHERE lote_id = %s
+    ORDER BY id
+'''
+
 @app.route('/api/documento/<token>')
 def get_documento(token):
     """Retorna informações do documento (ou lote de documentos)"""
@@ -1512,12 +2811,7 @@ def get_documento(token):
         cur = conn.cursor()
         
         # Buscar signatário pelo token
-        cur.execute('''
-            SELECT s.*, d.titulo, d.arquivo_nome, d.doc_id
-            FROM signatarios s
-            JOIN documentos d ON s.doc_id = d.doc_id
-            WHERE s.token = %s
-        ''', (token,))
+        cur.execute(SQL_SIGNATARIO_POR_TOKEN, (token,))
         
         row = cur.fetchone()
         
@@ -1531,11 +2825,7 @@ def get_documento(token):
         
         if lote_id:
             # É um lote - buscar todos os documentos do lote
-            cur.execute('''
-                SELECT doc_id, titulo, arquivo_nome
-                FROM documentos WHERE lote_id = %s
-                ORDER BY id
-            ''', (lote_id,))
+            cur.execute(SQL_DOCUMENTOS_DO_LOTE, (lote_id,))
             docs_lote = cur.fetchall()
             
             cur.close()
@@ -1588,27 +2878,23 @@ def get_pdf(token):
         conn = get_db()
         cur = conn.cursor()
         
+        # binary=True: bytea trafega em binário (em texto viria em hex, o dobro do tamanho)
         cur.execute('''
-            SELECT d.arquivo_base64, d.arquivo_nome
+            SELECT d.arquivo_bytes, d.arquivo_base64, d.arquivo_hash, d.arquivo_nome
             FROM signatarios s
             JOIN documentos d ON s.doc_id = d.doc_id
             WHERE s.token = %s
-        ''', (token,))
+        ''', (token,), binary=True)
         
         row = cur.fetchone()
         cur.close()
         conn.close()
         
-        if not row or not row['arquivo_base64']:
+        resposta = resposta_pdf(row, f'inline; filename="{row["arquivo_nome"]}"') if row else None
+        if not resposta:
             return 'Documento não encontrado', 404
         
-        pdf_data = base64.b64decode(row['arquivo_base64'])
-        
-        return Response(
-            pdf_data,
-            mimetype='application/pdf',
-            headers={'Content-Disposition': f'inline; filename="{row["arquivo_nome"]}"'}
-        )
+        return resposta
         
     except Exception as e:
         return f'Erro: {str(e)}', 500
@@ -1620,28 +2906,23 @@ def download_documento_original(token):
         conn = get_db()
         cur = conn.cursor()
         
+        # binary=True: bytea trafega em binário (em texto viria em hex, o dobro do tamanho)
         cur.execute('''
-            SELECT d.arquivo_base64, d.arquivo_nome
+            SELECT d.arquivo_bytes, d.arquivo_base64, d.arquivo_hash, d.arquivo_nome
             FROM signatarios s
             JOIN documentos d ON s.doc_id = d.doc_id
             WHERE s.token = %s
-        ''', (token,))
+        ''', (token,), binary=True)
         
         row = cur.fetchone()
         cur.close()
         conn.close()
         
-        if not row or not row['arquivo_base64']:
+        resposta = resposta_pdf(row, f'inline; filename="{row["arquivo_nome"]}"') if row else None
+        if not resposta:
             return 'Documento não encontrado', 404
         
-        # Decodificar base64 para bytes
-        pdf_data = base64.b64decode(row['arquivo_base64'])
-        
-        return Response(
-            pdf_data,
-            mimetype='application/pdf',
-            headers={'Content-Disposition': f'inline; filename="{row["arquivo_nome"]}"'}
-        )
+        return resposta
         
     except Exception as e:
         return f'Erro: {str(e)}', 500
@@ -1672,6 +2953,106 @@ def download_pdf_assinado_por_token(token):
     except Exception as e:
         return f'Erro: {str(e)}', 500
 
+def atualizar_progresso_assinatura(cur, doc_id, lote_id, momento):
+    """Conta uma assinatura nos contadores do documento (ou do lote e seus documentos).
+
+    Deve rodar na transação que marcou o signatário como assinado. Retorna
+    {total_signatarios, assinados, concluido_em}; concluido_em é preenchido
+    quando a última assinatura pendente é registrada. Documentos sem contadores
+    (total_signatarios = 0) e lotes sem linha em lotes - gravados pela versão
+    anterior enquanto a migração 0005 rodava - são recontados a partir de
+    signatarios (recontar_progresso_assinatura).
+    """
+    if lote_id:
+        # A linha do lote fica travada até o commit: assinaturas simultâneas
+        # do mesmo lote são contadas uma de cada vez. Os documentos do lote
+        # recebem os novos valores na mesma instrução.
+        cur.execute('''
+            WITH l AS (
+                UPDATE lotes
+                SET assinados = assinados + 1,
+                    concluido_em = CASE WHEN total_signatarios > 0 AND assinados + 1 >= total_signatarios
+                                        THEN %s ELSE concluido_em END
+                WHERE lote_id = %s AND total_signatarios > 0
+                RETURNING lote_id, total_signatarios, assinados, concluido_em
+            ), d AS (
+                UPDATE documentos d
+                SET total_signatarios = l.total_signatarios, assinados = l.assinados, concluido_em = l.concluido_em
+                FROM l WHERE d.lote_id = l.lote_id
+            )
+            SELECT total_signatarios, assinados, concluido_em FROM l
+        ''', (momento, lote_id))
+        progresso = cur.fetchone()
+    else:
+        cur.execute('''
+            UPDATE documentos
+            SET assinados = assinados + 1,
+                concluido_em = CASE WHEN total_signatarios > 0 AND assinados + 1 >= total_signatarios
+                                    THEN %s ELSE concluido_em END
+            WHERE doc_id = %s
+            RETURNING total_signatarios, assinados, concluido_em
+        ''', (momento, doc_id))
+        progresso = cur.fetchone()
+    if not progresso or not progresso['total_signatarios']:
+        progresso = recontar_progresso_assinatura(cur, doc_id, lote_id, momento)
+    return progresso
+
+def recontar_progresso_assinatura(cur, doc_id, lote_id, momento):
+    """Recalcula os contadores do documento (ou do lote e seus documentos) a partir de signatarios.
+
+    Para linhas que a versão anterior gravou depois do backfill da migração 0005.
+    A linha do lote é criada se faltar e travada antes da contagem: uma
+    assinatura simultânea do mesmo lote espera o commit e então é contada por
+    cima do valor recontado.
+    """
+    if lote_id:
+        cur.execute('INSERT INTO lotes (lote_id) VALUES (%s) ON CONFLICT (lote_id) DO NOTHING', (lote_id,))
+        cur.execute('SELECT 1 FROM lotes WHERE lote_id = %s FOR UPDATE', (lote_id,))
+        # Instrução nova depois da trava: a contagem vê o que já foi confirmado
+        cur.execute('''
+            WITH s AS (
+                SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE assinado) AS assinados
+                FROM signatarios WHERE lote_id = %s
+            ), l AS (
+                UPDATE lotes lt
+                SET total_signatarios = s.total, assinados = s.assinados,
+                    concluido_em = CASE WHEN s.assinados >= s.total THEN COALESCE(lt.concluido_em, %s) END
+                FROM s WHERE lt.lote_id = %s
+                RETURNING lt.lote_id, lt.total_signatarios, lt.assinados, lt.concluido_em
+            ), d AS (
+                UPDATE documentos d
+                SET total_signatarios = l.total_signatarios, assinados = l.assinados, concluido_em = l.concluido_em
+                FROM l WHERE d.lote_id = l.lote_id
+            )
+            SELECT total_signatarios, assinados, concluido_em FROM l
+        ''', (lote_id, momento, lote_id))
+    else:
+        # A linha do documento já está travada pelo UPDATE de atualizar_progresso_assinatura
+        cur.execute('''
+            UPDATE documentos d
+            SET total_signatarios = s.total, assinados = s.assinados,
+                concluido_em = CASE WHEN s.assinados >= s.total THEN COALESCE(d.concluido_em, %s) END
+            FROM (
+                SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE assinado) AS assinados
+                FROM signatarios WHERE doc_id = %s
+            ) s
+            WHERE d.doc_id = %s
+            RETURNING d.total_signatarios, d.assinados, d.concluido_em
+        ''', (momento, doc_id, doc_id))
+    print(f"[PROGRESSO] Contadores recontados a partir dos signatários: {lote_id or doc_id}")
+    return cur.fetchone()
+
+# Signatário que está assinando, com os documentos (e hashes) do seu lote
+SQL_SIGNATARIO_PARA_ASSINAR = '''
+    SELECT s.id, s.nome, s.cpf, s.assinado, s.doc_id, s.lote_id,
+           (SELECT json_agg(json_build_object('doc_id', d.doc_id, 'titulo', COALESCE(NULLIF(d.titulo, ''), d.arquivo_nome)) ORDER BY d.id)
+            FROM documentos d WHERE s.lote_id IS NOT NULL AND d.lote_id = s.lote_id) AS docs_do_lote,
+           (SELECT json_object_agg(d.doc_id, d.arquivo_hash) FROM documentos d
+            WHERE d.doc_id = s.doc_id OR (s.lote_id IS NOT NULL AND d.lote_id = s.lote_id)) AS hashes
+    FROM signatarios s WHERE s.token = %s
+    FOR UPDATE OF s
+'''
+
 @app.route('/api/assinar', methods=['POST'])
 def assinar():
     """Processa a assinatura com selfie, localização, aceite de termos e auditoria"""
@@ -1689,11 +3070,18 @@ def assinar():
         if not token or not assinatura_base64:
             return jsonify({'erro': 'Dados incompletos'})
         
+        # Imagens decodificadas e preparadas para o PDF antes da transação:
+        # assinaturas simultâneas do mesmo lote esperam só pelos INSERTs
+        imagens = preparar_imagens_signatario({'assinatura': assinatura_base64, 'selfie': selfie_base64})
+        
+        # Todo o evento de assinatura (assinatura, progresso, auditoria) é
+        # uma única transação nesta conexão
         conn = get_db()
         cur = conn.cursor()
         
-        # Buscar signatário e verificar se é um lote
-        cur.execute('SELECT s.*, d.doc_id, s.lote_id FROM signatarios s JOIN documentos d ON s.doc_id = d.doc_id WHERE s.token = %s', (token,))
+        # Buscar signatário (travado até o commit: um segundo envio do mesmo
+        # token espera e então vê assinado) e, se for um lote, os documentos COM TÍTULOS
+        cur.execute(SQL_SIGNATARIO_PARA_ASSINAR, (token,))
         row = cur.fetchone()
         
         if not row:
@@ -1707,12 +3095,7 @@ def assinar():
             return jsonify({'erro': 'Documento já foi assinado'})
         
         lote_id = row.get('lote_id')
-        docs_do_lote = []
-        
-        # Se for um lote, buscar todos os documentos do lote COM TÍTULOS
-        if lote_id:
-            cur.execute('SELECT doc_id, titulo, arquivo_nome FROM documentos WHERE lote_id = %s', (lote_id,))
-            docs_do_lote = [{'doc_id': r['doc_id'], 'titulo': r['titulo'] or r['arquivo_nome']} for r in cur.fetchall()]
+        docs_do_lote = row['docs_do_lote'] or []
         
         # Obter IP real (considerando proxies como Render, Cloudflare, etc.)
         ip_real = request.headers.get('X-Forwarded-For', request.headers.get('X-Real-IP', request.remote_addr))
@@ -1729,86 +3112,77 @@ def assinar():
         timestamp_utc = datetime.now(timezone.utc)
         timestamp_brasil = agora_brasil()
         
-        # Registrar assinatura com todos os dados incluindo aceite
-        cur.execute('''
-            UPDATE signatarios 
-            SET assinado = TRUE, 
-                assinatura_base64 = %s,
-                selfie_base64 = %s,
-                ip_assinatura = %s,
-                data_assinatura = %s,
-                user_agent = %s,
-                latitude = %s,
-                longitude = %s,
-                aceite_termos = %s,
-                data_aceite = %s,
-                hash_aceite = %s
-            WHERE token = %s
-        ''', (
-            assinatura_base64,
-            selfie_base64,
-            ip_real,
-            timestamp_brasil,
-            user_agent,
-            latitude,
-            longitude,
-            aceite_termos,
-            timestamp_brasil,
-            hash_aceite,
-            token
-        ))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        # Registrar no log de auditoria (para todos os docs do lote se aplicável)
+        # Auditoria: um registro por documento (todos os docs do lote se aplicável)
         # docs_do_lote agora é lista de {doc_id, titulo}, precisa extrair doc_id
         docs_para_auditoria = [d['doc_id'] for d in docs_do_lote] if docs_do_lote else [row['doc_id']]
-        for doc_id in docs_para_auditoria:
-            registrar_auditoria(
-                doc_id=doc_id,
-                acao='ASSINATURA_CONCLUIDA',
-                usuario=row['nome'],
-                ip=ip_real,
-                user_agent=user_agent,
-                dados_adicionais={
-                    'signatario_id': row['id'],
-                    'cpf_mascarado': row['cpf'][:3] + '.***.***-' + row['cpf'][-2:] if row['cpf'] else None,
-                    'latitude': float(latitude) if latitude else None,
-                    'longitude': float(longitude) if longitude else None,
-                    'aceite_termos': aceite_termos,
-                    'hash_aceite': hash_aceite,
-                    'timestamp_utc': timestamp_utc.isoformat(),
-                    'timestamp_brasil': timestamp_brasil.isoformat(),
-                    'lote_id': lote_id
-                }
-            )
+        dados_assinatura = {
+            'signatario_id': row['id'],
+            'cpf_mascarado': row['cpf'][:3] + '.***.***-' + row['cpf'][-2:] if row['cpf'] else None,
+            'latitude': float(latitude) if latitude else None,
+            'longitude': float(longitude) if longitude else None,
+            'aceite_termos': aceite_termos,
+            'hash_aceite': hash_aceite,
+            'timestamp_utc': timestamp_utc.isoformat(),
+            'timestamp_brasil': timestamp_brasil.isoformat(),
+            'lote_id': lote_id
+        }
         
-        # Verificar se todos os signatários assinaram (considerando lotes)
-        try:
-            conn2 = get_db()
-            cur2 = conn2.cursor()
+        # Pipeline: as escritas seguem sem esperar resposta uma da outra; só o
+        # progresso e as cabeças das cadeias de auditoria são lidos de volta
+        with conn.pipeline() if psycopg.Pipeline.is_supported() else contextlib.nullcontext():
+            # Registrar assinatura com todos os dados incluindo aceite
+            cur.execute('''
+                UPDATE signatarios 
+                SET assinado = TRUE, 
+                    ip_assinatura = %s,
+                    data_assinatura = %s,
+                    user_agent = %s,
+                    latitude = %s,
+                    longitude = %s,
+                    aceite_termos = %s,
+                    data_aceite = %s,
+                    hash_aceite = %s
+                WHERE token = %s AND NOT assinado
+            ''', (
+                ip_real,
+                timestamp_brasil,
+                user_agent,
+                latitude,
+                longitude,
+                aceite_termos,
+                timestamp_brasil,
+                hash_aceite,
+                token
+            ))
+            gravar_imagens_signatario(cur, row['id'], imagens)
             
-            # Para lotes, verificar com base no lote_id
-            if lote_id:
-                cur2.execute('''
-                    SELECT COUNT(*) as total, 
-                           SUM(CASE WHEN assinado THEN 1 ELSE 0 END) as assinados
-                    FROM signatarios WHERE lote_id = %s
-                ''', (lote_id,))
-            else:
-                cur2.execute('''
-                    SELECT COUNT(*) as total, 
-                           SUM(CASE WHEN assinado THEN 1 ELSE 0 END) as assinados
-                    FROM signatarios WHERE doc_id = %s
-                ''', (row['doc_id'],))
+            # Atualizar o progresso na mesma transação da assinatura
+            progresso = atualizar_progresso_assinatura(cur, row['doc_id'], lote_id, timestamp_brasil)
             
-            stats = cur2.fetchone()
-            cur2.close()
-            conn2.close()
+            # Registrar no log de auditoria, na mesma transação
+            anexar_auditoria_lote(cur, [{
+                'doc_id': doc_id,
+                'acao': 'ASSINATURA_CONCLUIDA',
+                'usuario': row['nome'],
+                'ip': ip_real,
+                'user_agent': user_agent,
+                'dados_adicionais': dados_assinatura,
+                'arquivo_hash': (row['hashes'] or {}).get(doc_id)
+            } for doc_id in docs_para_auditoria])
             
-            todos_assinaram = stats['total'] == stats['assinados']
+            conn.commit()
+        cur.close()
+        conn.close()
+        
+        ancorar_auditoria_async()
+        
+        # Documento (ou lote) concluído: gerar os PDFs assinados antes dos primeiros downloads
+        if progresso['concluido_em'] is not None:
+            materializar_pdfs_assinados_async(docs_para_auditoria)
+        
+        # Todos os signatários assinaram? (considerando lotes)
+        try:
+            todos_assinaram = progresso['concluido_em'] is not None
             
             # Enviar todos os emails em uma única thread com delay para evitar rate limit
             def enviar_emails_com_delay():
@@ -1875,10 +3249,17 @@ def limpar_tudo():
         # Tentar limpar log_auditoria (pode não existir em servidores antigos)
         try:
             cur.execute("DELETE FROM log_auditoria")
+            cur.execute("DELETE FROM cadeias_auditoria")
+            cur.execute("DELETE FROM auditoria_checkpoints")  # Checkpoints do log apagado não valem mais
+            cur.execute("DELETE FROM evidencias_hash")
         except:
             pass  # Tabela pode não existir
         cur.execute("DELETE FROM signatarios")
-        cur.execute("DELETE FROM documentos")
+        cur.execute("DELETE FROM artefatos_assinados RETURNING arquivo_hash")
+        liberar_blobs(cur, [r['arquivo_hash'] for r in cur.fetchall()])
+        cur.execute("DELETE FROM documentos RETURNING arquivo_hash, (arquivo_bytes IS NULL AND arquivo_base64 IS NULL) AS no_blob_store")
+        liberar_blobs(cur, [r['arquivo_hash'] for r in cur.fetchall() if r['no_blob_store']])
+        cur.execute("DELETE FROM lotes")
         cur.execute("DELETE FROM pastas WHERE id > 1")  # Manter pasta raiz
         
         # Resetar sequências
@@ -1890,6 +3271,9 @@ def limpar_tudo():
         cur.close()
         conn.close()
         
+        # Apagar os PDFs que ficaram sem referência
+        coletar_blobs()
+        
         return jsonify({
             'sucesso': True,
             'mensagem': 'Todos os dados foram limpos com sucesso!'
@@ -1898,6 +3282,13 @@ def limpar_tudo():
     except Exception as e:
         return jsonify({'erro': str(e)})
 
+SQL_SIGNATARIO_PARA_VALIDAR = '''
+    SELECT s.cpf, s.data_nascimento, s.nome, s.assinado, d.doc_id
+    FROM signatarios s
+    JOIN documentos d ON s.doc_id = d.doc_id
+    WHERE s.token = %s
+'''
+
 @app.route('/api/validar_signatario', methods=['POST'])
 def validar_signatario():
     """Valida CPF e data de nascimento do signatário antes de permitir assinatura"""
@@ -1922,12 +3313,7 @@ def validar_signatario():
         cur = conn.cursor()
         
         # Buscar dados cadastrados do signatário
-        cur.execute('''
-            SELECT s.cpf, s.data_nascimento, s.nome, s.assinado, d.doc_id
-            FROM signatarios s
-            JOIN documentos d ON s.doc_id = d.doc_id
-            WHERE s.token = %s
-        ''', (token,))
+        cur.execute(SQL_SIGNATARIO_PARA_VALIDAR, (token,))
         
         row = cur.fetchone()
         cur.close()
@@ -2015,9 +3401,7 @@ def criar_documento():
         if not arquivo_base64 or not signatarios:
             return jsonify({'erro': 'Dados incompletos'})
         
-        # Gerar hash do documento
         arquivo_bytes = base64.b64decode(arquivo_base64)
-        arquivo_hash = hashlib.sha256(arquivo_bytes).hexdigest()
         
         # Gerar ID do documento
         doc_id = hashlib.sha256(f"{datetime.now().isoformat()}{arquivo_nome}".encode()).hexdigest()[:16]
@@ -2025,11 +3409,14 @@ def criar_documento():
         conn = get_db()
         cur = conn.cursor()
         
-        # Inserir documento com hash, pasta_id e email_criador
+        # PDF no blob store pelo hash SHA-256 (gravado só se ainda não existir)
+        arquivo_hash = referenciar_blob(cur, arquivo_bytes)
+        
+        # Inserir documento com hash (referência ao blob), pasta_id, email_criador e total de signatários
         cur.execute('''
-            INSERT INTO documentos (doc_id, titulo, arquivo_nome, arquivo_base64, arquivo_hash, criado_por, pasta_id, email_criador)
+            INSERT INTO documentos (doc_id, titulo, arquivo_nome, arquivo_hash, criado_por, pasta_id, email_criador, total_signatarios)
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        ''', (doc_id, titulo, arquivo_nome, arquivo_base64, arquivo_hash, criado_por, pasta_id, email_criador))
+        ''', (doc_id, titulo, arquivo_nome, arquivo_hash, criado_por, pasta_id, email_criador, len(signatarios)))
         
         # Inserir signatários
         links = []
@@ -2086,7 +3473,8 @@ def criar_documento():
                 'arquivo_hash': arquivo_hash,
                 'total_signatarios': len(signatarios),
                 'pasta_id': pasta_id
-            }
+            },
+            arquivo_hash=arquivo_hash
         )
         
         return jsonify({
@@ -2123,6 +3511,9 @@ def criar_lote():
         conn = get_db()
         cur = conn.cursor()
         
+        # Contadores de progresso do lote
+        cur.execute('INSERT INTO lotes (lote_id, total_signatarios) VALUES (%s, %s)', (lote_id, len(signatarios)))
+        
         doc_ids = []
         
         # Criar cada documento do lote
@@ -2134,18 +3525,18 @@ def criar_lote():
             if not arquivo_base64:
                 continue
             
-            # Gerar hash do documento
+            # PDF no blob store pelo hash SHA-256 (gravado só se ainda não existir)
             arquivo_bytes = base64.b64decode(arquivo_base64)
-            arquivo_hash = hashlib.sha256(arquivo_bytes).hexdigest()
+            arquivo_hash = referenciar_blob(cur, arquivo_bytes)
             
             # Gerar ID do documento
             doc_id = hashlib.sha256(f"{datetime.now().isoformat()}{arquivo_nome}{lote_id}".encode()).hexdigest()[:16]
             
             # Inserir documento com lote_id
             cur.execute('''
-                INSERT INTO documentos (doc_id, titulo, arquivo_nome, arquivo_base64, arquivo_hash, criado_por, pasta_id, email_criador, lote_id)
+                INSERT INTO documentos (doc_id, titulo, arquivo_nome, arquivo_hash, criado_por, pasta_id, email_criador, lote_id, total_signatarios)
                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (doc_id, titulo, arquivo_nome, arquivo_base64, arquivo_hash, criado_por, pasta_id, email_criador, lote_id))
+            ''', (doc_id, titulo, arquivo_nome, arquivo_hash, criado_por, pasta_id, email_criador, lote_id, len(signatarios)))
             
             doc_ids.append({
                 'doc_id': doc_id,
@@ -2198,19 +3589,37 @@ def criar_lote():
         if ip_real and ',' in ip_real:
             ip_real = ip_real.split(',')[0].strip()
         
-        registrar_auditoria(
-            doc_id=lote_id,
-            acao='LOTE_CRIADO',
-            usuario=criado_por,
-            ip=ip_real,
-            user_agent=request.headers.get('User-Agent', ''),
-            dados_adicionais={
+        user_agent = request.headers.get('User-Agent', '')
+        
+        # Um DOCUMENTO_CRIADO por documento (evidência por hash, como em criar_documento) + o registro do lote
+        registrar_auditoria_lote([{
+            'doc_id': d['doc_id'],
+            'acao': 'DOCUMENTO_CRIADO',
+            'usuario': criado_por,
+            'ip': ip_real,
+            'user_agent': user_agent,
+            'dados_adicionais': {
+                'titulo': d['titulo'],
+                'arquivo_nome': d['arquivo_nome'],
+                'arquivo_hash': d['hash'],
+                'total_signatarios': len(signatarios),
+                'pasta_id': pasta_id,
+                'lote_id': lote_id
+            },
+            'arquivo_hash': d['hash']
+        } for d in doc_ids] + [{
+            'doc_id': lote_id,
+            'acao': 'LOTE_CRIADO',
+            'usuario': criado_por,
+            'ip': ip_real,
+            'user_agent': user_agent,
+            'dados_adicionais': {
                 'total_documentos': len(doc_ids),
                 'documentos': [d['arquivo_nome'] for d in doc_ids],
                 'total_signatarios': len(signatarios),
                 'pasta_id': pasta_id
             }
-        )
+        }])
         
         return jsonify({
             'sucesso': True,
@@ -2242,10 +3651,21 @@ def get_dossie(doc_id):
         
         # Buscar signatários
         cur.execute('''
-            SELECT nome, email, cpf, telefone, assinado, assinatura_base64, selfie_base64,
-                   ip_assinatura, data_assinatura, user_agent, latitude, longitude, token
-            FROM signatarios WHERE doc_id = %s
-        ''', (doc_id,))
+            SELECT s.nome, s.email, s.cpf, s.telefone, s.assinado, s.assinatura_base64, s.selfie_base64,
+                   s.ip_assinatura, s.data_assinatura, s.user_agent, s.latitude, s.longitude, s.token,
+                   i.mime AS assinatura_mime, i.inicio AS assinatura_inicio,
+                   f.mime AS selfie_mime, f.inicio AS selfie_inicio
+            FROM signatarios s
+            LEFT JOIN LATERAL (
+                SELECT mime, substring(conteudo FROM 1 FOR 48) AS inicio FROM signatarios_imagens
+                WHERE signatario_id = s.id AND tipo = 'assinatura'
+            ) i ON TRUE
+            LEFT JOIN LATERAL (
+                SELECT mime, substring(conteudo FROM 1 FOR 48) AS inicio FROM signatarios_imagens
+                WHERE signatario_id = s.id AND tipo = 'selfie'
+            ) f ON TRUE
+            WHERE s.doc_id = %s
+        ''', (doc_id,), binary=True)
         signatarios = cur.fetchall()
         
         cur.close()
@@ -2275,14 +3695,21 @@ def get_dossie(doc_id):
             }
             
             if sig['assinado']:
+                # Prefixo do data URL: da tabela de imagens ou das colunas legadas
+                imagens = {}
+                for tipo in TIPOS_IMAGEM_SIGNATARIO:
+                    if sig[f'{tipo}_inicio'] is not None:
+                        imagens[tipo] = prefixo_imagem(sig[f'{tipo}_mime'], bytes(sig[f'{tipo}_inicio']))
+                    elif sig[f'{tipo}_base64']:
+                        imagens[tipo] = sig[f'{tipo}_base64'][:50]
                 sig_info['assinatura'] = {
                     'data_hora': sig['data_assinatura'].strftime('%d/%m/%Y %H:%M:%S') if sig['data_assinatura'] else '',
                     'ip': sig['ip_assinatura'],
                     'dispositivo': sig['user_agent'],
                     'localizacao': f"{sig['latitude']}, {sig['longitude']}" if sig['latitude'] else 'Não disponível',
-                    'selfie': 'Capturada' if sig['selfie_base64'] else 'Não capturada',
-                    'assinatura_imagem': sig['assinatura_base64'][:50] + '...' if sig['assinatura_base64'] else None,
-                    'selfie_imagem': sig['selfie_base64'][:50] + '...' if sig['selfie_base64'] else None
+                    'selfie': 'Capturada' if imagens.get('selfie') else 'Não capturada',
+                    'assinatura_imagem': imagens['assinatura'] + '...' if imagens.get('assinatura') else None,
+                    'selfie_imagem': imagens['selfie'] + '...' if imagens.get('selfie') else None
                 }
             
             dossie['signatarios'].append(sig_info)
@@ -2338,135 +3765,452 @@ def get_pdf_original(doc_id):
         cur = conn.cursor()
         
         cur.execute('''
-            SELECT arquivo_base64, arquivo_nome
+            SELECT arquivo_bytes, arquivo_base64, arquivo_hash, arquivo_nome
             FROM documentos WHERE doc_id = %s
-        ''', (doc_id,))
+        ''', (doc_id,), binary=True)
         
         row = cur.fetchone()
         cur.close()
         conn.close()
         
-        if not row or not row['arquivo_base64']:
+        if not row:
             return 'Documento não encontrado', 404
         
-        pdf_data = base64.b64decode(row['arquivo_base64'])
-        
         # Usar urllib.parse.quote para encoding seguro do nome do arquivo
         from urllib.parse import quote
         arquivo_nome = row['arquivo_nome'] or 'documento.pdf'
         # Remover caracteres problemáticos e usar encoding UTF-8
         arquivo_nome_safe = quote(arquivo_nome, safe='')
         
-        return Response(
-            pdf_data,
-            mimetype='application/pdf',
-            headers={
-                'Content-Disposition': f"inline; filename*=UTF-8''{arquivo_nome_safe}"
-            }
-        )
+        resposta = resposta_pdf(row, f"inline; filename*=UTF-8''{arquivo_nome_safe}")
+        if not resposta:
+            return 'Documento não encontrado', 404
+        
+        return resposta
         
     except Exception as e:
         return f'Erro: {str(e)}', 500
 
 
-@app.route('/api/pdf_assinado/<doc_id>')
-def get_pdf_assinado(doc_id):
-    """Gera e retorna PDF com assinaturas aplicadas - Layout melhorado"""
+# QR Code de verificação: depende só da URL (hash do documento), então é gerado
+# uma vez por URL e reaproveitado por todos os signatários e renderizações.
+QR_CACHE_TAMANHO = int(os.environ.get('QR_CACHE_TAMANHO', 256))
+QR_CACHE_DIR = os.environ.get('QR_CACHE_DIR', '')  # opcional: guarda os PNGs em disco
+
+def url_verificacao(arquivo_hash):
+    """Link de verificação permanente do documento (funciona mesmo após exclusão do PDF)"""
+    server_url = os.environ.get('RENDER_EXTERNAL_URL', 'https://signature-server-jq9j.onrender.com')
+    return f"{server_url}/verificar/{arquivo_hash}"
+
+@functools.lru_cache(maxsize=QR_CACHE_TAMANHO)
+def qr_code_png(url):
+    """PNG do QR Code da URL (cache LRU em memória e, com QR_CACHE_DIR, em disco)"""
+    from io import BytesIO
+    caminho = None
+    if QR_CACHE_DIR:
+        caminho = os.path.join(QR_CACHE_DIR, hashlib.sha256(url.encode()).hexdigest() + '.png')
+        try:
+            with open(caminho, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+    
+    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=4, border=2)
+    qr.add_data(url)
+    qr.make(fit=True)
+    qr_buffer = BytesIO()
+    qr.make_image(fill_color="black", back_color="white").save(qr_buffer, format='PNG')
+    png = qr_buffer.getvalue()
+    
+    if caminho:
+        try:
+            os.makedirs(QR_CACHE_DIR, exist_ok=True)
+            temporario = f"{caminho}.{os.getpid()}.tmp"
+            with open(temporario, 'wb') as f:
+                f.write(png)
+            os.replace(temporario, caminho)
+        except OSError as e:
+            print(f"[QR] Não foi possível gravar o cache em disco: {e}")
+    return png
+
+def definir_modelo_folha(c, largura, altura, qr_imagem, verificacao_url):
+    """Define no canvas as partes fixas da folha de assinaturas como form XObjects.
+
+    Cada parte é gravada uma vez no PDF e cada uso é só uma referência
+    (doForm): o cabeçalho e o rodapé com os rótulos e o texto legal, e a seção
+    de verificação (QR Code, link e instruções), que se repete em todos os
+    signatários. Retorna {parte: nome do form}; 'verificacao' só existe com QR.
+    """
+    from reportlab.lib.colors import HexColor
+    cor_titulo = HexColor('#1a1a1a')
+    cor_label = HexColor('#666666')
+    cor_linha = HexColor('#cccccc')
+    prefixo = f'FolhaV{PDF_ASSINADO_LAYOUT_VERSAO}'
+    formularios = {}
+    
+    # Cabeçalho: título e rótulos (os valores são preenchidos a cada geração)
+    formularios['cabecalho'] = f'{prefixo}Cabecalho'
+    c.beginForm(formularios['cabecalho'])
+    c.setFillColor(cor_titulo)
+    c.setFont("Helvetica-Bold", 18)
+    c.drawString(50, altura - 50, "FOLHA DE ASSINATURAS DIGITAIS")
+    c.setFillColor(cor_label)
+    c.setFont("Helvetica", 10)
+    c.drawString(50, altura - 75, "Documento:")
+    c.drawString(50, altura - 90, "Hash SHA-256:")
+    c.drawString(50, altura - 105, "Criado em:")
+    c.drawString(50, altura - 120, "Última atualização em:")
+    c.setStrokeColor(cor_linha)
+    c.setLineWidth(1)
+    c.line(50, altura - 135, largura - 50, altura - 135)
+    c.endForm()
+    
+    # Rodapé com texto legal (a data de geração é preenchida a cada geração)
+    formularios['rodape'] = f'{prefixo}Rodape'
+    c.beginForm(formularios['rodape'])
+    c.setStrokeColor(cor_linha)
+    c.setLineWidth(0.5)
+    c.line(50, 60, largura - 50, 60)
+    c.setFillColor(cor_label)
+    c.setFont("Helvetica", 8)
+    c.drawString(50, 45, "Assinaturas eletrônicas e físicas têm igual validade legal, conforme MP 2.200-2/2001 e Lei 14.063/2020.")
+    c.drawString(50, 33, "Documento assinado digitalmente via HAMI ERP - Sistema de Assinaturas Digitais")
+    c.endForm()
+    
+    if qr_imagem is None:
+        return formularios
+    
+    # Seção de verificação, relativa à linha separadora (y = 0): igual para
+    # todos os signatários do documento
+    formularios['verificacao'] = f'{prefixo}Verificacao'
+    c.beginForm(formularios['verificacao'], lowerx=0, lowery=-120, upperx=largura, uppery=5)
+    c.setStrokeColor(cor_linha)
+    c.setLineWidth(0.5)
+    c.line(60, 0, largura - 60, 0)
+    
+    # Título da seção
+    c.setFillColor(cor_label)
+    c.setFont("Helvetica-Bold", 9)
+    c.drawString(60, -15, "Verificação de Autenticidade:")
+    
+    # Box de fundo para QR e link
+    box_verif_y = -110
+    c.setFillColor(HexColor('#f5f5f5'))
+    c.setStrokeColor(cor_linha)
+    c.rect(55, box_verif_y, largura - 110, 90, stroke=1, fill=1)
+    
+    # QR Code à esquerda
+    qr_size = 70
+    qr_x = 70
+    qr_y = box_verif_y + 10
+    c.drawImage(qr_imagem, qr_x, qr_y, width=qr_size, height=qr_size)
+    
+    # Texto explicativo à direita do QR
+    text_x = qr_x + qr_size + 20
+    c.setFillColor(HexColor('#333333'))
+    c.setFont("Helvetica-Bold", 9)
+    c.drawString(text_x, qr_y + 60, "Escaneie o QR Code ou acesse o link:")
+    
+    # Link (URL completa) - quebrar em duas linhas se necessário
+    c.setFillColor(HexColor('#1565c0'))
+    c.setFont("Helvetica", 7)
+    max_chars = 55
+    if len(verificacao_url) > max_chars:
+        c.drawString(text_x, qr_y + 47, verificacao_url[:max_chars])
+        c.drawString(text_x, qr_y + 38, verificacao_url[max_chars:])
+    else:
+        c.drawString(text_x, qr_y + 45, verificacao_url)
+    
+    # Instruções
+    c.setFillColor(HexColor('#666666'))
+    c.setFont("Helvetica", 7)
+    c.drawString(text_x, qr_y + 25, "Este link permite verificar a autenticidade")
+    c.drawString(text_x, qr_y + 14, "deste documento e das assinaturas.")
+    c.endForm()
+    
+    return formularios
+
+# incremental: o PDF assinado é o original byte a byte seguido de uma
+# atualização incremental com a folha de assinaturas (custo proporcional à
+# folha, não ao original); reescrever: PDF inteiro regravado pelo PdfWriter
+PDF_ASSINADO_MODO = os.environ.get('PDF_ASSINADO_MODO', 'incremental')
+
+def anexar_paginas_incremental(original, paginas, destino):
+    """Grava em `destino` o arquivo `original` seguido das páginas do PDF `paginas`
+    como atualização incremental.
+
+    Os bytes do original ficam intactos no início do resultado: o SHA-256 dos
+    primeiros bytes (quantos, fica registrado no trailer como
+    /HamiTamanhoOriginal) continua sendo o arquivo_hash. Só são gravados as
+    novas páginas, os objetos que elas usam e a nova versão do nó raiz da
+    árvore de páginas, com uma seção xref própria apontando (/Prev) para a
+    do original. O original é lido do arquivo sob demanda e copiado em
+    partes. Levanta ValueError (antes de gravar qualquer coisa em `destino`)
+    se o original não permite atualização: xref em stream ou object streams
+    (a seção xref gravada aqui é a clássica) e startxref que não aponta para
+    a seção xref.
+    """
+    import shutil
+    from io import BytesIO
+    from PyPDF2 import PdfReader
+    from PyPDF2.generic import (ArrayObject, DictionaryObject, IndirectObject, NameObject,
+                                NumberObject, StreamObject, ByteStringObject)
+    
+    leitor = PdfReader(original)
+    if leitor.is_encrypted:
+        raise ValueError('PDF original criptografado')
+    
+    # Seção xref do original, à qual a nova aponta (startxref fica no último 1 KB)
+    base = original.seek(0, os.SEEK_END)
+    original.seek(max(base - 1024, 0))
+    cauda = original.read()
+    posicao = cauda.rfind(b'startxref')
+    if posicao < 0:
+        raise ValueError('startxref não encontrado')
+    xref_anterior = int(cauda[posicao + 9:].split()[0])
+    original.seek(xref_anterior)
+    inicio = original.read(64).lstrip()
+    if b' obj' in inicio[:20]:
+        # Xref em stream (PDF 1.5+): a atualização teria de ser gravada no mesmo formato
+        raise ValueError('original com xref em stream')
+    if not inicio.startswith(b'xref'):
+        raise ValueError('startxref do original não aponta para uma seção xref')
+    
+    trailer = leitor.trailer
+    if '/XRefStm' in trailer:
+        raise ValueError('original híbrido, com object streams')
+    raiz_ref = trailer['/Root'].raw_get('/Pages')
+    if not isinstance(raiz_ref, IndirectObject):
+        raise ValueError('árvore de páginas sem referência indireta')
+    raiz_paginas = leitor.get_object(raiz_ref)
+    
+    folha = PdfReader(BytesIO(paginas))
+    proximo = int(trailer['/Size'])
+    numeros = {}  # número do objeto na folha -> número no PDF final
+    pendentes = []
+    
+    def referencia(ref):
+        nonlocal proximo
+        if ref.idnum not in numeros:
+            numeros[ref.idnum] = proximo
+            proximo += 1
+            pendentes.append(ref)
+        return IndirectObject(numeros[ref.idnum], 0, None)
+    
+    def copiar(obj):
+        if isinstance(obj, IndirectObject):
+            return referencia(obj)
+        if isinstance(obj, StreamObject):
+            novo = StreamObject()
+            novo._data = obj._data  # já codificado (/Filter copiado junto)
+        elif isinstance(obj, DictionaryObject):
+            novo = DictionaryObject()
+        elif isinstance(obj, ArrayObject):
+            return ArrayObject(copiar(v) for v in obj)
+        else:
+            return obj
+        for chave, valor in dict.items(obj):
+            novo[chave] = copiar(valor)
+        return novo
+    
+    # Referências à árvore de páginas da folha passam a apontar para a do original
+    numeros[folha.trailer['/Root'].raw_get('/Pages').idnum] = raiz_ref.idnum
+    novas_paginas = []
+    for pagina in folha.pages:
+        numeros[pagina.indirect_reference.idnum] = proximo
+        novas_paginas.append((proximo, pagina))
+        proximo += 1
+    
+    saida = BytesIO()  # a atualização (pequena) é montada em memória
+    if not cauda.endswith((b'\n', b'\r')):
+        saida.write(b'\n')
+    posicoes = {}
+    
+    def gravar(numero, obj, geracao=0):
+        posicoes[numero] = (base + saida.tell(), geracao)
+        saida.write(f'{numero} {geracao} obj\n'.encode())
+        obj.write_to_stream(saida, None)
+        saida.write(b'\nendobj\n')
+    
+    for numero, pagina in novas_paginas:
+        # pages já traz os atributos herdados; /Rotate e /CropBox explícitos
+        # para não herdar os da árvore do original
+        nova = copiar(DictionaryObject({k: v for k, v in dict.items(pagina) if k != '/Parent'}))
+        nova[NameObject('/Parent')] = IndirectObject(raiz_ref.idnum, raiz_ref.generation, None)
+        nova.setdefault(NameObject('/Rotate'), NumberObject(0))
+        nova.setdefault(NameObject('/CropBox'), nova['/MediaBox'])
+        gravar(numero, nova)
+    
+    while pendentes:
+        ref = pendentes.pop()
+        gravar(numeros[ref.idnum], copiar(ref.get_object()))
+    
+    # Nova versão do nó raiz: mesmas páginas do original + as da folha
+    raiz = DictionaryObject(dict.items(raiz_paginas))
+    raiz[NameObject('/Kids')] = ArrayObject(list(raiz_paginas.raw_get('/Kids')) +
+                                            [IndirectObject(n, 0, None) for n, _ in novas_paginas])
+    raiz[NameObject('/Count')] = NumberObject(int(raiz_paginas['/Count']) + len(novas_paginas))
+    gravar(raiz_ref.idnum, raiz, raiz_ref.generation)
+    
+    # Seção xref em subseções de números consecutivos (começando pela
+    # entrada livre do objeto 0, que leitores esperam na primeira subseção)
+    inicio_xref = base + saida.tell()
+    saida.write(b'xref\n0 1\n0000000000 65535 f\r\n')
+    numeros_gravados = sorted(posicoes)
+    grupos = []
+    for numero in numeros_gravados:
+        if grupos and numero == grupos[-1][-1] + 1:
+            grupos[-1].append(numero)
+        else:
+            grupos.append([numero])
+    for grupo in grupos:
+        saida.write(f'{grupo[0]} {len(grupo)}\n'.encode())
+        for numero in grupo:
+            offset, geracao = posicoes[numero]
+            saida.write(f'{offset:010d} {geracao:05d} n\r\n'.encode())
+    
+    novo_trailer = DictionaryObject({
+        NameObject('/Size'): NumberObject(proximo),
+        NameObject('/Root'): trailer.raw_get('/Root'),
+        NameObject('/Prev'): NumberObject(xref_anterior),
+        NameObject('/HamiTamanhoOriginal'): NumberObject(base),
+    })
+    if '/Info' in trailer:
+        novo_trailer[NameObject('/Info')] = trailer.raw_get('/Info')
+    if '/ID' in trailer:
+        # Primeiro identificador permanente; o segundo muda a cada versão
+        ids = trailer['/ID']
+        novo_trailer[NameObject('/ID')] = ArrayObject([ids[0], ByteStringObject(hashlib.md5(saida.getvalue()).digest())])
+    saida.write(b'trailer\n')
+    novo_trailer.write_to_stream(saida, None)
+    saida.write(f'\nstartxref\n{inicio_xref}\n%%EOF\n'.encode())
+    
+    original.seek(0)
+    shutil.copyfileobj(original, destino, BLOB_PARTE_TAMANHO)
+    destino.write(saida.getvalue())
+
+PDF_SIGNATARIOS_POR_LOTE = int(os.environ.get('PDF_SIGNATARIOS_POR_LOTE', 20))
+
+# Signatários desenhados na folha, pelo lote ou pelo documento ({coluna})
+SQL_SIGNATARIOS_PARA_PDF = '''
+    SELECT id, nome, email, cpf, telefone, token, assinado,
+           data_assinatura, ip_assinatura, user_agent, latitude, longitude, endereco_aproximado
+    FROM signatarios WHERE {coluna} = %s ORDER BY id
+'''
+
+def signatarios_para_pdf(conn, coluna, valor):
+    """Gera (signatário, imagens prontas) dos signatários com `coluna` = valor, em ordem.
+
+    Os signatários vêm de um cursor no servidor, PDF_SIGNATARIOS_POR_LOTE por
+    vez, e as imagens de cada lote são carregadas só quando ele é desenhado:
+    a memória não cresce com o número de signatários. Usa a transação de `conn`.
+    """
+    assert coluna in ('lote_id', 'doc_id')
+    leitura = conn.cursor(name=f'pdf_signatarios_{coluna}')
+    leitura.itersize = PDF_SIGNATARIOS_POR_LOTE
+    leitura.execute(SQL_SIGNATARIOS_PARA_PDF.format(coluna=coluna), (valor,))
+    cur = conn.cursor()
+    try:
+        while True:
+            lote = leitura.fetchmany(PDF_SIGNATARIOS_POR_LOTE)
+            if not lote:
+                break
+            imagens = carregar_imagens_pdf(cur, [s['id'] for s in lote if s['assinado']])
+            for sig in lote:
+                yield sig, imagens.get(sig['id'], {})
+    finally:
+        cur.close()
+        leitura.close()
+
+def renderizar_pdf_assinado(doc_id):
+    """Gera o PDF com assinaturas aplicadas - Layout melhorado. Retorna (arquivo, arquivo_nome).
+
+    O arquivo é temporário (em memória até ARQUIVO_SPOOL_LIMITE, depois em
+    disco), posicionado no início; quem chama deve fechá-lo.
+    """
+    conn = None
+    original = None
     try:
+        import tempfile
         from io import BytesIO
         from PyPDF2 import PdfReader, PdfWriter
         from reportlab.lib.pagesizes import A4
         from reportlab.pdfgen import canvas
         from reportlab.lib.utils import ImageReader
         from reportlab.lib.colors import HexColor
-        from PIL import Image
+        from reportlab import rl_config
+        
+        # Streams de imagem em binário: sem o acelerador C, o ASCII85 padrão do
+        # ReportLab (Python puro, segurando o GIL) era quase todo o tempo da
+        # geração, e ainda aumenta cada imagem em 25%
+        rl_config.useA85 = 0
         
         conn = get_db()
         cur = conn.cursor()
         
         # Buscar documento COM lote_id
         cur.execute('''
-            SELECT doc_id, titulo, arquivo_nome, arquivo_base64, arquivo_hash, criado_em, lote_id
+            SELECT doc_id, titulo, arquivo_nome, arquivo_bytes, arquivo_base64, arquivo_hash, criado_em, lote_id,
+                   total_signatarios, concluido_em
             FROM documentos WHERE doc_id = %s
-        ''', (doc_id,))
+        ''', (doc_id,), binary=True)
         doc = cur.fetchone()
         
-        if not doc or not doc['arquivo_base64']:
+        if not doc or (doc['arquivo_bytes'] is None and not doc['arquivo_base64'] and not doc['arquivo_hash']):
             cur.close()
             conn.close()
-            return jsonify({'erro': 'Documento não encontrado'}), 404
+            raise PdfAssinadoIndisponivel('Documento não encontrado')
+        
+        # Progresso mantido no documento: recusa sem carregar os signatários
+        if not doc['total_signatarios']:
+            cur.close()
+            conn.close()
+            raise PdfAssinadoIndisponivel('Nenhum signatário encontrado para este documento')
+        
+        if doc['concluido_em'] is None:
+            cur.close()
+            conn.close()
+            raise PdfAssinadoIndisponivel('Documento ainda não foi totalmente assinado', 400)
         
-        # Buscar signatários que assinaram
-        # Se for um lote, buscar pelo lote_id (signatários são vinculados ao lote, não ao doc individual)
+        # Onde estão os signatários: se for um lote, no lote_id (signatários são
+        # vinculados ao lote, não ao doc individual); em lotes antigos, no doc_id
+        # do primeiro documento do lote; senão, no doc_id atual. Aqui só se
+        # decide o filtro - os signatários são lidos em partes durante o desenho
         lote_id = doc.get('lote_id')
-        signatarios = []
+        filtro = None
         
         if lote_id:
-            try:
+            cur.execute('SELECT 1 FROM signatarios WHERE lote_id = %s LIMIT 1', (lote_id,))
+            if cur.fetchone():
+                filtro = ('lote_id', lote_id)
+            else:
                 cur.execute('''
-                    SELECT nome, email, cpf, telefone, token, assinado, assinatura_base64, selfie_base64,
-                           data_assinatura, ip_assinatura, user_agent, latitude, longitude, endereco_aproximado
-                    FROM signatarios WHERE lote_id = %s
+                    SELECT doc_id FROM documentos 
+                    WHERE lote_id = %s 
+                    ORDER BY criado_em ASC, id ASC 
+                    LIMIT 1
                 ''', (lote_id,))
-                signatarios = cur.fetchall()
-            except Exception as e:
-                # Se falhar por qualquer motivo (coluna não existe, etc), tenta por doc_id
-                signatarios = []
+                primeiro_doc = cur.fetchone()
+                if primeiro_doc:
+                    cur.execute('SELECT 1 FROM signatarios WHERE doc_id = %s LIMIT 1', (primeiro_doc['doc_id'],))
+                    if cur.fetchone():
+                        filtro = ('doc_id', primeiro_doc['doc_id'])
         
-        # Fallback: se não encontrou pelo lote_id, tenta pelo doc_id do primeiro documento do lote
-        if not signatarios:
-            # Para documentos de lote, os signatários estão vinculados ao primeiro doc
-            if lote_id:
-                try:
-                    # Buscar o doc_id do primeiro documento do lote
-                    cur.execute('''
-                        SELECT doc_id FROM documentos 
-                        WHERE lote_id = %s 
-                        ORDER BY criado_em ASC, id ASC 
-                        LIMIT 1
-                    ''', (lote_id,))
-                    primeiro_doc = cur.fetchone()
-                    if primeiro_doc:
-                        cur.execute('''
-                            SELECT nome, email, cpf, telefone, token, assinado, assinatura_base64, selfie_base64,
-                                   data_assinatura, ip_assinatura, user_agent, latitude, longitude, endereco_aproximado
-                            FROM signatarios WHERE doc_id = %s
-                        ''', (primeiro_doc['doc_id'],))
-                        signatarios = cur.fetchall()
-                except:
-                    pass
-            
-            # Se ainda não encontrou, tenta pelo doc_id atual
-            if not signatarios:
-                cur.execute('''
-                    SELECT nome, email, cpf, telefone, token, assinado, assinatura_base64, selfie_base64,
-                           data_assinatura, ip_assinatura, user_agent, latitude, longitude, endereco_aproximado
-                    FROM signatarios WHERE doc_id = %s
-                ''', (doc_id,))
-                signatarios = cur.fetchall()
+        if not filtro:
+            cur.execute('SELECT 1 FROM signatarios WHERE doc_id = %s LIMIT 1', (doc_id,))
+            if cur.fetchone():
+                filtro = ('doc_id', doc_id)
         
         cur.close()
-        conn.close()
         
         # Verificar se encontrou signatários
-        if not signatarios:
-            return jsonify({'erro': 'Nenhum signatário encontrado para este documento'}), 404
-        
-        # Verificar se todos assinaram
-        todos_assinaram = all(s['assinado'] for s in signatarios)
-        if not todos_assinaram:
-            return jsonify({'erro': 'Documento ainda não foi totalmente assinado'}), 400
-        
-        # Decodificar PDF original
-        pdf_original = base64.b64decode(doc['arquivo_base64'])
-        
-        # Ler PDF original
-        reader = PdfReader(BytesIO(pdf_original))
-        writer = PdfWriter()
+        if not filtro:
+            raise PdfAssinadoIndisponivel('Nenhum signatário encontrado para este documento')
         
-        # Copiar todas as páginas do original
-        for page in reader.pages:
-            writer.add_page(page)
+        # PDF original (blob store; colunas da linha apenas em documentos legados)
+        original = abrir_arquivo(doc)
+        if original is None:
+            raise PdfAssinadoIndisponivel('Arquivo do documento não encontrado')
         
         # Criar página de assinaturas
         sig_buffer = BytesIO()
@@ -2480,10 +4224,20 @@ def get_pdf_assinado(doc_id):
         cor_linha = HexColor('#cccccc')
         cor_fundo_imagem = HexColor('#f5f5f5')
         
-        # Cabeçalho com título
-        c.setFillColor(cor_titulo)
-        c.setFont("Helvetica-Bold", 18)
-        c.drawString(50, height - 50, "FOLHA DE ASSINATURAS DIGITAIS")
+        # QR Code de verificação: um só por documento (usa hash para verificação
+        # permanente); vai uma única vez para o PDF, dentro do form da seção de verificação
+        verificacao_url = url_verificacao(doc['arquivo_hash'])
+        try:
+            qr_imagem = ImageReader(BytesIO(qr_code_png(verificacao_url)))
+        except Exception as e:
+            print(f"[QR] Erro ao gerar QR Code: {e}")
+            qr_imagem = None
+        
+        # Partes fixas da folha como form XObjects, referenciadas a cada uso
+        formularios = definir_modelo_folha(c, width, height, qr_imagem, verificacao_url)
+        
+        # Cabeçalho com título e rótulos
+        c.doForm(formularios['cabecalho'])
         
         # Função para normalizar caracteres especiais para ASCII (ReportLab/Helvetica não suporta bem UTF-8)
         import unicodedata
@@ -2500,41 +4254,25 @@ def get_pdf_assinado(doc_id):
             return texto_limpo
         
         # Informações do documento
-        c.setFillColor(cor_label)
-        c.setFont("Helvetica", 10)
-        c.drawString(50, height - 75, "Documento:")
         c.setFillColor(cor_valor)
+        c.setFont("Helvetica", 10)
         # Normalizar nome do documento para evitar caracteres estranhos
         nome_documento = normalizar_texto(doc['titulo'] or doc['arquivo_nome'])
         c.drawString(120, height - 75, nome_documento)
         
-        c.setFillColor(cor_label)
-        c.drawString(50, height - 90, "Hash SHA-256:")
-        c.setFillColor(cor_valor)
         c.setFont("Helvetica", 8)
         c.drawString(130, height - 90, f"{doc['arquivo_hash']}")
         
         c.setFont("Helvetica", 10)
-        c.setFillColor(cor_label)
-        c.drawString(50, height - 105, "Criado em:")
-        c.setFillColor(cor_valor)
         criado_str = doc['criado_em'].strftime('%d/%m/%Y às %H:%M:%S') if doc['criado_em'] else ''
         c.drawString(115, height - 105, criado_str)
         
-        c.setFillColor(cor_label)
-        c.drawString(50, height - 120, "Última atualização em:")
-        c.setFillColor(cor_valor)
         c.drawString(175, height - 120, agora_brasil().strftime('%d/%m/%Y às %H:%M:%S'))
         
-        # Linha separadora
-        c.setStrokeColor(cor_linha)
-        c.setLineWidth(1)
-        c.line(50, height - 135, width - 50, height - 135)
-        
         # Posição inicial para assinaturas
         y_pos = height - 160
         
-        for idx, sig in enumerate(signatarios):
+        for idx, (sig, imagens_sig) in enumerate(signatarios_para_pdf(conn, *filtro)):
             if sig['assinado']:
                 # Verificar se precisa de nova página (altura estimada ~450-500px por signatário)
                 if y_pos < 500:
@@ -2669,58 +4407,18 @@ def get_pdf_assinado(doc_id):
                 img_y = images_y - 300  # Espaço para selfie 3/4 (260px altura + margem)
                 
                 # SELFIE - Maior (150x150) e melhor qualidade
-                if sig['selfie_base64']:
+                if imagens_sig.get('selfie'):
                     try:
-                        img_data = sig['selfie_base64']
-                        if ',' in img_data:
-                            img_data = img_data.split(',')[1]
-                        
-                        img_bytes = base64.b64decode(img_data)
-                        img = Image.open(BytesIO(img_bytes))
-                        
-                        # Converter para RGB se necessário
-                        if img.mode in ('RGBA', 'LA', 'P'):
-                            background = Image.new('RGB', img.size, (255, 255, 255))
-                            if img.mode == 'P':
-                                img = img.convert('RGBA')
-                            background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                            img = background
-                        elif img.mode != 'RGB':
-                            img = img.convert('RGB')
-                        
-                        # Selfie formato 3:4 (proporção retrato) - 195x260
-                        target_width = 195
-                        target_height = 260
-                        # Redimensionar mantendo proporção e cortando se necessário
-                        img_ratio = img.width / img.height
-                        target_ratio = target_width / target_height
-                        
-                        if img_ratio > target_ratio:
-                            # Imagem mais larga - ajustar pela altura
-                            new_height = target_height
-                            new_width = int(target_height * img_ratio)
-                        else:
-                            # Imagem mais alta - ajustar pela largura
-                            new_width = target_width
-                            new_height = int(target_width / img_ratio)
-                        
-                        img = img.resize((new_width, new_height), Image.LANCZOS)
-                        
-                        # Cortar para 180x240 centralizado
-                        left = (new_width - target_width) // 2
-                        top = (new_height - target_height) // 2
-                        img = img.crop((left, top, left + target_width, top + target_height))
-                        
-                        img_buffer = BytesIO()
-                        img.save(img_buffer, format='JPEG', quality=95)
-                        img_buffer.seek(0)
+                        # Selfie formato 3:4 (proporção retrato) - 195x260, JPEG pronto
+                        img = ImageReader(BytesIO(imagens_sig['selfie']))
+                        img_width, img_height = img.getSize()
                         
                         # Desenhar fundo cinza claro
                         c.setFillColor(cor_fundo_imagem)
-                        c.rect(selfie_x - 5, img_y - 5, img.width + 10, img.height + 10, stroke=0, fill=1)
+                        c.rect(selfie_x - 5, img_y - 5, img_width + 10, img_height + 10, stroke=0, fill=1)
                         
-                        c.drawImage(ImageReader(img_buffer), selfie_x, img_y, 
-                                   width=img.width, height=img.height)
+                        c.drawImage(img, selfie_x, img_y, 
+                                   width=img_width, height=img_height)
                         
                         # Legenda da selfie
                         c.setFillColor(cor_label)
@@ -2732,44 +4430,19 @@ def get_pdf_assinado(doc_id):
                         c.drawString(selfie_x, img_y + 50, "Selfie não disponível")
                 
                 # ASSINATURA - Maior (250x100) com fundo branco
-                if sig['assinatura_base64']:
+                if imagens_sig.get('assinatura'):
                     try:
-                        img_data = sig['assinatura_base64']
-                        if ',' in img_data:
-                            img_data = img_data.split(',')[1]
-                        
-                        img_bytes = base64.b64decode(img_data)
-                        img = Image.open(BytesIO(img_bytes))
-                        
-                        # IMPORTANTE: Converter PNG com transparência para fundo branco
-                        if img.mode in ('RGBA', 'LA', 'P'):
-                            background = Image.new('RGB', img.size, (255, 255, 255))
-                            if img.mode == 'P':
-                                img = img.convert('RGBA')
-                            if img.mode == 'RGBA':
-                                background.paste(img, mask=img.split()[3])
-                            else:
-                                background.paste(img)
-                            img = background
-                        elif img.mode != 'RGB':
-                            img = img.convert('RGB')
-                        
-                        # Assinatura - tamanho ajustado para caber na tabela
-                        max_width = 437  # 380 + 15%
-                        max_height = 138  # 120 + 15%
-                        img.thumbnail((max_width, max_height), Image.LANCZOS)
-                        
-                        img_buffer = BytesIO()
-                        img.save(img_buffer, format='PNG', quality=95)
-                        img_buffer.seek(0)
+                        # Assinatura em fundo branco, já no tamanho da tabela (máx. 437x138)
+                        img = ImageReader(BytesIO(imagens_sig['assinatura']))
+                        img_width, img_height = img.getSize()
                         
                         # Desenhar fundo branco para assinatura
                         c.setFillColor(HexColor('#ffffff'))
                         c.setStrokeColor(cor_linha)
-                        c.rect(assinatura_x - 5, img_y + 50 - 5, img.width + 10, img.height + 10, stroke=1, fill=1)
+                        c.rect(assinatura_x - 5, img_y + 50 - 5, img_width + 10, img_height + 10, stroke=1, fill=1)
                         
-                        c.drawImage(ImageReader(img_buffer), assinatura_x, img_y + 50, 
-                                   width=img.width, height=img.height)
+                        c.drawImage(img, assinatura_x, img_y + 50, 
+                                   width=img_width, height=img_height)
                         
                         # Legenda
                         c.setFillColor(cor_label)
@@ -2780,78 +4453,17 @@ def get_pdf_assinado(doc_id):
                         c.setFont("Helvetica", 8)
                         c.drawString(assinatura_x, img_y + 50, "Assinatura não disponível")
                 
-                # ========== QR CODE DE VERIFICAÇÃO ==========
-                # Gerar QR Code com link de verificação (usa hash para verificação permanente)
-                server_url = os.environ.get('RENDER_EXTERNAL_URL', 'https://signature-server-jq9j.onrender.com')
-                # Usar hash do documento para verificação permanente (funciona mesmo após exclusão do PDF)
-                verificacao_url = f"{server_url}/verificar/{doc['arquivo_hash']}"
-                
-                try:
-                    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=4, border=2)
-                    qr.add_data(verificacao_url)
-                    qr.make(fit=True)
-                    qr_img = qr.make_image(fill_color="black", back_color="white")
-                    
-                    # Converter para bytes
-                    qr_buffer = BytesIO()
-                    qr_img.save(qr_buffer, format='PNG')
-                    qr_buffer.seek(0)
-                    
-                    # ========== SEÇÃO DE VERIFICAÇÃO ==========
-                    # Linha separadora
+                # ========== SEÇÃO DE VERIFICAÇÃO (QR CODE) ==========
+                # Se o QR não pôde ser gerado, continua sem a seção
+                if 'verificacao' in formularios:
                     verif_y = img_y - 25
-                    c.setStrokeColor(cor_linha)
-                    c.setLineWidth(0.5)
-                    c.line(60, verif_y, width - 60, verif_y)
-                    
-                    # Título da seção
-                    c.setFillColor(cor_label)
-                    c.setFont("Helvetica-Bold", 9)
-                    c.drawString(60, verif_y - 15, "Verificação de Autenticidade:")
-                    
-                    # Box de fundo para QR e link
-                    box_verif_y = verif_y - 110
-                    c.setFillColor(HexColor('#f5f5f5'))
-                    c.setStrokeColor(cor_linha)
-                    c.rect(55, box_verif_y, width - 110, 90, stroke=1, fill=1)
-                    
-                    # QR Code à esquerda
-                    qr_size = 70
-                    qr_x = 70
-                    qr_y = box_verif_y + 10
-                    c.drawImage(ImageReader(qr_buffer), qr_x, qr_y, width=qr_size, height=qr_size)
-                    
-                    # Texto explicativo à direita do QR
-                    text_x = qr_x + qr_size + 20
-                    c.setFillColor(HexColor('#333333'))
-                    c.setFont("Helvetica-Bold", 9)
-                    c.drawString(text_x, qr_y + 60, "Escaneie o QR Code ou acesse o link:")
-                    
-                    # Link clicável (URL completa) - quebrar em múltiplas linhas se necessário
-                    c.setFillColor(HexColor('#1565c0'))
-                    c.setFont("Helvetica", 7)
-                    # Quebrar URL longa em múltiplas linhas
-                    max_chars = 55
-                    if len(verificacao_url) > max_chars:
-                        # Primeira linha
-                        c.drawString(text_x, qr_y + 47, verificacao_url[:max_chars])
-                        # Segunda linha
-                        c.drawString(text_x, qr_y + 38, verificacao_url[max_chars:])
-                    else:
-                        c.drawString(text_x, qr_y + 45, verificacao_url)
-                    
-                    # Instruções
-                    c.setFillColor(HexColor('#666666'))
-                    c.setFont("Helvetica", 7)
-                    c.drawString(text_x, qr_y + 25, "Este link permite verificar a autenticidade")
-                    c.drawString(text_x, qr_y + 14, "deste documento e das assinaturas.")
+                    c.saveState()
+                    c.translate(0, verif_y)
+                    c.doForm(formularios['verificacao'])
+                    c.restoreState()
                     
                     # Atualizar img_y para o cálculo do box incluir a verificação
-                    img_y = box_verif_y - 10
-                    
-                except Exception as e:
-                    # Se falhar o QR, continua sem ele
-                    pass
+                    img_y = verif_y - 120
                 
                 # Calcular altura final do box e desenhá-lo
                 box_end_y = img_y - 20  # Margem inferior
@@ -2863,48 +4475,452 @@ def get_pdf_assinado(doc_id):
                 y_pos = box_end_y - 20  # Próximo signatário
         
         # Rodapé com texto legal
+        c.doForm(formularios['rodape'])
         c.setFillColor(cor_label)
         c.setFont("Helvetica", 8)
-        
-        # Linha separadora do rodapé
-        c.setStrokeColor(cor_linha)
-        c.line(50, 60, width - 50, 60)
-        
-        # Texto legal
-        c.drawString(50, 45, "Assinaturas eletrônicas e físicas têm igual validade legal, conforme MP 2.200-2/2001 e Lei 14.063/2020.")
-        c.drawString(50, 33, "Documento assinado digitalmente via HAMI ERP - Sistema de Assinaturas Digitais")
         c.drawString(50, 21, f"Gerado em: {agora_brasil().strftime('%d/%m/%Y às %H:%M:%S')} (Horário de Brasília)")
         
         c.save()
+        conn.close()
+        
+        # PDF final montado em arquivo temporário: em memória até
+        # ARQUIVO_SPOOL_LIMITE, em disco acima disso
+        output = tempfile.SpooledTemporaryFile(max_size=ARQUIVO_SPOOL_LIMITE)
+        try:
+            # Original intacto + folha de assinaturas como atualização incremental
+            incremental = False
+            if PDF_ASSINADO_MODO == 'incremental':
+                try:
+                    anexar_paginas_incremental(original, sig_buffer.getvalue(), output)
+                    incremental = True
+                except Exception as e:
+                    print(f"[PDF] Atualização incremental indisponível para {doc_id} ({e}); reescrevendo o PDF")
+            
+            if not incremental:
+                # Ler PDF original e copiar todas as páginas
+                output.seek(0)
+                output.truncate()
+                original.seek(0)
+                reader = PdfReader(original)
+                writer = PdfWriter()
+                for page in reader.pages:
+                    writer.add_page(page)
+                
+                # Adicionar página de assinaturas ao PDF
+                sig_buffer.seek(0)
+                sig_reader = PdfReader(sig_buffer)
+                for page in sig_reader.pages:
+                    writer.add_page(page)
+                
+                writer.write(output)
+            
+            output.seek(0)
+        except BaseException:
+            output.close()
+            raise
         
-        # Adicionar página de assinaturas ao PDF
-        sig_buffer.seek(0)
-        sig_reader = PdfReader(sig_buffer)
-        for page in sig_reader.pages:
-            writer.add_page(page)
+        return output, doc['arquivo_nome']
         
-        # Gerar PDF final
-        output = BytesIO()
-        writer.write(output)
-        output.seek(0)
+    except ImportError as e:
+        raise PdfAssinadoIndisponivel(f'Dependências não instaladas: {e}', 500)
+    finally:
+        if original is not None:
+            original.close()
+        if conn is not None:
+            conn.close()
+
+# O PDF assinado é gerado uma vez, quando a última assinatura é registrada,
+# e guardado no blob store como artefato imutável (artefatos_assinados).
+# Downloads servem o artefato; só um artefato de layout anterior (ou ausente,
+# em documentos concluídos antes desta versão) é gerado de novo.
+
+PDF_ASSINADO_LAYOUT_VERSAO = 1  # Incrementar ao mudar a folha de assinaturas
+PDF_ASSINADO_ESPERA_MAXIMA = int(os.environ.get('PDF_ASSINADO_ESPERA_MAXIMA', 60))  # segundos
+PDF_ASSINADO_ESPERA_INTERVALO = 0.5  # Segundos entre consultas de quem espera a geração de outro worker
+ARTEFATO_LOCK_ID = 7351003
+
+# Gerações em andamento neste processo: (doc_id, layout) -> Future do resultado
+_geracoes_pdf = {}
+_geracoes_pdf_lock = threading.Lock()
+
+class PdfAssinadoIndisponivel(Exception):
+    """Não há PDF assinado para o documento (inexistente, pendente, sem arquivo)"""
+    
+    def __init__(self, mensagem, status=404):
+        super().__init__(mensagem)
+        self.status = status
+    
+    def __reduce__(self):
+        # Preserva o status ao voltar de um processo do pool de renderização
+        return (type(self), (str(self), self.status))
+
+def artefato_pdf_assinado(doc_id):
+    """Artefato do PDF assinado no layout atual ({arquivo_hash, tamanho, arquivo_nome}), ou None"""
+    with get_db() as conn:
+        return conn.execute('''
+            SELECT a.arquivo_hash, a.tamanho, d.arquivo_nome
+            FROM artefatos_assinados a
+            JOIN documentos d ON d.doc_id = a.doc_id
+            WHERE a.doc_id = %s AND a.layout_versao = %s
+        ''', (doc_id, PDF_ASSINADO_LAYOUT_VERSAO)).fetchone()
+
+# Geração em processos separados (pool de renderização): o trabalho de
+# CPU do PyPDF2/ReportLab/Pillow não segura o GIL do worker que atende as
+# requisições e roda sob limites de memória e de tempo por tarefa. Um
+# processo que estoure a memória ou morra só derruba a sua geração; o pool
+# é recriado na próxima. 0 processos = gerar no próprio worker, como antes
+# (desenvolvimento).
+
+def _processos_render_padrao():
+    """1 ou 2 processos: os.cpu_count() mostra os núcleos do host, não a cota do contêiner"""
+    try:
+        nucleos = len(os.sched_getaffinity(0))
+    except AttributeError:  # Sem sched_getaffinity (macOS)
+        nucleos = os.cpu_count() or 1
+    return max(1, min(2, nucleos))
+
+PDF_RENDER_PROCESSOS = int(os.environ.get('PDF_RENDER_PROCESSOS', _processos_render_padrao()))
+PDF_RENDER_TAREFAS_POR_PROCESSO = int(os.environ.get('PDF_RENDER_TAREFAS_POR_PROCESSO', 50))  # Reciclagem
+# Por processo (0 = sem limite). Medido: 176 MB para 200 páginas com 120
+# signatários. PDF_RENDER_PROCESSOS x limite, mais o worker, cabe na instância.
+PDF_RENDER_MEMORIA_MAXIMA_MB = int(os.environ.get('PDF_RENDER_MEMORIA_MAXIMA_MB', 256))
+PDF_RENDER_TEMPO_MAXIMO = int(os.environ.get('PDF_RENDER_TEMPO_MAXIMO', 120))  # Segundos por geração
+PDF_RENDER_TEMPO_WATCHDOG = 10  # Segundos além de PDF_RENDER_TEMPO_MAXIMO até o processo travado se encerrar
+PDF_RENDER_ESPERA_EXTRA = 30  # Segundos além de PDF_RENDER_TEMPO_MAXIMO que o worker espera (fila, início do processo)
+
+_pool_render = None
+_pool_render_pid = None
+_pool_render_lock = threading.Lock()
+
+class TempoRenderizacaoEsgotado(BaseException):
+    """Tempo da geração esgotado (SIGALRM). BaseException para não ser
+    engolida pelos except Exception do desenho da folha de assinaturas"""
+
+def _inicializar_processo_render(memoria_maxima_mb):
+    """Roda uma vez em cada processo do pool de renderização"""
+    global DB_POOL_MIN, DB_POOL_MAX
+    # Uma geração por vez: a leitura dos signatários e a do blob store bastam
+    DB_POOL_MIN, DB_POOL_MAX = 1, 2
+    if memoria_maxima_mb:
+        # RLIMIT_DATA (heap e mapeamentos privados graváveis), não RLIMIT_AS:
+        # o espaço de endereçamento conta também reservas que nunca viram
+        # memória (arenas do glibc por thread, bibliotecas)
+        import resource
+        limite = memoria_maxima_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_DATA, (limite, limite))
+
+def _renderizar_em_processo(doc_id, tempo_maximo):
+    """Tarefa do pool: gera o PDF assinado num arquivo temporário e retorna (caminho, arquivo_nome).
+
+    O tempo é limitado três vezes: SIGALRM interrompe a geração com erro
+    (tempo de relógio, inclusive esperando o banco), RLIMIT_CPU mata o
+    processo se ele ficar preso em código C gastando CPU, e o watchdog do
+    faulthandler (uma thread em C, que não depende do GIL) encerra o processo
+    PDF_RENDER_TEMPO_WATCHDOG segundos depois do limite se ele estiver preso
+    sem devolver o controle. Processo encerrado = BrokenProcessPool no worker.
+    """
+    import faulthandler
+    import signal
+    import resource
+    import shutil
+    import tempfile
+    
+    def _tempo_esgotado(signum, frame):
+        raise TempoRenderizacaoEsgotado()
+    
+    signal.signal(signal.SIGALRM, _tempo_esgotado)
+    uso = resource.getrusage(resource.RUSAGE_SELF)
+    _, cpu_maximo = resource.getrlimit(resource.RLIMIT_CPU)
+    limite_cpu = int(uso.ru_utime + uso.ru_stime) + tempo_maximo + 5
+    if cpu_maximo != resource.RLIM_INFINITY:
+        limite_cpu = min(limite_cpu, cpu_maximo)
+    resource.setrlimit(resource.RLIMIT_CPU, (limite_cpu, cpu_maximo))
+    signal.alarm(tempo_maximo)
+    faulthandler.dump_traceback_later(tempo_maximo + PDF_RENDER_TEMPO_WATCHDOG, exit=True)
+    caminho = None
+    try:
+        arquivo, arquivo_nome = renderizar_pdf_assinado(doc_id)
+        with arquivo, tempfile.NamedTemporaryFile(prefix='pdf-assinado-', suffix='.pdf', delete=False) as destino:
+            caminho = destino.name
+            shutil.copyfileobj(arquivo, destino, BLOB_PARTE_TAMANHO)
+        return caminho, arquivo_nome
+    except BaseException as e:
+        signal.alarm(0)
+        if caminho and os.path.exists(caminho):
+            os.remove(caminho)
+        if isinstance(e, TempoRenderizacaoEsgotado):
+            print(f"[PDF] Geração de {doc_id} excedeu {tempo_maximo}s")
+            raise PdfAssinadoIndisponivel('Geração do PDF assinado excedeu o tempo máximo', 500) from None
+        raise
+    finally:
+        signal.alarm(0)
+        faulthandler.cancel_dump_traceback_later()
+
+def get_pool_render():
+    """Pool de renderização do processo atual (criado sob demanda, recriado após fork)"""
+    global _pool_render, _pool_render_pid
+    with _pool_render_lock:
+        if _pool_render is None or _pool_render_pid != os.getpid():
+            import multiprocessing
+            # spawn: os processos não herdam o pool de conexões nem as threads do worker
+            _pool_render = concurrent.futures.ProcessPoolExecutor(
+                max_workers=PDF_RENDER_PROCESSOS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_inicializar_processo_render,
+                initargs=(PDF_RENDER_MEMORIA_MAXIMA_MB,),
+                max_tasks_per_child=PDF_RENDER_TAREFAS_POR_PROCESSO,
+            )
+            _pool_render_pid = os.getpid()
+        return _pool_render
+
+def _descartar_pool_render(pool):
+    """Descarta um pool quebrado (processo morto) ou travado; o próximo envio cria outro.
+
+    Um processo travado se encerra sozinho (watchdog de _renderizar_em_processo).
+    """
+    global _pool_render
+    with _pool_render_lock:
+        if _pool_render is pool:
+            _pool_render = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def enviar_renderizacao(doc_id):
+    """Submete a geração do PDF assinado ao pool de renderização.
+
+    Retorna (pool, Future de (caminho, arquivo_nome)); o arquivo em caminho é
+    temporário e passa a ser de quem recebe o resultado.
+    """
+    pool = get_pool_render()
+    try:
+        return pool, pool.submit(_renderizar_em_processo, doc_id, PDF_RENDER_TEMPO_MAXIMO)
+    except concurrent.futures.BrokenExecutor:
+        _descartar_pool_render(pool)
+        pool = get_pool_render()
+        return pool, pool.submit(_renderizar_em_processo, doc_id, PDF_RENDER_TEMPO_MAXIMO)
+
+def gerar_pdf_assinado(doc_id):
+    """Gera o PDF assinado no pool de renderização. Retorna (arquivo, arquivo_nome), como renderizar_pdf_assinado.
+
+    Levanta PdfAssinadoIndisponivel também quando a geração estoura os
+    limites de memória ou de tempo ou o processo morre. O worker espera no
+    máximo PDF_RENDER_TEMPO_MAXIMO + PDF_RENDER_ESPERA_EXTRA: um processo
+    que passe disso está travado e o pool é recriado.
+    """
+    if PDF_RENDER_PROCESSOS <= 0:
+        return renderizar_pdf_assinado(doc_id)
+    
+    pool, tarefa = enviar_renderizacao(doc_id)
+    try:
+        caminho, arquivo_nome = tarefa.result(timeout=PDF_RENDER_TEMPO_MAXIMO + PDF_RENDER_ESPERA_EXTRA)
+    except concurrent.futures.TimeoutError:
+        if tarefa.cancel():
+            # Nem começou: todos os processos ocupados
+            raise PdfAssinadoIndisponivel('Geração de PDFs assinados sobrecarregada, tente novamente em instantes', 503)
+        print(f"[PDF] Geração de {doc_id} não terminou em {PDF_RENDER_TEMPO_MAXIMO + PDF_RENDER_ESPERA_EXTRA}s; recriando o pool")
+        _descartar_pool_render(pool)
+        raise PdfAssinadoIndisponivel('Geração do PDF assinado excedeu o tempo máximo', 500)
+    except MemoryError:
+        print(f"[PDF] Geração de {doc_id} excedeu {PDF_RENDER_MEMORIA_MAXIMA_MB} MB")
+        raise PdfAssinadoIndisponivel('Geração do PDF assinado excedeu o limite de memória', 500)
+    except concurrent.futures.BrokenExecutor:
+        # Processo morto (sinal, falta de memória fora do Python, limite de CPU, watchdog):
+        # as gerações em andamento nele falham juntas e o pool é recriado
+        print(f"[PDF] Processo de renderização morreu gerando {doc_id}; recriando o pool")
+        _descartar_pool_render(pool)
+        raise PdfAssinadoIndisponivel('Falha no processo de geração do PDF assinado', 500)
+    
+    arquivo = open(caminho, 'rb')
+    os.remove(caminho)  # Some do disco quando o arquivo for fechado
+    return arquivo, arquivo_nome
+
+def materializar_pdf_assinado(doc_id):
+    """Gera o PDF assinado e grava como artefato, substituindo um de layout anterior.
+
+    Requisições simultâneas para o mesmo documento compartilham uma única
+    geração: no mesmo processo esperam o resultado da primeira; entre workers,
+    só quem reivindica a geração (geracoes_pdf_assinado) gera, e os outros
+    consultam o artefato até ele aparecer.
+
+    Retorna {arquivo_hash, tamanho, arquivo_nome}; o conteúdo fica só no blob
+    store (a resposta é enviada de lá, em partes). Levanta PdfAssinadoIndisponivel se o documento não pode ter PDF
+    assinado ou se a geração em andamento não terminar a tempo.
+    """
+    chave = (doc_id, PDF_ASSINADO_LAYOUT_VERSAO)
+    with _geracoes_pdf_lock:
+        geracao = _geracoes_pdf.get(chave)
+        primeira = geracao is None
+        if primeira:
+            geracao = _geracoes_pdf[chave] = concurrent.futures.Future()
+    
+    if not primeira:
+        try:
+            return geracao.result(timeout=PDF_ASSINADO_ESPERA_MAXIMA)
+        except concurrent.futures.TimeoutError:
+            raise PdfAssinadoIndisponivel('PDF assinado em geração, tente novamente em instantes', 503)
+    
+    try:
+        resultado = _materializar_pdf_assinado(doc_id)
+        geracao.set_result(resultado)
+        return resultado
+    except BaseException as e:
+        geracao.set_exception(e)
+        raise
+    finally:
+        with _geracoes_pdf_lock:
+            _geracoes_pdf.pop(chave, None)
+
+def reivindicar_geracao_pdf(doc_id, dono):
+    """Numa transação curta: o artefato pronto (dict), True se a geração ficou com dono ou False se outro worker está gerando.
+
+    Documento pendente ou sem signatários é recusado aqui, pelos contadores da
+    linha, sem reivindicar nem enviar nada ao pool de geração.
+    """
+    with get_db() as conn:
+        row = conn.execute('''
+            SELECT d.arquivo_nome, d.total_signatarios, d.concluido_em, a.arquivo_hash, a.tamanho
+            FROM documentos d
+            LEFT JOIN artefatos_assinados a ON a.doc_id = d.doc_id AND a.layout_versao = %s
+            WHERE d.doc_id = %s
+        ''', (PDF_ASSINADO_LAYOUT_VERSAO, doc_id)).fetchone()
+        if not row:
+            raise PdfAssinadoIndisponivel('Documento não encontrado')
+        if row['arquivo_hash']:
+            return {'arquivo_nome': row['arquivo_nome'], 'arquivo_hash': row['arquivo_hash'], 'tamanho': row['tamanho']}
+        if not row['total_signatarios']:
+            raise PdfAssinadoIndisponivel('Nenhum signatário encontrado para este documento')
+        if row['concluido_em'] is None:
+            raise PdfAssinadoIndisponivel('Documento ainda não foi totalmente assinado', 400)
+        # Reivindicação vencida = geração interrompida: fica com o novo dono
+        validade = PDF_RENDER_TEMPO_MAXIMO + PDF_RENDER_ESPERA_EXTRA + PDF_ASSINADO_ESPERA_MAXIMA
+        return conn.execute('''
+            INSERT INTO geracoes_pdf_assinado (doc_id, dono, expira_em)
+            VALUES (%s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s))
+            ON CONFLICT (doc_id) DO UPDATE SET dono = EXCLUDED.dono, expira_em = EXCLUDED.expira_em
+            WHERE geracoes_pdf_assinado.expira_em < CURRENT_TIMESTAMP
+            RETURNING dono
+        ''', (doc_id, dono, validade)).fetchone() is not None
+
+def _materializar_pdf_assinado(doc_id):
+    """Geração de fato (ver materializar_pdf_assinado).
+
+    Nenhuma conexão fica emprestada durante a geração nem enquanto se espera
+    a de outro worker: reivindicar, consultar e gravar são transações curtas.
+    Quem grava toma o advisory lock do documento e, se encontrar um artefato
+    gravado nesse meio tempo (reivindicação vencida), fica com ele.
+    """
+    dono = os.urandom(16).hex()
+    prazo = time.monotonic() + PDF_ASSINADO_ESPERA_MAXIMA
+    while True:
+        reivindicacao = reivindicar_geracao_pdf(doc_id, dono)
+        if isinstance(reivindicacao, dict):
+            return reivindicacao
+        if reivindicacao:
+            break
+        if time.monotonic() >= prazo:
+            raise PdfAssinadoIndisponivel('PDF assinado em geração, tente novamente em instantes', 503)
+        time.sleep(PDF_ASSINADO_ESPERA_INTERVALO)
+    
+    try:
+        arquivo, arquivo_nome = gerar_pdf_assinado(doc_id)
+        with arquivo, get_db() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT pg_advisory_xact_lock(%s, hashtext(%s))', (ARTEFATO_LOCK_ID, doc_id))
+            cur.execute('''
+                SELECT a.arquivo_hash, a.layout_versao, a.tamanho, d.arquivo_nome
+                FROM artefatos_assinados a
+                JOIN documentos d ON d.doc_id = a.doc_id
+                WHERE a.doc_id = %s
+            ''', (doc_id,))
+            anterior = cur.fetchone()
+            if anterior and anterior['layout_versao'] == PDF_ASSINADO_LAYOUT_VERSAO:
+                cur.close()
+                return {'arquivo_hash': anterior['arquivo_hash'], 'tamanho': anterior['tamanho'], 'arquivo_nome': anterior['arquivo_nome']}
+            
+            tamanho = arquivo.seek(0, os.SEEK_END)
+            arquivo_hash = referenciar_blob_arquivo(cur, arquivo)
+            cur.execute('''
+                INSERT INTO artefatos_assinados (doc_id, layout_versao, arquivo_hash, tamanho)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (doc_id) DO UPDATE
+                SET layout_versao = EXCLUDED.layout_versao, arquivo_hash = EXCLUDED.arquivo_hash,
+                    tamanho = EXCLUDED.tamanho, criado_em = CURRENT_TIMESTAMP
+            ''', (doc_id, PDF_ASSINADO_LAYOUT_VERSAO, arquivo_hash, tamanho))
+            # A referência ao blob do artefato substituído é liberada exatamente uma vez
+            if anterior:
+                liberar_blobs(cur, [anterior['arquivo_hash']])
+            cur.close()
+    finally:
+        with get_db() as conn:
+            conn.execute('DELETE FROM geracoes_pdf_assinado WHERE doc_id = %s AND dono = %s', (doc_id, dono))
+    
+    if anterior:
+        coletar_blobs()
+    print(f"[PDF] PDF assinado de {doc_id} gerado ({tamanho} bytes, layout v{PDF_ASSINADO_LAYOUT_VERSAO})")
+    return {'arquivo_hash': arquivo_hash, 'tamanho': tamanho, 'arquivo_nome': arquivo_nome}
+
+def materializar_pdfs_assinados_async(doc_ids):
+    """Gera em segundo plano os PDFs assinados dos documentos recém-concluídos"""
+    def _gerar():
+        for doc_id in doc_ids:
+            try:
+                materializar_pdf_assinado(doc_id)
+            except Exception as e:
+                print(f"[PDF] Erro ao gerar PDF assinado de {doc_id}: {e}")
+    
+    threading.Thread(target=_gerar, daemon=True).start()
+
+def regenerar_pdfs_assinados():
+    """Gera os artefatos ausentes ou de layout anterior dos documentos concluídos. Retorna (gerados, falhas)."""
+    with get_db() as conn:
+        doc_ids = [r['doc_id'] for r in conn.execute('''
+            SELECT d.doc_id FROM documentos d
+            LEFT JOIN artefatos_assinados a ON a.doc_id = d.doc_id
+            WHERE d.concluido_em IS NOT NULL
+              AND (a.doc_id IS NULL OR a.layout_versao <> %s)
+            ORDER BY d.id
+        ''', (PDF_ASSINADO_LAYOUT_VERSAO,)).fetchall()]
+    
+    gerados = 0
+    falhas = 0
+    for doc_id in doc_ids:
+        try:
+            materializar_pdf_assinado(doc_id)
+            gerados += 1
+        except Exception as e:
+            falhas += 1
+            print(f"[PDF] Erro ao gerar PDF assinado de {doc_id}: {e}")
+    return gerados, falhas
+
+@app.cli.command('regenerar-pdfs-assinados')
+def comando_regenerar_pdfs_assinados():
+    """Gera os PDFs assinados que faltam ou estão em layout anterior (flask --app app regenerar-pdfs-assinados)"""
+    gerados, falhas = regenerar_pdfs_assinados()
+    print(f"Concluído: {gerados} gerado(s), {falhas} falha(s)")
+
+@app.route('/api/pdf_assinado/<doc_id>')
+def get_pdf_assinado(doc_id):
+    """Retorna o PDF com assinaturas aplicadas (artefato gerado na conclusão)"""
+    try:
+        artefato = artefato_pdf_assinado(doc_id) or materializar_pdf_assinado(doc_id)
         
         # Usar urllib.parse.quote para encoding seguro do nome do arquivo
         from urllib.parse import quote
-        arquivo_nome = doc['arquivo_nome'] or 'documento.pdf'
-        # Remover caracteres problemáticos e usar encoding UTF-8
+        arquivo_nome = artefato['arquivo_nome'] or 'documento.pdf'
         arquivo_nome_safe = quote(f"ASSINADO_{arquivo_nome}", safe='')
+        content_disposition = f"inline; filename*=UTF-8''{arquivo_nome_safe}"
         
-        return Response(
-            output.getvalue(),
-            mimetype='application/pdf',
-            headers={
-                'Content-Disposition': f"inline; filename*=UTF-8''{arquivo_nome_safe}",
-                'Content-Type': 'application/pdf'
-            }
-        )
+        # Enviado do blob store em partes, com Content-Length
+        resposta = resposta_blob(artefato['arquivo_hash'], artefato['tamanho'])
+        if not resposta:
+            return jsonify({'erro': 'Arquivo do documento não encontrado'}), 404
+        resposta.headers['Content-Disposition'] = content_disposition
         
-    except ImportError as e:
-        return jsonify({'erro': f'Dependências não instaladas: {e}'}), 500
+        # Conteúdo endereçado pelo hash: revalidações respondem 304 sem corpo
+        resposta.set_etag(artefato['arquivo_hash'])
+        return resposta.make_conditional(request)
+        
+    except PdfAssinadoIndisponivel as e:
+        return jsonify({'erro': str(e)}), e.status
     except Exception as e:
         return jsonify({'erro': str(e)}), 500
 
@@ -2918,122 +4934,246 @@ def download_documento(token):
         
         # Buscar documento pelo token do signatário
         cur.execute('''
-            SELECT d.arquivo_base64, d.arquivo_nome, d.doc_id
+            SELECT d.arquivo_bytes, d.arquivo_base64, d.arquivo_hash, d.arquivo_nome, d.doc_id
             FROM signatarios s
             JOIN documentos d ON s.doc_id = d.doc_id
             WHERE s.token = %s
-        ''', (token,))
+        ''', (token,), binary=True)
         
         row = cur.fetchone()
         
         # Se não encontrou pelo token do signatário, tentar pelo doc_id
         if not row:
             cur.execute('''
-                SELECT arquivo_base64, arquivo_nome, doc_id
+                SELECT arquivo_bytes, arquivo_base64, arquivo_hash, arquivo_nome, doc_id
                 FROM documentos WHERE doc_id = %s
-            ''', (token,))
+            ''', (token,), binary=True)
             row = cur.fetchone()
         
         cur.close()
         conn.close()
         
-        if not row or not row['arquivo_base64']:
+        resposta = resposta_pdf(row, f'inline; filename="ASSINADO_{row["arquivo_nome"]}"') if row else None
+        if not resposta:
             return jsonify({'erro': 'Documento não encontrado'}), 404
         
-        pdf_data = base64.b64decode(row['arquivo_base64'])
-        
-        return Response(
-            pdf_data,
-            mimetype='application/pdf',
-            headers={
-                'Content-Disposition': f'inline; filename="ASSINADO_{row["arquivo_nome"]}"',
-                'Content-Type': 'application/pdf'
-            }
-        )
+        return resposta
         
     except Exception as e:
         return jsonify({'erro': str(e)}), 500
 
+LISTAGEM_LIMITE_PADRAO = 50
+LISTAGEM_LIMITE_MAXIMO = 500
+STREAMING_LINHAS_POR_LOTE = int(os.environ.get('STREAMING_LINHAS_POR_LOTE', 500))
+
+def resposta_json_streaming(chave, buscar_lote, converter):
+    """Resposta {chave: [...]} escrita aos poucos, em lotes buscados por keyset.
+
+    buscar_lote(cur, ultimo, limite) retorna até limite linhas depois de ultimo
+    (a última linha do lote anterior; None no primeiro). Cada lote usa uma
+    conexão do pool só durante a consulta e é convertido e enviado ao cliente
+    antes do próximo: um cliente lento não segura conexão nem transação, e a
+    memória do worker não cresce com o tamanho do resultado. O primeiro lote é
+    buscado aqui, antes da resposta começar; um erro no meio da transmissão só
+    pode interromper o corpo (JSON truncado). Cada lote vê o banco no momento
+    em que é buscado.
+    """
+    def buscar(ultimo):
+        with get_db() as conn:
+            cur = conn.cursor()
+            rows = buscar_lote(cur, ultimo, STREAMING_LINHAS_POR_LOTE)
+            cur.close()
+        return rows
+    
+    primeiro = buscar(None)
+    
+    def gerar():
+        try:
+            yield '{"%s":[' % chave
+            separador = ''
+            rows = primeiro
+            while rows:
+                partes = []
+                for row in rows:
+                    partes.append(separador + app.json.dumps(converter(row), separators=(',', ':')))
+                    separador = ','
+                yield ''.join(partes)
+                if len(rows) < STREAMING_LINHAS_POR_LOTE:
+                    break
+                rows = buscar(rows[-1])
+            yield ']}'
+        except Exception as e:
+            print(f"[STREAM] Erro ao transmitir {chave}: {e}")
+            raise
+    
+    return Response(stream_with_context(gerar()), mimetype='application/json')
+
+def documento_listagem(row):
+    """Item de /api/documentos"""
+    return {
+        'doc_id': row['doc_id'],
+        'titulo': row['titulo'],
+        'arquivo_nome': row['arquivo_nome'],
+        'criado_em': row['criado_em'].strftime('%d/%m/%Y %H:%M') if row['criado_em'] else '',
+        'criado_por': row['criado_por'],
+        'total_signatarios': row['total_signatarios'] or 0,
+        'assinados': row['assinados'] or 0,
+        'lote_id': row['lote_id'] or ''
+    }
+
+def codificar_cursor(row):
+    """Cursor opaco da listagem: posição (criado_em, id) do último item da página"""
+    return base64.urlsafe_b64encode(f"{row['criado_em'].isoformat()}|{row['id']}".encode()).decode()
+
+def decodificar_cursor(cursor):
+    """Inverso de codificar_cursor; ValueError se o cursor for inválido"""
+    try:
+        criado_em, _, id_ = base64.urlsafe_b64decode(cursor.encode()).decode().partition('|')
+        return datetime.fromisoformat(criado_em), int(id_)
+    except Exception:
+        raise ValueError('Cursor inválido')
+
+def ler_data_filtro(valor):
+    """Data de filtro em DD/MM/AAAA ou AAAA-MM-DD"""
+    for formato in ('%d/%m/%Y', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(valor.strip(), formato)
+        except ValueError:
+            pass
+    raise ValueError(f'Data inválida: {valor}')
+
+def filtros_documentos(args):
+    """Monta (condições SQL, parâmetros) dos filtros da listagem de documentos.
+
+    Filtros: pasta_id, criado_por, lote_id, status (pendente | concluido) e
+    período de/ate (inclusive) sobre criado_em. Cada filtro tem índice em INDICES.
+    """
+    condicoes = []
+    params = []
+    if args.get('pasta_id'):
+        condicoes.append('pasta_id = %s')
+        params.append(int(args['pasta_id']))
+    if args.get('criado_por'):
+        condicoes.append('criado_por = %s')
+        params.append(args['criado_por'])
+    if args.get('lote_id'):
+        condicoes.append('lote_id = %s')
+        params.append(args['lote_id'])
+    status = (args.get('status') or '').lower()
+    if status == 'pendente':
+        condicoes.append('concluido_em IS NULL')
+    elif status in ('concluido', 'concluído'):
+        condicoes.append('concluido_em IS NOT NULL')
+    elif status:
+        raise ValueError(f'Status inválido: {status}')
+    if args.get('de'):
+        condicoes.append('criado_em >= %s')
+        params.append(ler_data_filtro(args['de']))
+    if args.get('ate'):
+        condicoes.append('criado_em < %s')
+        params.append(ler_data_filtro(args['ate']) + timedelta(days=1))
+    return condicoes, params
+
+def sql_listagem_documentos(condicoes, params, limite, depois_de=None):
+    """(SQL, parâmetros) da listagem de documentos, do mais recente ao mais antigo.
+
+    depois_de é a posição (criado_em, id) do último item já entregue (keyset).
+    """
+    condicoes = list(condicoes)
+    params = list(params)
+    if depois_de:
+        condicoes.append('(criado_em, id) < (%s, %s)')
+        params.extend(depois_de)
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ''
+    # Contadores mantidos pelo assinar (documentos de lote espelham o lote)
+    return f'''
+        SELECT id, doc_id, titulo, arquivo_nome, criado_em, criado_por, lote_id, total_signatarios, assinados
+        FROM documentos
+        {where}
+        ORDER BY criado_em DESC, id DESC
+        LIMIT %s
+    ''', params + [limite]
+
+def consultar_documentos(cur, condicoes, params, limite, depois_de=None):
+    """Linhas da listagem de documentos (ver sql_listagem_documentos)"""
+    cur.execute(*sql_listagem_documentos(condicoes, params, limite, depois_de))
+    return cur.fetchall()
+
 @app.route('/api/documentos')
 def listar_documentos():
-    """Lista todos os documentos"""
+    """Lista os documentos, do mais recente ao mais antigo.
+
+    Com ?limite=N (ou ?cursor=...) a resposta é paginada por keyset sobre
+    (criado_em, id) e inclui proximo_cursor; sem eles, retorna todos, em
+    streaming, em lotes pela mesma chave (criado_em, id).
+    """
     try:
+        try:
+            condicoes, params = filtros_documentos(request.args)
+            cursor = request.args.get('cursor')
+            paginado = bool(request.args.get('limite') or cursor)
+            limite = min(max(int(request.args.get('limite') or LISTAGEM_LIMITE_PADRAO), 1), LISTAGEM_LIMITE_MAXIMO)
+            depois_de = decodificar_cursor(cursor) if cursor else None
+        except ValueError as e:
+            return jsonify({'erro': str(e)}), 400
+        
+        if not paginado:
+            return resposta_json_streaming(
+                'documentos',
+                lambda cur, ultimo, lote: consultar_documentos(
+                    cur, condicoes, params, lote, (ultimo['criado_em'], ultimo['id']) if ultimo else None),
+                documento_listagem)
+        
         conn = get_db()
         cur = conn.cursor()
         
-        # Query modificada para buscar signatários pelo lote_id quando documento faz parte de um lote
-        cur.execute('''
-            SELECT d.doc_id, d.titulo, d.arquivo_nome, d.criado_em, d.criado_por, d.lote_id,
-                   COALESCE(
-                       (SELECT COUNT(*) FROM signatarios s WHERE 
-                           CASE WHEN d.lote_id IS NOT NULL 
-                           THEN s.lote_id = d.lote_id 
-                           ELSE s.doc_id = d.doc_id END),
-                       0
-                   ) as total_signatarios,
-                   COALESCE(
-                       (SELECT SUM(CASE WHEN s.assinado THEN 1 ELSE 0 END) FROM signatarios s WHERE 
-                           CASE WHEN d.lote_id IS NOT NULL 
-                           THEN s.lote_id = d.lote_id 
-                           ELSE s.doc_id = d.doc_id END),
-                       0
-                   ) as assinados
-            FROM documentos d
-            ORDER BY d.criado_em DESC
-        ''')
-        
-        rows = cur.fetchall()
+        # Um a mais que o limite: indica se existe próxima página
+        rows = consultar_documentos(cur, condicoes, params, limite + 1, depois_de)
         cur.close()
         conn.close()
         
-        documentos = []
-        for row in rows:
-            documentos.append({
-                'doc_id': row['doc_id'],
-                'titulo': row['titulo'],
-                'arquivo_nome': row['arquivo_nome'],
-                'criado_em': row['criado_em'].strftime('%d/%m/%Y %H:%M') if row['criado_em'] else '',
-                'criado_por': row['criado_por'],
-                'total_signatarios': row['total_signatarios'] or 0,
-                'assinados': row['assinados'] or 0,
-                'lote_id': row['lote_id'] or ''
-            })
+        proximo_cursor = None
+        if len(rows) > limite:
+            rows = rows[:limite]
+            proximo_cursor = codificar_cursor(rows[-1])
+        
+        documentos = [documento_listagem(row) for row in rows]
         
-        return jsonify({'documentos': documentos})
+        return jsonify({'documentos': documentos, 'proximo_cursor': proximo_cursor})
         
     except Exception as e:
         return jsonify({'erro': str(e)})
 
 # ==================== API DE PASTAS ====================
 
+def pasta_listagem(row):
+    """Item de /api/pastas"""
+    return {
+        'id': row['id'],
+        'nome': row['nome'],
+        'pasta_pai_id': row['pasta_pai_id'],
+        'criado_em': row['criado_em'].strftime('%d/%m/%Y %H:%M') if row['criado_em'] else '',
+        'criado_por': row['criado_por']
+    }
+
+def consultar_pastas(cur, ultimo, limite):
+    """Lote da listagem de pastas: raiz primeiro, depois por pasta pai e nome (keyset após ultimo)"""
+    # COALESCE(pasta_pai_id, 0) ordena a raiz (sem pai) primeiro, como NULLS FIRST
+    chave = (ultimo['ordem_pai'], ultimo['nome'], ultimo['id']) if ultimo else (-1, '', 0)
+    cur.execute('''
+        SELECT id, nome, pasta_pai_id, criado_em, criado_por, COALESCE(pasta_pai_id, 0) AS ordem_pai
+        FROM pastas
+        WHERE (COALESCE(pasta_pai_id, 0), nome, id) > (%s, %s, %s)
+        ORDER BY COALESCE(pasta_pai_id, 0), nome, id
+        LIMIT %s
+    ''', chave + (limite,))
+    return cur.fetchall()
+
 @app.route('/api/pastas')
 def listar_pastas():
-    """Lista todas as pastas"""
+    """Lista todas as pastas (em streaming, em lotes)"""
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        
-        cur.execute('''
-            SELECT id, nome, pasta_pai_id, criado_em, criado_por
-            FROM pastas
-            ORDER BY pasta_pai_id NULLS FIRST, nome
-        ''')
-        
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        
-        pastas = []
-        for row in rows:
-            pastas.append({
-                'id': row['id'],
-                'nome': row['nome'],
-                'pasta_pai_id': row['pasta_pai_id'],
-                'criado_em': row['criado_em'].strftime('%d/%m/%Y %H:%M') if row['criado_em'] else '',
-                'criado_por': row['criado_por']
-            })
-        
-        return jsonify({'pastas': pastas})
+        return resposta_json_streaming('pastas', consultar_pastas, pasta_listagem)
         
     except Exception as e:
         return jsonify({'erro': str(e)})
@@ -3097,6 +5237,9 @@ def renomear_pasta(pasta_id):
     except Exception as e:
         return jsonify({'erro': str(e)})
 
+SQL_CONTAR_DOCUMENTOS_DA_PASTA = 'SELECT COUNT(*) as count FROM documentos WHERE pasta_id = %s'
+SQL_CONTAR_SUBPASTAS = 'SELECT COUNT(*) as count FROM pastas WHERE pasta_pai_id = %s'
+
 @app.route('/api/pastas/<int:pasta_id>', methods=['DELETE'])
 def excluir_pasta(pasta_id):
     """Exclui uma pasta (apenas se estiver vazia)"""
@@ -3108,14 +5251,14 @@ def excluir_pasta(pasta_id):
         cur = conn.cursor()
         
         # Verificar se há documentos na pasta
-        cur.execute('SELECT COUNT(*) as count FROM documentos WHERE pasta_id = %s', (pasta_id,))
+        cur.execute(SQL_CONTAR_DOCUMENTOS_DA_PASTA, (pasta_id,))
         if cur.fetchone()['count'] > 0:
             cur.close()
             conn.close()
             return jsonify({'erro': 'Pasta contém documentos. Mova-os antes de excluir.'})
         
         # Verificar se há subpastas
-        cur.execute('SELECT COUNT(*) as count FROM pastas WHERE pasta_pai_id = %s', (pasta_id,))
+        cur.execute(SQL_CONTAR_SUBPASTAS, (pasta_id,))
         if cur.fetchone()['count'] > 0:
             cur.close()
             conn.close()
@@ -3438,13 +5581,22 @@ def limpar_documentos():
         # Deletar signatários vinculados aos documentos
         cur.execute('DELETE FROM signatarios')
         
+        # PDFs assinados gerados
+        cur.execute('DELETE FROM artefatos_assinados RETURNING arquivo_hash')
+        liberar_blobs(cur, [r['arquivo_hash'] for r in cur.fetchall()])
+        
         # Deletar documentos
-        cur.execute('DELETE FROM documentos')
+        cur.execute('DELETE FROM documentos RETURNING arquivo_hash, (arquivo_bytes IS NULL AND arquivo_base64 IS NULL) AS no_blob_store')
+        liberar_blobs(cur, [r['arquivo_hash'] for r in cur.fetchall() if r['no_blob_store']])
+        cur.execute('DELETE FROM lotes')
         
         conn.commit()
         cur.close()
         conn.close()
         
+        # Apagar os PDFs que ficaram sem referência
+        coletar_blobs()
+        
         return jsonify({
             'sucesso': True,
             'documentos_removidos': total_docs,
@@ -3454,6 +5606,22 @@ def limpar_documentos():
     except Exception as e:
         return jsonify({'erro': str(e)})
 
+SQL_DOCUMENTOS_MAIS_ANTIGOS = '''
+    SELECT doc_id, titulo, criado_em FROM documentos
+    ORDER BY criado_em ASC
+    LIMIT %s
+'''
+SQL_REMOVER_SIGNATARIOS_DOS_DOCUMENTOS = 'DELETE FROM signatarios WHERE doc_id = ANY(%s)'
+SQL_REMOVER_DOCUMENTOS = '''
+    DELETE FROM documentos
+    WHERE doc_id = ANY(%s)
+    RETURNING arquivo_hash, lote_id, (arquivo_bytes IS NULL AND arquivo_base64 IS NULL) AS no_blob_store
+'''
+SQL_REMOVER_LOTES_VAZIOS = '''
+    DELETE FROM lotes l
+    WHERE l.lote_id = ANY(%s) AND NOT EXISTS (SELECT 1 FROM documentos d WHERE d.lote_id = l.lote_id)
+'''
+
 @app.route('/api/limpar_documentos_antigos', methods=['POST'])
 def limpar_documentos_antigos():
     """Remove os X documentos mais antigos"""
@@ -3478,11 +5646,7 @@ def limpar_documentos_antigos():
         cur = conn.cursor()
         
         # Buscar os X documentos mais antigos (ordenados por data de criação)
-        cur.execute('''
-            SELECT doc_id, titulo, criado_em FROM documentos 
-            ORDER BY criado_em ASC
-            LIMIT %s
-        ''', (quantidade,))
+        cur.execute(SQL_DOCUMENTOS_MAIS_ANTIGOS, (quantidade,))
         docs_antigos = cur.fetchall()
         doc_ids = [row['doc_id'] for row in docs_antigos]
         
@@ -3496,29 +5660,30 @@ def limpar_documentos_antigos():
                 'mensagem': 'Nenhum documento encontrado'
             })
         
-        # Contar signatários associados
-        cur.execute('''
-            SELECT COUNT(*) as count FROM signatarios 
-            WHERE doc_id = ANY(%s)
-        ''', (doc_ids,))
-        total_sigs = cur.fetchone()['count']
-        
         # Deletar signatários dos documentos antigos
-        cur.execute('''
-            DELETE FROM signatarios 
-            WHERE doc_id = ANY(%s)
-        ''', (doc_ids,))
+        cur.execute(SQL_REMOVER_SIGNATARIOS_DOS_DOCUMENTOS, (doc_ids,))
+        total_sigs = cur.rowcount
+        
+        # PDFs assinados gerados dos documentos antigos
+        cur.execute('DELETE FROM artefatos_assinados WHERE doc_id = ANY(%s) RETURNING arquivo_hash', (doc_ids,))
+        liberar_blobs(cur, [r['arquivo_hash'] for r in cur.fetchall()])
         
         # Deletar documentos antigos
-        cur.execute('''
-            DELETE FROM documentos 
-            WHERE doc_id = ANY(%s)
-        ''', (doc_ids,))
+        cur.execute(SQL_REMOVER_DOCUMENTOS, (doc_ids,))
+        removidos = cur.fetchall()
+        # Cada documento removido libera uma referência ao seu PDF
+        liberar_blobs(cur, [r['arquivo_hash'] for r in removidos if r['no_blob_store']])
+        
+        # Lotes dos documentos removidos que ficaram sem documentos
+        cur.execute(SQL_REMOVER_LOTES_VAZIOS, (list({r['lote_id'] for r in removidos if r['lote_id']}),))
         
         conn.commit()
         cur.close()
         conn.close()
         
+        # Apagar apenas os PDFs cuja última referência foi removida
+        coletar_blobs()
+        
         # Pegar data do documento mais antigo e mais recente removido
         data_mais_antigo = docs_antigos[0]['criado_em'].strftime('%d/%m/%Y') if docs_antigos else ''
         data_mais_recente = docs_antigos[-1]['criado_em'].strftime('%d/%m/%Y') if docs_antigos else ''
@@ -3809,6 +5974,30 @@ def pagina_verificacao_permanente(hash):
     """Página de verificação permanente de autenticidade (usa hash do documento)"""
     return render_template_string(PAGINA_VERIFICACAO, hash=hash)
 
+# PDFs idênticos: preferir o documento concluído mais recente
+SQL_DOCUMENTO_POR_HASH = '''
+    SELECT doc_id, titulo, arquivo_nome, arquivo_hash, criado_em, criado_por, lote_id
+    FROM documentos WHERE arquivo_hash = %s
+    ORDER BY concluido_em IS NULL, concluido_em DESC
+    LIMIT 1
+'''
+SQL_DOCUMENTO_POR_DOC_ID = '''
+    SELECT doc_id, titulo, arquivo_nome, arquivo_hash, criado_em, criado_por, lote_id
+    FROM documentos WHERE doc_id = %s
+'''
+SQL_EVIDENCIAS_DO_HASH = '''
+    SELECT doc_id, acao, usuario, ip, dados, criado_em
+    FROM evidencias_hash
+    WHERE arquivo_hash = %s OR doc_id = %s
+    ORDER BY criado_em DESC
+'''
+# Signatários que assinaram, pelo lote ou pelo documento ({coluna})
+SQL_ASSINADOS_PERMANENTE = '''
+    SELECT nome, cpf, data_assinatura, ip_assinatura, latitude, longitude
+    FROM signatarios
+    WHERE {coluna} = %s AND assinado = TRUE
+'''
+
 @app.route('/api/verificar_permanente/<doc_hash>')
 def verificar_permanente(doc_hash):
     """
@@ -3820,70 +6009,64 @@ def verificar_permanente(doc_hash):
         cur = conn.cursor()
         
         # Primeiro tenta buscar pelo hash do documento na tabela documentos
-        cur.execute('''
-            SELECT doc_id, titulo, arquivo_nome, arquivo_hash, criado_em, criado_por
-            FROM documentos WHERE arquivo_hash = %s
-        ''', (doc_hash,))
+        # (PDFs idênticos: preferir o documento concluído mais recente)
+        cur.execute(SQL_DOCUMENTO_POR_HASH, (doc_hash,))
         doc = cur.fetchone()
         
         # Se não encontrou pelo hash, tenta buscar pelo doc_id (para compatibilidade)
         if not doc:
-            cur.execute('''
-                SELECT doc_id, titulo, arquivo_nome, arquivo_hash, criado_em, criado_por
-                FROM documentos WHERE doc_id = %s
-            ''', (doc_hash,))
+            cur.execute(SQL_DOCUMENTO_POR_DOC_ID, (doc_hash,))
             doc = cur.fetchone()
         
-        # Se ainda não encontrou, buscar no log de auditoria
+        # Se ainda não encontrou (documento removido), buscar as evidências
+        # gravadas junto com a auditoria, indexadas pelo hash e pelo doc_id
         if not doc:
-            # Buscar no log de auditoria pelo doc_id ou hash
-            cur.execute('''
-                SELECT DISTINCT doc_id, dados_adicionais, timestamp, usuario
-                FROM log_auditoria 
-                WHERE (doc_id = %s OR dados_adicionais::text LIKE %s)
-                AND acao = 'ASSINATURA_CONCLUIDA'
-                ORDER BY timestamp DESC
-            ''', (doc_hash, f'%{doc_hash}%'))
-            audit_rows = cur.fetchall()
+            cur.execute(SQL_EVIDENCIAS_DO_HASH, (doc_hash, doc_hash))
+            evidencias = cur.fetchall()
+            cur.close()
+            conn.close()
             
-            if not audit_rows:
-                cur.close()
-                conn.close()
+            # O mesmo PDF pode ter sido assinado em documentos diferentes:
+            # mostrar o documento com a assinatura mais recente
+            assinaturas = [ev for ev in evidencias if ev['acao'] == 'ASSINATURA_CONCLUIDA']
+            if not assinaturas:
                 return jsonify({'erro': 'Documento não encontrado no registro de assinaturas'})
             
+            doc_id = assinaturas[0]['doc_id']
+            assinaturas = [ev for ev in assinaturas if ev['doc_id'] == doc_id]
+            criacao = next((ev for ev in evidencias if ev['acao'] == 'DOCUMENTO_CRIADO' and ev['doc_id'] == doc_id), None)
+            
             # Construir resposta apenas com dados do log de auditoria
             signatarios = []
-            for row in audit_rows:
-                dados = json.loads(row['dados_adicionais']) if row['dados_adicionais'] else {}
+            for ev in assinaturas:
+                dados = ev['dados'] or {}
+                momento = datetime.fromisoformat(dados['timestamp_brasil']) if dados.get('timestamp_brasil') else ev['criado_em']
                 signatarios.append({
-                    'nome': row['usuario'],
+                    'nome': ev['usuario'],
                     'cpf_mascarado': dados.get('cpf_mascarado', 'N/A'),
-                    'data_assinatura': row['timestamp'].strftime('%d/%m/%Y às %H:%M') if row['timestamp'] else 'N/A',
-                    'ip': dados.get('ip', 'N/A'),
+                    'data_assinatura': momento.strftime('%d/%m/%Y às %H:%M') if momento else 'N/A',
+                    'ip': ev['ip'] or 'N/A',
                     'localizacao': f"{dados.get('latitude', 'N/A')}, {dados.get('longitude', 'N/A')}" if dados.get('latitude') else None
                 })
             
-            cur.close()
-            conn.close()
-            
+            dados_criacao = (criacao['dados'] or {}) if criacao else {}
             return jsonify({
-                'titulo': 'Documento (dados do log)',
-                'arquivo_nome': 'N/A',
+                'titulo': dados_criacao.get('titulo') or 'Documento (dados do log)',
+                'arquivo_nome': dados_criacao.get('arquivo_nome') or 'N/A',
                 'hash': doc_hash,
-                'criado_em': 'N/A',
-                'criado_por': 'N/A',
+                'criado_em': criacao['criado_em'].strftime('%d/%m/%Y às %H:%M') if criacao and criacao['criado_em'] else 'N/A',
+                'criado_por': criacao['usuario'] if criacao else 'N/A',
                 'signatarios': signatarios,
                 'fonte': 'log_auditoria'
             })
         
         doc_id = doc['doc_id']
         
-        # Buscar signatários que assinaram
-        cur.execute('''
-            SELECT nome, cpf, data_assinatura, ip_assinatura, latitude, longitude
-            FROM signatarios
-            WHERE doc_id = %s AND assinado = TRUE
-        ''', (doc_id,))
+        # Buscar signatários que assinaram (em lotes, vinculados ao lote)
+        if doc['lote_id']:
+            cur.execute(SQL_ASSINADOS_PERMANENTE.format(coluna='lote_id'), (doc['lote_id'],))
+        else:
+            cur.execute(SQL_ASSINADOS_PERMANENTE.format(coluna='doc_id'), (doc_id,))
         sigs = cur.fetchall()
         
         signatarios = []
@@ -3921,5 +6104,6 @@ def verificar_permanente(doc_hash):
         return jsonify({'erro': str(e)})
 
 if __name__ == '__main__':
+    migrar_banco()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
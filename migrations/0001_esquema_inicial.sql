@@ -0,0 +1,81 @@
+-- Esquema inicial (antes criado pelo init_db a cada inicialização).
+-- Idempotente: bancos existentes já têm estas tabelas e colunas.
+
+-- Tabela de documentos
+CREATE TABLE IF NOT EXISTS documentos (
+    id SERIAL PRIMARY KEY,
+    doc_id VARCHAR(64) UNIQUE NOT NULL,
+    titulo VARCHAR(255),
+    arquivo_nome VARCHAR(255),
+    arquivo_base64 TEXT,
+    arquivo_hash VARCHAR(64),
+    criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    criado_por VARCHAR(100)
+);
+
+-- Tabela de signatários
+CREATE TABLE IF NOT EXISTS signatarios (
+    id SERIAL PRIMARY KEY,
+    doc_id VARCHAR(64) REFERENCES documentos(doc_id),
+    nome VARCHAR(255) NOT NULL,
+    email VARCHAR(255),
+    cpf VARCHAR(14),
+    telefone VARCHAR(20),
+    token VARCHAR(64) UNIQUE NOT NULL,
+    assinado BOOLEAN DEFAULT FALSE,
+    assinatura_base64 TEXT,
+    selfie_base64 TEXT,
+    ip_assinatura VARCHAR(45),
+    data_assinatura TIMESTAMP,
+    user_agent TEXT,
+    latitude DECIMAL(10, 8),
+    longitude DECIMAL(11, 8),
+    endereco_aproximado TEXT,
+    data_nascimento DATE
+);
+
+-- Colunas adicionadas depois da criação original das tabelas
+ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS selfie_base64 TEXT;
+ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS telefone VARCHAR(20);
+ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS latitude DECIMAL(10, 8);
+ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS longitude DECIMAL(11, 8);
+ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS endereco_aproximado TEXT;
+ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS data_nascimento DATE;
+ALTER TABLE documentos ADD COLUMN IF NOT EXISTS arquivo_hash VARCHAR(64);
+ALTER TABLE documentos ADD COLUMN IF NOT EXISTS pasta_id INTEGER DEFAULT 1;
+ALTER TABLE documentos ADD COLUMN IF NOT EXISTS email_criador VARCHAR(255);
+
+-- Tabela de pastas para organizar documentos
+CREATE TABLE IF NOT EXISTS pastas (
+    id SERIAL PRIMARY KEY,
+    nome VARCHAR(100) NOT NULL,
+    pasta_pai_id INTEGER REFERENCES pastas(id) ON DELETE CASCADE,
+    criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    criado_por VARCHAR(100)
+);
+
+-- Tabela de log de auditoria com hash encadeado (blockchain-like)
+CREATE TABLE IF NOT EXISTS log_auditoria (
+    id SERIAL PRIMARY KEY,
+    doc_id VARCHAR(64),
+    acao VARCHAR(50) NOT NULL,
+    usuario VARCHAR(200),
+    ip VARCHAR(50),
+    user_agent TEXT,
+    dados_adicionais JSONB,
+    hash_anterior VARCHAR(64),
+    hash_registro VARCHAR(64),
+    criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Pasta raiz
+INSERT INTO pastas (id, nome, pasta_pai_id, criado_por) VALUES (1, 'Raiz', NULL, 'SISTEMA') ON CONFLICT (id) DO NOTHING;
+
+-- Aceite de termos
+ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS aceite_termos BOOLEAN DEFAULT FALSE;
+ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS data_aceite TIMESTAMP;
+ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS hash_aceite VARCHAR(64);
+
+-- Lotes (múltiplos documentos por assinatura)
+ALTER TABLE documentos ADD COLUMN IF NOT EXISTS lote_id VARCHAR(32);
+ALTER TABLE signatarios ADD COLUMN IF NOT EXISTS lote_id VARCHAR(32);
@@ -0,0 +1,5 @@
+-- PDF armazenado em binário (arquivo_base64 fica só para linhas legadas ainda não migradas)
+ALTER TABLE documentos ADD COLUMN IF NOT EXISTS arquivo_bytes BYTEA;
+
+-- PDFs já são comprimidos: guardar fora da linha sem tentar recomprimir
+ALTER TABLE documentos ALTER COLUMN arquivo_bytes SET STORAGE EXTERNAL;
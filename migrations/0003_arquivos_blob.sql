@@ -0,0 +1,9 @@
+-- Blobs endereçados pelo SHA-256 (backend 'banco' do armazenamento de arquivos)
+CREATE TABLE IF NOT EXISTS arquivos_blob (
+    hash VARCHAR(64) PRIMARY KEY,
+    conteudo BYTEA NOT NULL,
+    tamanho BIGINT,
+    criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE arquivos_blob ALTER COLUMN conteudo SET STORAGE EXTERNAL;
@@ -0,0 +1,14 @@
+-- Contagem de referências dos blobs (PDFs idênticos são gravados uma única vez)
+CREATE TABLE IF NOT EXISTS blob_referencias (
+    hash VARCHAR(64) PRIMARY KEY,
+    referencias INTEGER NOT NULL DEFAULT 0,
+    tamanho BIGINT,
+    criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Bancos existentes: contar os documentos que já apontam para o blob store
+INSERT INTO blob_referencias (hash, referencias)
+SELECT arquivo_hash, COUNT(*) FROM documentos
+WHERE arquivo_hash IS NOT NULL AND arquivo_bytes IS NULL AND arquivo_base64 IS NULL
+GROUP BY arquivo_hash
+ON CONFLICT (hash) DO NOTHING;
@@ -0,0 +1,38 @@
+-- Progresso das assinaturas mantido junto com cada assinatura (em vez de
+-- COUNT/SUM sobre signatarios a cada leitura). Documentos de lote repetem os
+-- contadores do lote; a linha em lotes serializa assinaturas concorrentes.
+ALTER TABLE documentos ADD COLUMN IF NOT EXISTS total_signatarios INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE documentos ADD COLUMN IF NOT EXISTS assinados INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE documentos ADD COLUMN IF NOT EXISTS concluido_em TIMESTAMP;
+
+CREATE TABLE IF NOT EXISTS lotes (
+    lote_id VARCHAR(32) PRIMARY KEY,
+    total_signatarios INTEGER NOT NULL DEFAULT 0,
+    assinados INTEGER NOT NULL DEFAULT 0,
+    concluido_em TIMESTAMP,
+    criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Bancos existentes: calcular os contadores a partir dos signatários
+INSERT INTO lotes (lote_id, total_signatarios, assinados, concluido_em)
+SELECT lote_id, COUNT(*), COUNT(*) FILTER (WHERE assinado),
+       CASE WHEN bool_and(assinado) THEN COALESCE(MAX(data_assinatura), CURRENT_TIMESTAMP) END
+FROM signatarios
+WHERE lote_id IS NOT NULL
+GROUP BY lote_id
+ON CONFLICT (lote_id) DO NOTHING;
+
+UPDATE documentos d
+SET total_signatarios = s.total, assinados = s.assinados, concluido_em = s.concluido_em
+FROM (
+    SELECT doc_id, COUNT(*) AS total, COUNT(*) FILTER (WHERE assinado) AS assinados,
+           CASE WHEN bool_and(assinado) THEN COALESCE(MAX(data_assinatura), CURRENT_TIMESTAMP) END AS concluido_em
+    FROM signatarios
+    GROUP BY doc_id
+) s
+WHERE d.lote_id IS NULL AND s.doc_id = d.doc_id;
+
+UPDATE documentos d
+SET total_signatarios = l.total_signatarios, assinados = l.assinados, concluido_em = l.concluido_em
+FROM lotes l
+WHERE l.lote_id = d.lote_id;
@@ -0,0 +1,24 @@
+-- Log de auditoria em cadeias independentes (uma por documento/lote), que
+-- podem receber registros em paralelo. Registros legados (hash_versao NULL)
+-- formam a antiga cadeia global única.
+ALTER TABLE log_auditoria ADD COLUMN IF NOT EXISTS cadeia VARCHAR(64);
+ALTER TABLE log_auditoria ADD COLUMN IF NOT EXISTS seq BIGINT;
+ALTER TABLE log_auditoria ADD COLUMN IF NOT EXISTS hash_versao SMALLINT;
+ALTER TABLE log_auditoria ADD COLUMN IF NOT EXISTS carimbo VARCHAR(40);
+
+-- Último elo de cada cadeia; a linha é travada (FOR UPDATE) durante o encadeamento
+CREATE TABLE IF NOT EXISTS cadeias_auditoria (
+    cadeia VARCHAR(64) PRIMARY KEY,
+    seq BIGINT NOT NULL DEFAULT 0,
+    hash_ultimo VARCHAR(64) NOT NULL,
+    ancorado_seq BIGINT NOT NULL DEFAULT 0,
+    atualizado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- A cadeia legada entra na primeira âncora com o seu último hash
+INSERT INTO cadeias_auditoria (cadeia, seq, hash_ultimo)
+SELECT 'LEGADO', COUNT(*), COALESCE((SELECT hash_registro FROM log_auditoria WHERE hash_versao IS NULL ORDER BY id DESC LIMIT 1), repeat('0', 64))
+FROM log_auditoria
+WHERE hash_versao IS NULL
+HAVING COUNT(*) > 0
+ON CONFLICT (cadeia) DO NOTHING;
@@ -0,0 +1,10 @@
+-- Pontos de verificação da auditoria: até onde o log já foi verificado e o
+-- último elo de cada cadeia naquele ponto, assinados com HMAC
+CREATE TABLE IF NOT EXISTS auditoria_checkpoints (
+    id SERIAL PRIMARY KEY,
+    ate_id BIGINT NOT NULL,
+    total_registros BIGINT NOT NULL,
+    cabecas JSONB NOT NULL,
+    assinatura VARCHAR(64) NOT NULL,
+    criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
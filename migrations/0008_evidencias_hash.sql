@@ -0,0 +1,32 @@
+-- Evidências por hash do PDF: a verificação permanente (QR code) encontra os
+-- registros de criação e assinatura de um documento por índice, mesmo depois
+-- que o documento foi removido
+CREATE TABLE IF NOT EXISTS evidencias_hash (
+    id BIGSERIAL PRIMARY KEY,
+    arquivo_hash VARCHAR(64) NOT NULL,
+    doc_id VARCHAR(64) NOT NULL,
+    acao VARCHAR(50) NOT NULL,
+    log_id INTEGER,
+    usuario VARCHAR(200),
+    ip VARCHAR(50),
+    dados JSONB,
+    criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Bancos existentes: criação (hash registrado no próprio log) e assinaturas
+-- (hash do documento, ou do registro de criação se o documento já foi removido)
+INSERT INTO evidencias_hash (arquivo_hash, doc_id, acao, log_id, usuario, ip, dados, criado_em)
+SELECT l.dados_adicionais->>'arquivo_hash', l.doc_id, l.acao, l.id, l.usuario, l.ip, l.dados_adicionais, l.criado_em
+FROM log_auditoria l
+WHERE l.acao = 'DOCUMENTO_CRIADO' AND l.doc_id IS NOT NULL AND l.dados_adicionais->>'arquivo_hash' IS NOT NULL;
+
+INSERT INTO evidencias_hash (arquivo_hash, doc_id, acao, log_id, usuario, ip, dados, criado_em)
+SELECT COALESCE(d.arquivo_hash, c.arquivo_hash), l.doc_id, l.acao, l.id, l.usuario, l.ip, l.dados_adicionais, l.criado_em
+FROM log_auditoria l
+LEFT JOIN documentos d ON d.doc_id = l.doc_id
+LEFT JOIN (
+    SELECT DISTINCT ON (doc_id) doc_id, dados_adicionais->>'arquivo_hash' AS arquivo_hash
+    FROM log_auditoria WHERE acao = 'DOCUMENTO_CRIADO'
+    ORDER BY doc_id, id
+) c ON c.doc_id = l.doc_id
+WHERE l.acao = 'ASSINATURA_CONCLUIDA' AND COALESCE(d.arquivo_hash, c.arquivo_hash) IS NOT NULL;
@@ -0,0 +1,19 @@
+-- Imagens de evidência (assinatura manuscrita, selfie) fora da linha de
+-- signatarios, em binário: consultas de metadados do signatário não
+-- carregam mais megabytes de data URLs
+CREATE TABLE IF NOT EXISTS signatarios_imagens (
+    signatario_id INTEGER NOT NULL REFERENCES signatarios(id) ON DELETE CASCADE,
+    tipo VARCHAR(20) NOT NULL,
+    mime VARCHAR(50),
+    conteudo BYTEA NOT NULL,
+    tamanho INTEGER,
+    criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (signatario_id, tipo)
+);
+
+-- Imagens já são comprimidas (JPEG/PNG)
+ALTER TABLE signatarios_imagens ALTER COLUMN conteudo SET STORAGE EXTERNAL;
+
+-- As imagens já gravadas em signatarios.assinatura_base64/selfie_base64 são
+-- movidas depois, em lotes, com o servidor no ar:
+--   flask --app app migrar-imagens
@@ -0,0 +1,11 @@
+-- PDF assinado gerado uma vez, na conclusão do documento, e guardado no blob
+-- store (arquivo_hash = SHA-256 do PDF assinado). layout_versao registra com
+-- qual versão da folha de assinaturas foi gerado: artefatos de versões
+-- anteriores são gerados de novo.
+CREATE TABLE IF NOT EXISTS artefatos_assinados (
+    doc_id VARCHAR(64) PRIMARY KEY REFERENCES documentos(doc_id) ON DELETE CASCADE,
+    layout_versao INTEGER NOT NULL,
+    arquivo_hash VARCHAR(64) NOT NULL,
+    tamanho BIGINT NOT NULL,
+    criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
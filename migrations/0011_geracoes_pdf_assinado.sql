@@ -0,0 +1,9 @@
+-- Geração de PDF assinado em andamento: uma por documento entre todos os
+-- workers. Quem insere a linha gera; os outros esperam o artefato aparecer
+-- em artefatos_assinados. A linha expira para que uma geração interrompida
+-- (worker morto) não trave o documento.
+CREATE TABLE IF NOT EXISTS geracoes_pdf_assinado (
+    doc_id VARCHAR(64) PRIMARY KEY REFERENCES documentos(doc_id) ON DELETE CASCADE,
+    dono VARCHAR(32) NOT NULL,
+    expira_em TIMESTAMP NOT NULL
+);
@@ -0,0 +1,7 @@
+-- Cada elo (cadeia, seq) aparece uma vez só: um seq repetido não pode ser
+-- gravado, em vez de depender da verificação para aparecer. Substitui o
+-- índice comum de mesmo nome criado por criar_indices (trava as escritas em
+-- log_auditoria enquanto o índice é construído). Registros legados têm
+-- cadeia/seq NULL e não entram na restrição.
+DROP INDEX IF EXISTS idx_log_auditoria_cadeia_seq;
+CREATE UNIQUE INDEX idx_log_auditoria_cadeia_seq ON log_auditoria (cadeia, seq);
@@ -0,0 +1,70 @@
+"""Configuração dos testes.
+
+Os testes usam um banco PostgreSQL dedicado, informado em TEST_DATABASE_URL:
+o esquema public desse banco é apagado e recriado pelas migrações no início
+da sessão - nunca aponte para um banco com dados. Sem TEST_DATABASE_URL os
+testes são ignorados.
+"""
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL', '')
+
+# Antes de importar o app: ele lê a configuração do ambiente na importação
+os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+os.environ['EMAIL_ENABLED'] = 'false'
+os.environ['BLOB_BACKEND'] = 'local'
+os.environ['BLOB_DIR'] = tempfile.mkdtemp(prefix='hami-testes-blobs-')
+os.environ['PDF_RENDER_PROCESSOS'] = '0'  # PDF gerado no próprio processo (tracemalloc)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Tabelas de dados (ficam de fora schema_version e a pasta raiz)
+TABELAS = ['geracoes_pdf_assinado', 'artefatos_assinados', 'signatarios_imagens', 'signatarios',
+           'documentos', 'lotes', 'evidencias_hash', 'log_auditoria', 'cadeias_auditoria',
+           'auditoria_checkpoints', 'blob_referencias', 'arquivos_blob']
+
+
+def pytest_collection_modifyitems(config, items):
+    if TEST_DATABASE_URL:
+        return
+    pular = pytest.mark.skip(reason='TEST_DATABASE_URL não definida')
+    for item in items:
+        item.add_marker(pular)
+
+
+@pytest.fixture(scope='session')
+def app_modulo():
+    """Módulo app com o banco de testes recriado pelas migrações"""
+    import psycopg
+    with psycopg.connect(TEST_DATABASE_URL, autocommit=True) as conn:
+        conn.execute('DROP SCHEMA public CASCADE')
+        conn.execute('CREATE SCHEMA public')
+    import app
+    app.migrar_banco()
+    return app
+
+
+@pytest.fixture(scope='module')
+def banco(app_modulo):
+    """Conexão em autocommit para preparar dados; as tabelas são esvaziadas no fim do módulo"""
+    import psycopg
+    from psycopg.rows import dict_row
+    conn = psycopg.connect(TEST_DATABASE_URL, autocommit=True, row_factory=dict_row)
+    yield conn
+    # Assinaturas concluídas disparam gerações e âncoras em segundo plano, que
+    # podem ainda estar gravando: o TRUNCATE é repetido se houver deadlock
+    for tentativa in range(5):
+        try:
+            conn.execute(f"TRUNCATE {', '.join(TABELAS)} RESTART IDENTITY")
+            break
+        except psycopg.errors.DeadlockDetected:
+            time.sleep(1)
+    else:
+        raise RuntimeError('Não foi possível esvaziar as tabelas de teste')
+    conn.execute('DELETE FROM pastas WHERE id > 1')
+    conn.close()
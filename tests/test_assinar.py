@@ -0,0 +1,50 @@
+"""POST /api/assinar: a preparação das imagens fica fora da transação que trava o signatário."""
+import base64
+import io
+
+import psycopg
+from PIL import Image
+
+import app
+
+
+def data_url_png(tamanho):
+    buffer = io.BytesIO()
+    Image.new('RGBA', tamanho, (0, 0, 0, 255)).save(buffer, 'PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def test_imagens_preparadas_antes_de_travar_o_signatario(banco, monkeypatch):
+    resposta = app.app.test_client().post('/api/criar_documento', json={
+        'titulo': 'Contrato',
+        'arquivo_nome': 'contrato.pdf',
+        'arquivo_base64': base64.b64encode(b'%PDF-1.4\n%%EOF\n').decode(),
+        'signatarios': [{'nome': 'Pessoa', 'email': 'p@x', 'cpf': '52998224725'}]
+    }).get_json()
+    signatario = banco.execute('SELECT id, token FROM signatarios WHERE doc_id = %s',
+                               (resposta['doc_id'],)).fetchone()
+
+    # Durante a preparação outra conexão consegue travar a linha do signatário
+    travado_na_preparacao = []
+    preparar_imagens_pdf = app.preparar_imagens_pdf
+
+    def preparar_sem_trava(itens):
+        try:
+            with banco.transaction():
+                banco.execute('SELECT 1 FROM signatarios WHERE id = %s FOR UPDATE NOWAIT', (signatario['id'],))
+            travado_na_preparacao.append(False)
+        except psycopg.errors.LockNotAvailable:
+            travado_na_preparacao.append(True)
+        return preparar_imagens_pdf(itens)
+    monkeypatch.setattr(app, 'preparar_imagens_pdf', preparar_sem_trava)
+
+    resposta = app.app.test_client().post('/api/assinar', json={
+        'token': signatario['token'], 'assinatura': data_url_png((600, 200))
+    }).get_json()
+
+    assert resposta.get('sucesso') is True and 'erro' not in resposta
+    assert travado_na_preparacao == [False]
+    imagens = {row['tipo']: row for row in banco.execute(
+        'SELECT tipo, mime, tamanho FROM signatarios_imagens WHERE signatario_id = %s', (signatario['id'],))}
+    assert set(imagens) == {'assinatura', 'assinatura_pdf'}
+    assert imagens['assinatura_pdf']['mime'] == 'image/png'
@@ -0,0 +1,160 @@
+"""Verificação das cadeias de auditoria (verificar_auditoria).
+
+Cadeia íntegra, registro adulterado, âncora que não confere com as cadeias e
+verificação incremental a partir do checkpoint assinado com HMAC - inclusive
+com um checkpoint forjado sem a chave.
+"""
+import hashlib
+import hmac
+import json
+
+import psycopg
+import pytest
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def log_vazio(banco, monkeypatch):
+    """Cada teste começa com o log vazio; registros recém-gravados já entram na verificação"""
+    banco.execute('TRUNCATE evidencias_hash, log_auditoria, cadeias_auditoria, auditoria_checkpoints RESTART IDENTITY')
+    monkeypatch.setattr(app, 'AUDITORIA_VERIFICACAO_MARGEM', 0)
+    monkeypatch.setattr(app, 'AUDITORIA_CHAVE_CHECKPOINT', 'chave-de-teste')
+
+
+def registrar(banco, doc_id, quantidade):
+    with banco.transaction():
+        cur = banco.cursor()
+        for i in range(quantidade):
+            app.anexar_auditoria(cur, doc_id, f'ACAO_{i}', usuario='teste', ip='127.0.0.1')
+        cur.close()
+
+
+def registro(banco, cadeia, seq):
+    return banco.execute('SELECT * FROM log_auditoria WHERE cadeia = %s AND seq = %s', (cadeia, seq)).fetchone()
+
+
+def test_cadeias_integras(banco):
+    registrar(banco, 'doc-a', 3)
+    registrar(banco, 'doc-b', 2)
+    assert app.ancorar_auditoria() is not None
+    registrar(banco, 'doc-a', 1)
+
+    resultado = app.verificar_auditoria(completo=True)
+
+    assert resultado['integra'], resultado['quebra']
+    assert resultado['verificados'] == 7
+    assert resultado['cadeias'] == 3  # doc-a, doc-b e ANCORA
+
+
+def test_seq_repetido_nao_e_gravado(banco):
+    registrar(banco, 'doc-a', 1)
+    with pytest.raises(psycopg.errors.UniqueViolation):
+        banco.execute('''
+            INSERT INTO log_auditoria (doc_id, acao, hash_anterior, hash_registro, cadeia, seq, hash_versao)
+            SELECT doc_id, acao, hash_anterior, hash_registro, cadeia, seq, hash_versao FROM log_auditoria
+        ''')
+
+
+def test_hash_registro_adulterado(banco):
+    registrar(banco, 'doc-a', 3)
+    adulterado = registro(banco, 'doc-a', 2)
+    banco.execute('UPDATE log_auditoria SET hash_registro = %s WHERE id = %s', ('f' * 64, adulterado['id']))
+
+    resultado = app.verificar_auditoria(completo=True)
+
+    assert not resultado['integra']
+    assert resultado['quebra']['id'] == adulterado['id']
+    assert resultado['quebra']['motivo'] == 'hash_registro não confere com o conteúdo do registro'
+    assert resultado['verificados'] == 1
+    assert resultado['checkpoint'] is None
+
+
+def reescrever_ancora(banco, alterar):
+    """Altera os dados da âncora e recalcula o hash dela, como faria quem forjasse a âncora"""
+    ancora = dict(registro(banco, app.AUDITORIA_CADEIA_ANCORA, 1))
+    alterar(ancora['dados_adicionais'])
+    banco.execute('UPDATE log_auditoria SET dados_adicionais = %s, hash_registro = %s WHERE id = %s',
+                  (json.dumps(ancora['dados_adicionais']), app.hash_auditoria(ancora), ancora['id']))
+
+
+def raiz(cadeias):
+    return hashlib.sha256(json.dumps(cadeias, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def test_ancora_com_elo_divergente(banco):
+    registrar(banco, 'doc-a', 2)
+    app.ancorar_auditoria()
+
+    def elo_falso(dados):
+        dados['cadeias']['doc-a']['hash'] = 'e' * 64
+        dados['raiz'] = raiz(dados['cadeias'])
+    reescrever_ancora(banco, elo_falso)
+
+    resultado = app.verificar_auditoria(completo=True)
+
+    assert resultado['quebra']['cadeia'] == app.AUDITORIA_CADEIA_ANCORA
+    assert resultado['quebra']['motivo'] == 'âncora diverge da cadeia doc-a no elo 2'
+
+
+def test_ancora_com_raiz_divergente(banco):
+    registrar(banco, 'doc-a', 2)
+    registrar(banco, 'doc-b', 1)
+    app.ancorar_auditoria()
+
+    def sem_doc_b(dados):
+        del dados['cadeias']['doc-b']
+    reescrever_ancora(banco, sem_doc_b)
+
+    resultado = app.verificar_auditoria(completo=True)
+
+    assert resultado['quebra']['cadeia'] == app.AUDITORIA_CADEIA_ANCORA
+    assert resultado['quebra']['motivo'] == 'raiz da âncora não confere com as cadeias incluídas'
+
+
+def test_verificacao_retoma_do_checkpoint(banco):
+    registrar(banco, 'doc-a', 3)
+    primeira = app.verificar_auditoria()
+    assert primeira['integra'] and primeira['verificados'] == 3
+    assert primeira['checkpoint'] is not None
+
+    registrar(banco, 'doc-a', 2)
+    registrar(banco, 'doc-b', 1)
+    segunda = app.verificar_auditoria()
+
+    assert segunda['integra'], segunda['quebra']
+    assert segunda['desde_id'] == primeira['ate_id']
+    assert segunda['verificados'] == 3
+    assert segunda['total_registros'] == 6
+    assert segunda['checkpoint'] > primeira['checkpoint']
+
+    # Adulterar o que o checkpoint já cobre só aparece na verificação completa
+    banco.execute("UPDATE log_auditoria SET usuario = 'outro' WHERE cadeia = 'doc-a' AND seq = 1")
+    assert app.verificar_auditoria()['integra']
+    assert not app.verificar_auditoria(completo=True)['integra']
+
+
+def test_checkpoint_forjado_e_ignorado(banco):
+    registrar(banco, 'doc-a', 2)
+    valido = app.verificar_auditoria()
+
+    registrar(banco, 'doc-a', 2)
+    adulterado = registro(banco, 'doc-a', 3)
+    banco.execute("UPDATE log_auditoria SET usuario = 'outro' WHERE id = %s", (adulterado['id'],))
+    # Checkpoint cobrindo o registro adulterado, assinado sem a chave certa
+    ultimo = registro(banco, 'doc-a', 4)
+    cabecas = {'doc-a': {'seq': 4, 'hash': ultimo['hash_registro']}}
+    conteudo = json.dumps({'ate_id': ultimo['id'], 'total_registros': 4, 'cabecas': cabecas},
+                          sort_keys=True, separators=(',', ':'))
+    forjado = banco.execute('''
+        INSERT INTO auditoria_checkpoints (ate_id, total_registros, cabecas, assinatura)
+        VALUES (%s, 4, %s, %s) RETURNING id
+    ''', (ultimo['id'], json.dumps(cabecas),
+          hmac.new(b'outra-chave', conteudo.encode(), hashlib.sha256).hexdigest())).fetchone()['id']
+
+    resultado = app.verificar_auditoria()
+
+    assert resultado['checkpoints_invalidos'] == [forjado]
+    assert resultado['desde_id'] == valido['ate_id']
+    assert not resultado['integra']
+    assert resultado['quebra']['id'] == adulterado['id']
@@ -0,0 +1,117 @@
+"""Contagem de referências dos blobs (migração 0004) e coleta dos que ficam sem referência.
+
+PDFs idênticos são gravados uma vez só no blob store; liberar_blobs só
+decrementa o contador e coletar_blobs apaga o que chegou a zero.
+"""
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def store(monkeypatch):
+    """Blob store local dos testes, contando as gravações em salvar_arquivo"""
+    store = app.get_blob_store()
+    store.gravacoes = []
+    salvar_arquivo = store.salvar_arquivo
+
+    def contar(hash_hex, arquivo, cur=None):
+        store.gravacoes.append(hash_hex)
+        return salvar_arquivo(hash_hex, arquivo, cur)
+    monkeypatch.setattr(store, 'salvar_arquivo', contar)
+    return store
+
+
+def conteudo():
+    return b'%PDF-1.4\n' + os.urandom(4096)
+
+
+def referenciar(banco, dados):
+    with banco.transaction():
+        return app.referenciar_blob(banco.cursor(), dados)
+
+
+def liberar(banco, *hashes):
+    with banco.transaction():
+        app.liberar_blobs(banco.cursor(), list(hashes))
+
+
+def referencias(banco, hash_hex):
+    row = banco.execute('SELECT referencias FROM blob_referencias WHERE hash = %s', (hash_hex,)).fetchone()
+    return row['referencias'] if row else None
+
+
+def test_conteudo_repetido_gravado_uma_vez(banco, store):
+    dados = conteudo()
+
+    primeiro = referenciar(banco, dados)
+    segundo = referenciar(banco, dados)
+
+    assert primeiro == segundo
+    assert referencias(banco, primeiro) == 2
+    assert store.gravacoes == [primeiro]
+    assert store.ler(primeiro) == dados
+
+
+def test_liberar_uma_de_duas_referencias_mantem_o_blob(banco, store):
+    hash_hex = referenciar(banco, conteudo())
+    referenciar(banco, store.ler(hash_hex))
+
+    liberar(banco, hash_hex)
+    app.coletar_blobs()
+
+    assert referencias(banco, hash_hex) == 1
+    assert store.existe(hash_hex)
+
+
+def test_ultima_referencia_liberada_e_apagada_na_coleta(banco, store):
+    hash_hex = referenciar(banco, conteudo())
+
+    liberar(banco, hash_hex)
+    # Só a coleta apaga o conteúdo
+    assert referencias(banco, hash_hex) == 0
+    assert store.existe(hash_hex)
+
+    assert app.coletar_blobs() >= 1
+    assert referencias(banco, hash_hex) is None
+    assert not store.existe(hash_hex)
+
+
+def test_liberar_o_mesmo_blob_duas_vezes_na_mesma_exclusao(banco, store):
+    # Dois documentos com o mesmo PDF excluídos juntos (excluir_pasta)
+    dados = conteudo()
+    hash_hex = referenciar(banco, dados)
+    referenciar(banco, dados)
+    referenciar(banco, dados)
+
+    liberar(banco, hash_hex, hash_hex)
+
+    assert referencias(banco, hash_hex) == 1
+
+
+def test_nova_referencia_antes_da_coleta_mantem_o_arquivo(banco, store):
+    dados = conteudo()
+    hash_hex = referenciar(banco, dados)
+    liberar(banco, hash_hex)
+
+    assert referenciar(banco, dados) == hash_hex
+    app.coletar_blobs()
+
+    assert referencias(banco, hash_hex) == 1
+    assert store.ler(hash_hex) == dados
+
+
+def test_nova_referencia_depois_da_coleta_grava_de_novo(banco, store):
+    dados = conteudo()
+    hash_hex = referenciar(banco, dados)
+    liberar(banco, hash_hex)
+    app.coletar_blobs()
+    assert not store.existe(hash_hex)
+
+    referenciar(banco, dados)
+
+    assert referencias(banco, hash_hex) == 1
+    assert store.ler(hash_hex) == dados
+    assert store.gravacoes == [hash_hex, hash_hex]
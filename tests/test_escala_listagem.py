@@ -0,0 +1,93 @@
+"""Escala de /api/documentos (listagem completa, em streaming) com o tamanho da tabela.
+
+Mede a listagem completa com N e 4N documentos. Com os contadores mantidos em
+documentos o custo por linha é constante e o tempo cresce ~4x; com as
+subconsultas correlacionadas de antes crescia ~16x. Com -s imprime a tabela de
+tempos. A medição de tempo depende da máquina e só roda com
+TESTES_DESEMPENHO=1.
+"""
+import os
+import time
+
+import pytest
+
+import app
+
+TAMANHOS = [5000, 20000]
+REPETICOES = 3
+
+desempenho = pytest.mark.skipif(not os.environ.get('TESTES_DESEMPENHO'),
+                                reason='medição de tempo: defina TESTES_DESEMPENHO=1')
+
+
+@pytest.fixture
+def sem_documentos(banco):
+    """Cada teste insere os seus documentos em tabelas vazias (ids a partir de 1)"""
+    banco.execute('TRUNCATE signatarios, documentos RESTART IDENTITY CASCADE')
+
+
+def inserir_documentos(banco, inicio, fim):
+    banco.execute('''
+        INSERT INTO documentos (doc_id, titulo, arquivo_nome, arquivo_hash, criado_por, pasta_id,
+                                criado_em, total_signatarios, assinados)
+        SELECT 'doc' || g, 'Documento ' || g, 'd.pdf', md5(g::text) || md5(g::text), 'usuario' || g %% 100, 1,
+               timestamp '2023-01-01' + g * interval '1 minute', 2, g %% 3
+        FROM generate_series(%s::int, %s::int) g
+    ''', (inicio, fim))
+    banco.execute('''
+        INSERT INTO signatarios (doc_id, nome, email, cpf, token, assinado)
+        SELECT d.doc_id, 'Signatário ' || n, 's@x', '52998224725', md5(d.doc_id || n), n <= d.assinados
+        FROM documentos d, generate_series(1, 2) n
+        WHERE d.id BETWEEN %s AND %s
+    ''', (inicio, fim))
+    banco.execute('ANALYZE documentos, signatarios')
+
+
+def listar_tudo(cliente):
+    resposta = cliente.get('/api/documentos')
+    assert resposta.status_code == 200
+    return resposta.get_json()['documentos']
+
+
+@desempenho
+def test_listagem_completa_escala_linearmente(banco, sem_documentos):
+    cliente = app.app.test_client()
+    tempos = {}
+    inseridos = 0
+    for tamanho in TAMANHOS:
+        inserir_documentos(banco, inseridos + 1, tamanho)
+        inseridos = tamanho
+
+        documentos = listar_tudo(cliente)  # aquece cache e pool
+        assert len(documentos) == tamanho
+        medidas = []
+        for _ in range(REPETICOES):
+            inicio = time.perf_counter()
+            listar_tudo(cliente)
+            medidas.append(time.perf_counter() - inicio)
+        tempos[tamanho] = min(medidas)
+
+    print('\n  documentos   tempo (s)   us/documento')
+    for tamanho, tempo in tempos.items():
+        print(f'  {tamanho:>10}   {tempo:>9.3f}   {tempo / tamanho * 1e6:>12.1f}')
+
+    razao_tamanho = TAMANHOS[-1] / TAMANHOS[0]
+    razao_tempo = tempos[TAMANHOS[-1]] / tempos[TAMANHOS[0]]
+    # Linear ~4x; quadrático ~16x. Folga de 2x para ruído de medição.
+    assert razao_tempo < 2 * razao_tamanho, f'tempo cresceu {razao_tempo:.1f}x para {razao_tamanho:.0f}x documentos'
+
+
+def test_contadores_da_listagem_batem_com_signatarios(banco, sem_documentos):
+    inserir_documentos(banco, 1, 300)
+    esperados = {
+        row['doc_id']: (row['total'], row['assinados'])
+        for row in banco.execute('''
+            SELECT doc_id, COUNT(*) AS total, COUNT(*) FILTER (WHERE assinado) AS assinados
+            FROM signatarios GROUP BY doc_id
+        ''')
+    }
+    documentos = listar_tudo(app.app.test_client())
+    assert {d['doc_id']: (d['total_signatarios'], d['assinados']) for d in documentos} == esperados
+    # Mesma forma do JSON de antes
+    assert set(documentos[0]) == {'doc_id', 'titulo', 'arquivo_nome', 'criado_em', 'criado_por',
+                                  'total_signatarios', 'assinados', 'lote_id'}
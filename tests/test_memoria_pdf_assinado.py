@@ -0,0 +1,115 @@
+"""Pico de memória (tracemalloc) de renderizar_pdf_assinado.
+
+O original e o PDF em montagem ficam em memória só até ARQUIVO_SPOOL_LIMITE;
+acima disso vão para disco. O pico tem que ficar perto desse limite mais a
+folha de assinaturas e não pode crescer com o tamanho do original.
+"""
+import base64
+import io
+import os
+import tracemalloc
+
+import pytest
+from PIL import Image
+
+import app
+
+MiB = 1024 * 1024
+SPOOL_LIMITE = 1 * MiB
+# Folha de assinaturas (ReportLab, em memória até fechar) e estruturas do
+# PyPDF2 com 2 signatários
+FOLGA_FOLHA = 4 * MiB
+
+
+def imagem_ruido(formato, tamanho):
+    """Imagem que não comprime (ruído): o tamanho do PDF é o das imagens"""
+    buffer = io.BytesIO()
+    Image.frombytes('RGB', tamanho, os.urandom(tamanho[0] * tamanho[1] * 3)).save(buffer, formato)
+    return buffer.getvalue()
+
+
+def pdf_original(paginas):
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer)
+    for i in range(paginas):
+        c.drawImage(ImageReader(io.BytesIO(imagem_ruido('JPEG', (700, 700)))), 50, 100, 500, 500)
+        c.drawString(100, 700, f'Página {i + 1}')
+        c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+
+def data_url(mime, conteudo):
+    return f'data:{mime};base64,{base64.b64encode(conteudo).decode()}'
+
+
+def documento_assinado(banco, paginas):
+    """Documento concluído com 2 signatários; assinado direto no banco, sem a geração em segundo plano"""
+    original = pdf_original(paginas)
+    resposta = app.app.test_client().post('/api/criar_documento', json={
+        'titulo': f'Original de {paginas} páginas',
+        'arquivo_nome': 'original.pdf',
+        'arquivo_base64': base64.b64encode(original).decode(),
+        'signatarios': [{'nome': f'Pessoa {i}', 'email': f'p{i}@x', 'cpf': '52998224725'} for i in range(2)]
+    }).get_json()
+    doc_id = resposta['doc_id']
+
+    cur = banco.cursor()
+    for sig in cur.execute('SELECT id FROM signatarios WHERE doc_id = %s', (doc_id,)).fetchall():
+        cur.execute('''
+            UPDATE signatarios SET assinado = TRUE, data_assinatura = NOW(), ip_assinatura = '127.0.0.1',
+                   aceite_termos = TRUE, data_aceite = NOW(), hash_aceite = md5(id::text)
+            WHERE id = %s
+        ''', (sig['id'],))
+        app.gravar_imagens_signatario(cur, sig['id'], app.preparar_imagens_signatario({
+            'assinatura': data_url('image/png', imagem_ruido('PNG', (300, 100))),
+            'selfie': data_url('image/jpeg', imagem_ruido('JPEG', (640, 480)))
+        }))
+    cur.execute('UPDATE documentos SET assinados = total_signatarios, concluido_em = NOW() WHERE doc_id = %s',
+                (doc_id,))
+    cur.close()
+    return doc_id, len(original)
+
+
+def pico_renderizacao(doc_id):
+    # Fora da medição: a primeira geração importa o PyPDF2 e o ReportLab
+    arquivo, _ = app.renderizar_pdf_assinado(doc_id)
+    arquivo.close()
+
+    tracemalloc.start()
+    try:
+        arquivo, _ = app.renderizar_pdf_assinado(doc_id)
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    with arquivo:
+        arquivo.seek(0, os.SEEK_END)
+        tamanho = arquivo.tell()
+    return pico, tamanho
+
+
+@pytest.fixture
+def spool_pequeno(monkeypatch):
+    monkeypatch.setattr(app, 'ARQUIVO_SPOOL_LIMITE', SPOOL_LIMITE)
+
+
+def test_pico_limitado_pelo_spool_e_nao_cresce_com_o_original(banco, spool_pequeno):
+    medidas = []
+    for paginas in (20, 40):
+        doc_id, tamanho_original = documento_assinado(banco, paginas)
+        pico, tamanho_assinado = pico_renderizacao(doc_id)
+        assert tamanho_assinado > tamanho_original > 4 * SPOOL_LIMITE
+        medidas.append((tamanho_original, pico))
+
+    print('\n  original (MiB)   pico (MiB)')
+    for tamanho_original, pico in medidas:
+        print(f'  {tamanho_original / MiB:>14.1f}   {pico / MiB:>10.1f}')
+
+    (original_1, pico_1), (original_2, pico_2) = medidas
+    for _, pico in medidas:
+        assert pico < SPOOL_LIMITE + FOLGA_FOLHA, f'pico de {pico / MiB:.1f} MiB'
+    # Original ~2x maior: o pico quase não muda (bem menos que a diferença dos originais)
+    assert pico_2 - pico_1 < (original_2 - original_1) / 10, \
+        f'pico cresceu {(pico_2 - pico_1) / MiB:.1f} MiB com +{(original_2 - original_1) / MiB:.1f} MiB de original'
@@ -0,0 +1,46 @@
+"""Falhas de `flask migrar` interrompem o deploy."""
+import app
+
+INDICE_QUE_FALHA = ('idx_teste_falha', 'documentos ((1 / (id - id)))')  # divisão por zero ao indexar
+
+
+def indice(banco, nome):
+    return banco.execute('''
+        SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid WHERE c.relname = %s
+    ''', (nome,)).fetchone()
+
+
+def test_indice_que_falha_interrompe_migrar(banco, monkeypatch):
+    banco.execute("INSERT INTO documentos (doc_id, titulo) VALUES ('doc-migrar', 'x')")
+    monkeypatch.setattr(app, 'INDICES', app.INDICES + [INDICE_QUE_FALHA])
+
+    resultado = app.app.test_cli_runner().invoke(args=['migrar'])
+
+    assert resultado.exit_code == 1
+    assert 'idx_teste_falha' in resultado.output
+    # O CONCURRENTLY que falhou não deixa índice inválido para trás
+    assert indice(banco, 'idx_teste_falha') is None
+
+
+def test_indice_invalido_e_recriado(banco):
+    nome, _ = app.INDICES[0]
+    banco.execute(f'DROP INDEX {nome}')
+    banco.execute(f"CREATE INDEX {nome} ON documentos (id)")
+    banco.execute("UPDATE pg_index SET indisvalid = FALSE WHERE indexrelid = %s::regclass", (nome,))
+
+    resultado = app.app.test_cli_runner().invoke(args=['migrar'])
+
+    assert resultado.exit_code == 0, resultado.output
+    assert indice(banco, nome)['indisvalid']
+    definicao = banco.execute('SELECT pg_get_indexdef(%s::regclass) AS d', (nome,)).fetchone()['d']
+    assert definicao.endswith(f'ON public.{app.INDICES[0][1].replace(" (", " USING btree (")}')
+
+
+def test_indices_removidos_nao_existem(banco):
+    banco.execute('CREATE INDEX IF NOT EXISTS idx_log_auditoria_doc_id_acao ON log_auditoria (doc_id, acao)')
+
+    resultado = app.app.test_cli_runner().invoke(args=['migrar'])
+
+    assert resultado.exit_code == 0, resultado.output
+    for nome in app.INDICES_REMOVIDOS:
+        assert indice(banco, nome) is None
@@ -0,0 +1,63 @@
+"""GET /api/pdf_assinado: recusas antes de reivindicar a geração."""
+import base64
+import io
+
+import pytest
+
+import app
+
+
+def pdf_simples():
+    from reportlab.pdfgen import canvas
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer)
+    c.drawString(100, 700, 'Contrato')
+    c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+
+def criar_documento(signatarios=2):
+    return app.app.test_client().post('/api/criar_documento', json={
+        'titulo': 'Contrato',
+        'arquivo_nome': 'contrato.pdf',
+        'arquivo_base64': base64.b64encode(pdf_simples()).decode(),
+        'signatarios': [{'nome': f'Pessoa {i}', 'email': f'p{i}@x', 'cpf': '52998224725'} for i in range(signatarios)]
+    }).get_json()['doc_id']
+
+
+@pytest.fixture
+def geracoes(monkeypatch):
+    """Documentos enviados para geração (não deve haver nenhum)"""
+    enviados = []
+    monkeypatch.setattr(app, 'gerar_pdf_assinado', lambda doc_id: enviados.append(doc_id))
+    return enviados
+
+
+def test_documento_pendente_recusado_sem_reivindicar(banco, geracoes):
+    doc_id = criar_documento()
+
+    resposta = app.app.test_client().get(f'/api/pdf_assinado/{doc_id}')
+
+    assert resposta.status_code == 400
+    assert 'totalmente assinado' in resposta.get_json()['erro']
+    assert geracoes == []
+    assert banco.execute('SELECT COUNT(*) AS n FROM geracoes_pdf_assinado').fetchone()['n'] == 0
+
+
+def test_documento_sem_signatarios_recusado_sem_reivindicar(banco, geracoes):
+    doc_id = criar_documento()
+    banco.execute('UPDATE documentos SET total_signatarios = 0 WHERE doc_id = %s', (doc_id,))
+
+    resposta = app.app.test_client().get(f'/api/pdf_assinado/{doc_id}')
+
+    assert resposta.status_code == 404
+    assert geracoes == []
+    assert banco.execute('SELECT COUNT(*) AS n FROM geracoes_pdf_assinado').fetchone()['n'] == 0
+
+
+def test_documento_inexistente(banco, geracoes):
+    resposta = app.app.test_client().get('/api/pdf_assinado/nao-existe')
+
+    assert resposta.status_code == 404
+    assert geracoes == []
@@ -0,0 +1,169 @@
+"""PDF assinado como atualização incremental do original (anexar_paginas_incremental).
+
+O original fica byte a byte no início do resultado, com o tamanho registrado
+em /HamiTamanhoOriginal, e ganha as páginas da folha. Originais que a
+atualização não suporta (xref em stream, object streams, trailer corrompido)
+são regravados inteiros pela geração.
+"""
+import base64
+import hashlib
+import io
+import re
+
+import pytest
+from PyPDF2 import PdfReader
+
+import app
+
+
+def pdf_reportlab(paginas, texto='Página'):
+    from reportlab.pdfgen import canvas
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer)
+    for i in range(paginas):
+        c.drawString(100, 700, f'{texto} {i + 1}')
+        c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+
+def pdf_xref_em_stream(object_streams):
+    """PDF 1.5 de uma página com a xref em stream e, opcionalmente, catálogo e páginas num object stream"""
+    objetos = {
+        1: b'<< /Type /Catalog /Pages 2 0 R >>',
+        2: b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        3: b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R /Resources << >> >>',
+    }
+    conteudo = b'0 0 m 100 100 l S'
+    saida = io.BytesIO()
+    saida.write(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+    entradas = {0: (0, 0, 65535)}  # número -> (tipo, campo 2, campo 3) da xref
+
+    def gravar(numero, corpo):
+        entradas[numero] = (1, saida.tell(), 0)
+        saida.write(b'%d 0 obj\n%s\nendobj\n' % (numero, corpo))
+
+    if object_streams:
+        cabecalho, corpo = b'', b''
+        for numero, obj in objetos.items():
+            cabecalho += b'%d %d ' % (numero, len(corpo))
+            corpo += obj + b'\n'
+        gravar(5, b'<< /Type /ObjStm /N %d /First %d /Length %d >>\nstream\n%s\nendstream'
+               % (len(objetos), len(cabecalho), len(cabecalho + corpo), cabecalho + corpo))
+        for indice, numero in enumerate(objetos):
+            entradas[numero] = (2, 5, indice)
+    else:
+        for numero, obj in objetos.items():
+            gravar(numero, obj)
+    gravar(4, b'<< /Length %d >>\nstream\n%s\nendstream' % (len(conteudo), conteudo))
+
+    inicio_xref = saida.tell()
+    entradas[6] = (1, inicio_xref, 0)
+    tamanho = max(entradas) + 1
+    dados = b''.join(bytes([tipo]) + campo2.to_bytes(4, 'big') + campo3.to_bytes(2, 'big')
+                     for tipo, campo2, campo3 in (entradas.get(n, (0, 0, 0)) for n in range(tamanho)))
+    saida.write(b'6 0 obj\n<< /Type /XRef /Size %d /W [1 4 2] /Root 1 0 R /Length %d >>\nstream\n%s\nendstream\nendobj\n'
+                % (tamanho, len(dados), dados))
+    saida.write(b'startxref\n%d\n%%%%EOF\n' % inicio_xref)
+    return saida.getvalue()
+
+
+def pdf_startxref_corrompido():
+    """Original de 2 páginas cujo startxref não aponta para a xref (o PyPDF2 reconstrói, a atualização não)"""
+    original = pdf_reportlab(2)
+    posicao = original.rfind(b'startxref')
+    return original[:posicao] + re.sub(rb'startxref\s+\d+', b'startxref\n17', original[posicao:])
+
+
+ORIGINAIS_SEM_INCREMENTAL = {
+    'xref_em_stream': lambda: pdf_xref_em_stream(object_streams=False),
+    'object_streams': lambda: pdf_xref_em_stream(object_streams=True),
+    'startxref_corrompido': pdf_startxref_corrompido,
+}
+
+
+def anexar(original, folha):
+    destino = io.BytesIO()
+    app.anexar_paginas_incremental(io.BytesIO(original), folha, destino)
+    return destino.getvalue()
+
+
+def test_original_intacto_no_inicio():
+    original = pdf_reportlab(3)
+    folha = pdf_reportlab(2, 'Assinaturas')
+
+    resultado = anexar(original, folha)
+
+    assert resultado[:len(original)] == original
+    leitor = PdfReader(io.BytesIO(resultado))
+    assert leitor.trailer['/HamiTamanhoOriginal'] == len(original)
+    assert hashlib.sha256(resultado[:leitor.trailer['/HamiTamanhoOriginal']]).hexdigest() == hashlib.sha256(original).hexdigest()
+    assert len(leitor.pages) == 5
+    assert [pagina.extract_text().strip() for pagina in leitor.pages] == \
+        ['Página 1', 'Página 2', 'Página 3', 'Assinaturas 1', 'Assinaturas 2']
+
+
+def test_segunda_atualizacao_preserva_a_primeira():
+    # Um PDF assinado usado como original de outro documento
+    primeira = anexar(pdf_reportlab(1), pdf_reportlab(1, 'Assinaturas'))
+
+    resultado = anexar(primeira, pdf_reportlab(1, 'Outras assinaturas'))
+
+    assert resultado[:len(primeira)] == primeira
+    leitor = PdfReader(io.BytesIO(resultado))
+    assert leitor.trailer['/HamiTamanhoOriginal'] == len(primeira)
+    assert len(leitor.pages) == 3
+
+
+@pytest.mark.parametrize('tipo', ORIGINAIS_SEM_INCREMENTAL)
+def test_original_sem_suporte_recusado_sem_gravar(tipo):
+    destino = io.BytesIO()
+    with pytest.raises(ValueError):
+        app.anexar_paginas_incremental(io.BytesIO(ORIGINAIS_SEM_INCREMENTAL[tipo]()), pdf_reportlab(1), destino)
+    assert destino.getvalue() == b''
+
+
+def documento_concluido(banco, original):
+    """Documento com o original dado e os 2 signatários já assinados direto no banco"""
+    doc_id = app.app.test_client().post('/api/criar_documento', json={
+        'titulo': 'Contrato',
+        'arquivo_nome': 'contrato.pdf',
+        'arquivo_base64': base64.b64encode(original).decode(),
+        'signatarios': [{'nome': f'Pessoa {i}', 'email': f'p{i}@x', 'cpf': '52998224725'} for i in range(2)]
+    }).get_json()['doc_id']
+    banco.execute('''
+        UPDATE signatarios SET assinado = TRUE, data_assinatura = NOW(), ip_assinatura = '127.0.0.1',
+               aceite_termos = TRUE, data_aceite = NOW(), hash_aceite = md5(id::text)
+        WHERE doc_id = %s
+    ''', (doc_id,))
+    banco.execute('UPDATE documentos SET assinados = total_signatarios, concluido_em = NOW() WHERE doc_id = %s',
+                  (doc_id,))
+    return doc_id
+
+
+def renderizar(doc_id):
+    arquivo, _ = app.renderizar_pdf_assinado(doc_id)
+    with arquivo:
+        return arquivo.read()
+
+
+def test_geracao_incremental(banco):
+    original = pdf_reportlab(2)
+
+    assinado = renderizar(documento_concluido(banco, original))
+
+    assert assinado.startswith(original)
+    assert len(PdfReader(io.BytesIO(assinado)).pages) > 2
+
+
+@pytest.mark.parametrize('tipo', ORIGINAIS_SEM_INCREMENTAL)
+def test_geracao_regrava_original_sem_suporte(banco, tipo):
+    original = ORIGINAIS_SEM_INCREMENTAL[tipo]()
+    paginas_original = len(PdfReader(io.BytesIO(original)).pages)
+
+    assinado = renderizar(documento_concluido(banco, original))
+
+    assert not assinado.startswith(original)
+    leitor = PdfReader(io.BytesIO(assinado))
+    assert '/HamiTamanhoOriginal' not in leitor.trailer
+    assert len(leitor.pages) > paginas_original
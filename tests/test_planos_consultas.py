@@ -0,0 +1,83 @@
+"""Planos das consultas das rotas sobre um banco com volume (planejador com as opções padrão).
+
+As consultas vêm de consultas_indexadas(): o mesmo SQL que listar_documentos,
+verificar_permanente, excluir_pasta, limpar_documentos_antigos e as buscas de
+signatários executam. Aqui enable_seqscan fica ligado - o índice tem que ser
+a escolha do planejador, não a única opção permitida.
+"""
+import json
+
+import pytest
+
+import app
+
+DOCUMENTOS = 30000
+PASTAS = 5000
+CRIADORES = 500
+
+
+@pytest.fixture(scope='module')
+def dados(banco):
+    banco.execute('''
+        INSERT INTO pastas (id, nome, pasta_pai_id, criado_por)
+        SELECT g, 'pasta ' || g, 1 + g / 10, 'x' FROM generate_series(2, %s) g
+    ''', (PASTAS + 1,))
+    banco.execute("SELECT setval('pastas_id_seq', %s)", (PASTAS + 1,))
+    banco.execute('''
+        INSERT INTO lotes (lote_id, total_signatarios)
+        SELECT 'lote' || g, 2 FROM generate_series(1, %s) g
+    ''', (DOCUMENTOS // 10,))
+    # Um documento por hora desde 2023; um em cada dez em lote, metade concluídos
+    banco.execute('''
+        INSERT INTO documentos (doc_id, titulo, arquivo_nome, arquivo_hash, criado_por, pasta_id, lote_id,
+                                criado_em, concluido_em, total_signatarios)
+        SELECT 'doc' || g, 'Documento ' || g, 'd.pdf', md5(g::text) || md5(g::text), 'usuario' || g %% %s,
+               2 + g %% %s, CASE WHEN g %% 10 = 0 THEN 'lote' || g / 10 END,
+               timestamp '2023-01-01' + g * interval '1 hour',
+               CASE WHEN g %% 2 = 0 THEN timestamp '2023-01-01' + g * interval '1 hour' END, 2
+        FROM generate_series(1, %s) g
+    ''', (CRIADORES, PASTAS, DOCUMENTOS))
+    banco.execute('''
+        INSERT INTO signatarios (doc_id, nome, email, cpf, token, assinado, lote_id)
+        SELECT d.doc_id, 'Signatário ' || n, 's@x', '52998224725', md5(d.doc_id || n), d.concluido_em IS NOT NULL, d.lote_id
+        FROM documentos d, generate_series(1, 2) n
+    ''')
+    banco.execute('''
+        INSERT INTO evidencias_hash (arquivo_hash, doc_id, acao, usuario)
+        SELECT arquivo_hash, doc_id, 'DOCUMENTO_CRIADO', criado_por FROM documentos
+    ''')
+    banco.execute('ANALYZE')
+
+
+def varreduras(sql, params, tabela, conn):
+    cur = conn.cursor()
+    cur.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+    plano = cur.fetchone()['QUERY PLAN'][0]['Plan']
+    conn.rollback()
+    return plano, app.varreduras_sequenciais(plano, tabela)
+
+
+@pytest.mark.parametrize('descricao, tabela, sql, params', app.consultas_indexadas(),
+                         ids=[c[0] for c in app.consultas_indexadas()])
+def test_consulta_da_rota_usa_indice(dados, descricao, tabela, sql, params):
+    with app.get_db() as conn:
+        plano, seq_scans = varreduras(sql, params, tabela, conn)
+    assert not seq_scans, f'{descricao}: varredura sequencial em {tabela}\n{json.dumps(plano, indent=2)}'
+
+
+def test_listagem_com_cursor_real_usa_indice(dados):
+    # Cursor devolvido pela própria rota, no meio da tabela
+    resposta = app.app.test_client().get('/api/documentos?limite=50&criado_por=usuario7')
+    corpo = resposta.get_json()
+    assert len(corpo['documentos']) == 50 and corpo['proximo_cursor']
+
+    condicoes, params = app.filtros_documentos({'criado_por': 'usuario7'})
+    depois_de = app.decodificar_cursor(corpo['proximo_cursor'])
+    with app.get_db() as conn:
+        plano, seq_scans = varreduras(*app.sql_listagem_documentos(condicoes, params, 51, depois_de), 'documentos', conn)
+    assert not seq_scans, json.dumps(plano, indent=2)
+
+
+def test_verificar_planos_consultas(dados):
+    assert app.verificar_planos_consultas(forcar_indices=False) == []
+    assert app.verificar_planos_consultas() == []
@@ -0,0 +1,128 @@
+"""Contadores de progresso (migração 0005) para linhas gravadas pela versão anterior.
+
+Durante o deploy a versão anterior continua no ar enquanto `flask migrar`
+roda: o que ela grava depois do backfill fica sem contadores (documentos com
+total_signatarios = 0, lotes sem linha em lotes). A primeira assinatura
+os reconta a partir de signatarios.
+"""
+import base64
+import threading
+import uuid
+
+import pytest
+
+import app
+
+ASSINATURA = 'data:image/png;base64,' + base64.b64encode(
+    bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+                  '1f15c4890000000d49444154789c6360f8cfc0f01f0005000201a3f6d1ad0000000049454e44ae426082')).decode()
+
+
+def documento_versao_anterior(banco, lote_id=None):
+    """Documento como a versão anterior grava: sem os contadores"""
+    doc_id = uuid.uuid4().hex[:12]
+    banco.execute('INSERT INTO documentos (doc_id, titulo, arquivo_nome, criado_por, lote_id) VALUES (%s, %s, %s, %s, %s)',
+                  (doc_id, 'Contrato', 'c.pdf', 'teste', lote_id))
+    return doc_id
+
+
+def signatarios_versao_anterior(banco, doc_id, quantidade, lote_id=None):
+    tokens = [uuid.uuid4().hex for _ in range(quantidade)]
+    for i, token in enumerate(tokens):
+        banco.execute('INSERT INTO signatarios (doc_id, nome, email, cpf, token, lote_id) VALUES (%s, %s, %s, %s, %s, %s)',
+                      (doc_id, f'Pessoa {i}', f'p{i}@x', '52998224725', token, lote_id))
+    return tokens
+
+
+def assinar(token):
+    """True se a rota confirmou a assinatura"""
+    resposta = app.app.test_client().post('/api/assinar', json={'token': token, 'assinatura': ASSINATURA}).get_json()
+    return resposta.get('sucesso') is True and 'erro' not in resposta
+
+
+def progresso_documento(banco, doc_id):
+    return banco.execute('SELECT total_signatarios, assinados, concluido_em FROM documentos WHERE doc_id = %s',
+                         (doc_id,)).fetchone()
+
+
+def test_documento_sem_contadores_nao_conclui_na_primeira_assinatura(banco):
+    doc_id = documento_versao_anterior(banco)
+    tokens = signatarios_versao_anterior(banco, doc_id, 2)
+    assert progresso_documento(banco, doc_id)['total_signatarios'] == 0
+
+    assert assinar(tokens[0])
+    progresso = progresso_documento(banco, doc_id)
+    assert (progresso['total_signatarios'], progresso['assinados'], progresso['concluido_em']) == (2, 1, None)
+
+    assert assinar(tokens[1])
+    progresso = progresso_documento(banco, doc_id)
+    assert (progresso['total_signatarios'], progresso['assinados']) == (2, 2)
+    assert progresso['concluido_em'] is not None
+
+
+def test_documento_sem_contadores_com_assinatura_anterior(banco):
+    # Um signatário já assinou pela versão anterior (que não contava)
+    doc_id = documento_versao_anterior(banco)
+    tokens = signatarios_versao_anterior(banco, doc_id, 2)
+    banco.execute('UPDATE signatarios SET assinado = TRUE WHERE token = %s', (tokens[0],))
+
+    assert assinar(tokens[1])
+    progresso = progresso_documento(banco, doc_id)
+    assert (progresso['total_signatarios'], progresso['assinados']) == (2, 2)
+    assert progresso['concluido_em'] is not None
+
+
+def lote_versao_anterior(banco, documentos=2, signatarios=3):
+    lote_id = uuid.uuid4().hex[:12]
+    doc_ids = [documento_versao_anterior(banco, lote_id=lote_id) for _ in range(documentos)]
+    # Signatários do lote ficam no primeiro documento
+    tokens = signatarios_versao_anterior(banco, doc_ids[0], signatarios, lote_id=lote_id)
+    assert banco.execute('SELECT 1 FROM lotes WHERE lote_id = %s', (lote_id,)).fetchone() is None
+    return lote_id, doc_ids, tokens
+
+
+def progresso_lote(banco, lote_id):
+    return banco.execute('SELECT total_signatarios, assinados, concluido_em FROM lotes WHERE lote_id = %s',
+                         (lote_id,)).fetchone()
+
+
+def test_lote_sem_linha_em_lotes(banco):
+    lote_id, doc_ids, tokens = lote_versao_anterior(banco)
+
+    assert assinar(tokens[0])
+    progresso = progresso_lote(banco, lote_id)
+    assert (progresso['total_signatarios'], progresso['assinados'], progresso['concluido_em']) == (3, 1, None)
+    for doc_id in doc_ids:
+        assert dict(progresso_documento(banco, doc_id)) == dict(progresso)
+
+    for token in tokens[1:]:
+        assert assinar(token)
+    progresso = progresso_lote(banco, lote_id)
+    assert (progresso['total_signatarios'], progresso['assinados']) == (3, 3)
+    assert progresso['concluido_em'] is not None
+    for doc_id in doc_ids:
+        assert progresso_documento(banco, doc_id)['concluido_em'] == progresso['concluido_em']
+
+
+@pytest.mark.parametrize('em_lote', [False, True], ids=['documento', 'lote'])
+def test_assinaturas_simultaneas_sem_contadores(banco, em_lote):
+    signatarios = 6
+    if em_lote:
+        lote_id, _, tokens = lote_versao_anterior(banco, signatarios=signatarios)
+        ler = lambda: progresso_lote(banco, lote_id)
+    else:
+        doc_id = documento_versao_anterior(banco)
+        tokens = signatarios_versao_anterior(banco, doc_id, signatarios)
+        ler = lambda: progresso_documento(banco, doc_id)
+
+    respostas = []
+    threads = [threading.Thread(target=lambda t=token: respostas.append(assinar(t))) for token in tokens]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert respostas == [True] * signatarios
+    progresso = ler()
+    assert (progresso['total_signatarios'], progresso['assinados']) == (signatarios, signatarios)
+    assert progresso['concluido_em'] is not None